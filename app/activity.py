@@ -0,0 +1,586 @@
+"""This module handles importing the recent activity of list members."""
+from collections import OrderedDict
+from itertools import compress
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+from app.concurrency import TaskGroup, run_workers
+from app.connections import WorkerConnections
+from app.errors import MailChimpImportError
+from app.members import MemberBuffer
+from app.throttling import AdaptiveConcurrencyLimiter
+
+class ActivityImportMixin():
+    """Imports the recent activity of a MailChimp list's subscribers.
+
+    Mixed into MailChimpList, which makes the requests and holds the
+    imported members.
+    """
+
+    # The number of simultanous connections to start with for the activity
+    # import phase
+    # This number is lower than MAX_CONNECTIONS
+    # Otherwise MailChimp will flag as too many requests
+    # (Each request takes very little time to complete)
+    MAX_ACTIVITY_CONNECTIONS = 2
+
+    # The number of subscribers whose activity is checkpointed together
+    # See ImportCheckpoint
+    ACTIVITY_CHECKPOINT_SIZE = 1000
+
+    # The number of chunks of subscribers which can wait on the queue
+    # between the member and activity imports (see import_queued_activity())
+    # The member import waits once it's full, rather than getting further
+    # and further ahead of the activity import
+    ACTIVITY_QUEUE_SIZE = 2
+
+    # The parameters of requests for a subscriber's activity
+    # Only opens are requested, since other actions are discarded anyway
+    SUB_ACTIVITY_PARAMS = (
+        ('fields', 'activity.action,activity.timestamp,email_id'),
+        ('exclude_fields', 'total_items,_links'),
+        ('action', 'open')
+    )
+
+    # The max size of a request to paginated report endpoints
+    # e.g. campaign open details
+    REPORT_CHUNK_SIZE = 1000
+
+    # The strategies for determining whether subscribers opened recently
+    # member_activity: requests each subscriber's activity individually,
+    #   i.e. one request per subscriber. Also the fallback for
+    #   campaign_reports
+    # campaign_reports: pulls the open reports of every campaign sent to the
+    #   list in the past year, i.e. roughly one request per thousand opens.
+    #   Opens of campaigns sent more than a year ago are missed, so
+    #   subscribers who only opened those count as inactive
+    # The strategy is chosen when the list is submitted, and stored with it
+    # (see EmailList)
+    ACTIVITY_STRATEGIES = ('member_activity', 'campaign_reports')
+
+    async def update_recent_activity(self, last_analyzed):
+        """Brings subscribers' recent opens up to date since the last analysis.
+
+        Imports every subscriber's opens since the previous analysis from
+        campaign reports, whatever the list's activity strategy. Requesting
+        each subscriber's activity would mean importing the whole list's
+        activity again, and only importing changed subscribers' activity
+        would miss everyone else's opens (see update_members()). If the
+        reports can't be imported, falls back to importing every
+        subscriber's activity. Then keeps each subscriber's most recent
+        open, out of their previous one and any newly imported one, if it
+        was in the past year.
+
+        Args:
+            last_analyzed: the timezone-aware datetime of the previous
+                analysis.
+        """
+        previous_opens = self.df.pop('recent_open')
+        is_subscribed = (self.df['status'] == 'subscribed').values
+        await self.import_recent_activity(
+            last_analyzed, activity_strategy='campaign_reports')
+
+        # Keep the later of the previous and new opens
+        recent_opens = pd.DataFrame({
+            'previous': MemberBuffer.parse_timestamps(previous_opens.values),
+            'new': MemberBuffer.parse_timestamps(
+                self.df['recent_open'].values)}).max(axis=1)
+
+        # Drop opens which are now older than a year, and non-subscribers'
+        one_year_ago = np.datetime64(
+            (datetime.now(timezone.utc) - timedelta(days=365)).replace(
+                tzinfo=None))
+        recent_opens[(recent_opens <= one_year_ago) | ~is_subscribed] = pd.NaT
+        self.df['recent_open'] = recent_opens.values
+
+    async def import_queued_activity(self, subscriber_queue):
+        """Requests the recent activity of subscribers as they're queued.
+
+        A single pool of workers (see run_workers()) requests every queued
+        subscriber's activity, taking chunks off the queue only as the
+        workers free up. Each request is tagged with its chunk, and a
+        chunk's activity is parsed and checkpointed as soon as its last
+        request completes. Chunks checkpointed by a previous attempt at
+        the run aren't requested again.
+
+        Args:
+            subscriber_queue: see import_list_members().
+
+        Returns:
+            A list of dictionaries of activity arrays, one per chunk, see
+                merge_recent_opens().
+        """
+        request_uri = (self.api_root +
+                       '/lists/{}/members/{}/activity'.format(self.id, '{}'))
+
+        # Limit simultaneous connections to MailChimp API
+        sem = AdaptiveConcurrencyLimiter(
+            self.MAX_ACTIVITY_CONNECTIONS, self.MAX_API_CONNECTIONS)
+
+        # Calculate timestamp for one year ago
+        one_year_ago = datetime.now(timezone.utc) - timedelta(days=365)
+
+        activities = []
+        chunk_responses = {}
+        remaining = {}
+
+        # Parse and checkpoint a chunk's subscriber activity
+        def finish_chunk(chunk_num):
+            parsed_chunk = self.parse_sub_activities(
+                chunk_responses.pop(chunk_num), one_year_ago)
+            del remaining[chunk_num]
+            self.save_checkpoint('chunk-activity-{}'.format(chunk_num),
+                                 **parsed_chunk)
+            activities.append(parsed_chunk)
+
+        # Yield each queued subscriber, tagged with its chunk
+        async def queued_subscribers():
+            while True:
+                queued_chunk = await subscriber_queue.get()
+                if queued_chunk is None:
+                    return
+                chunk_num, subscriber_ids = queued_chunk
+                saved_chunk = self.load_checkpoint(
+                    'chunk-activity-{}'.format(chunk_num))
+                if saved_chunk is not None:
+                    activities.append(saved_chunk)
+                    continue
+                chunk_responses[chunk_num] = [None] * len(subscriber_ids)
+                remaining[chunk_num] = len(subscriber_ids)
+                if not subscriber_ids:
+                    finish_chunk(chunk_num)
+                for position, subscriber_id in enumerate(subscriber_ids):
+                    yield chunk_num, position, subscriber_id
+
+        async with WorkerConnections.client_session() as session:
+
+            async def import_subscriber(request):
+                chunk_num, position, subscriber_id = request
+                chunk_responses[chunk_num][position] = (
+                    await self.make_async_requests(
+                        sem, request_uri.format(subscriber_id),
+                        self.SUB_ACTIVITY_PARAMS, session))
+                remaining[chunk_num] -= 1
+                if not remaining[chunk_num]:
+                    finish_chunk(chunk_num)
+
+            # One worker per connection the limiter can grow to
+            await run_workers(
+                'activity workers', self.MAX_API_CONNECTIONS,
+                import_subscriber, queued_subscribers())
+        return activities
+
+    async def import_sub_activity(self, subscriber_rows=None): # pylint: disable=too-many-locals
+        """Requests each subscriber's recent activity.
+
+        First, gets a list of subscribers, unless given one.
+        Then makes the requests one-by-one using aiohttp (MailChimp's API is
+        very inefficient and you cannot request multiple subscribers' activity
+        at the same time).
+        A fixed number of workers take subscribers off a queue in turn (see
+        run_workers()), so the number of pending requests doesn't grow with
+        the size of the list.
+        Subscribers are referred to by their row in the members dataframe
+        (see get_subscriber_rows()), and only their slice's ids are
+        converted to strings, to build the request urls.
+        Subscribers are split into slices of ACTIVITY_CHECKPOINT_SIZE. Each
+        slice's results are parsed together (see parse_sub_activities()) and
+        checkpointed as soon as the slice completes, with either backend, so
+        only the responses of incomplete slices are held. Slices
+        checkpointed by a previous attempt at the run aren't requested
+        again.
+        Finally, writes the results back to the subscribers' rows of the
+        members dataframe created by import_list_members().
+
+        Args:
+            subscriber_rows: an int32 array containing the rows of the
+                subscribers to request activity for. Defaults to every
+                subscriber.
+        """
+        params = self.SUB_ACTIVITY_PARAMS
+
+        request_path = '/lists/{}/members/{}/activity'.format(self.id, '{}')
+        request_uri = self.api_root + request_path
+
+        # Limit simultaneous connections to MailChimp API
+        sem = AdaptiveConcurrencyLimiter(
+            self.MAX_ACTIVITY_CONNECTIONS, self.MAX_API_CONNECTIONS)
+
+        # Get the subscribers' rows in the members dataframe
+        all_subscriber_rows = self.get_subscriber_rows()
+
+        # Store the number of subscribers for later
+        self.subscribers = len(all_subscriber_rows)
+        if subscriber_rows is None:
+            subscriber_rows = all_subscriber_rows
+        ids = self.get_column('id')
+
+        # Calculate timestamp for one year ago
+        now = datetime.now(timezone.utc)
+        one_year_ago = now - timedelta(days=365)
+
+        # Placeholder for each slice's parsed activity
+        activities = []
+
+        # Split the subscribers into slices
+        # Loading any slices imported by a previous attempt
+        pending_slices = OrderedDict()
+        for slice_num, slice_start in enumerate(range(
+                0, len(subscriber_rows), self.ACTIVITY_CHECKPOINT_SIZE)):
+            saved_slice = self.load_checkpoint('activity-{}'.format(slice_num))
+            if saved_slice is None:
+                pending_slices[slice_num] = subscriber_rows[
+                    slice_start:slice_start + self.ACTIVITY_CHECKPOINT_SIZE]
+            else:
+                activities.append(saved_slice)
+
+        # Keep track of the responses to each slice's requests
+        # Parsing, checkpointing and releasing a slice once it's complete
+        slice_responses = {slice_num: [None] * len(slice_rows)
+                           for slice_num, slice_rows in pending_slices.items()}
+        remaining = {slice_num: len(slice_rows)
+                     for slice_num, slice_rows in pending_slices.items()}
+
+        def add_response(slice_num, position, response):
+            slice_responses[slice_num][position] = response
+            remaining[slice_num] -= 1
+            if not remaining[slice_num]:
+                parsed_slice = self.parse_sub_activities(
+                    slice_responses.pop(slice_num), one_year_ago,
+                    pending_slices[slice_num])
+                self.save_checkpoint(
+                    'activity-{}'.format(slice_num), **parsed_slice)
+                activities.append(parsed_slice)
+
+        # Create a session with which to make requests
+        async with WorkerConnections.client_session() as session:
+
+            # Either submit every request as a single batch operation
+            if self.import_backend == 'batch_operations' and pending_slices:
+                operations = [
+                    self.make_batch_operation(
+                        '{}-{}'.format(slice_num, position),
+                        request_path.format(subscriber_id), params)
+                    for slice_num, slice_rows in pending_slices.items()
+                    for position, subscriber_id in enumerate(
+                        ids[slice_rows].astype(str).tolist())]
+                async for operation_id, response in self.make_batch_requests(
+                        session, operations):
+                    slice_num, position = map(int, operation_id.split('-'))
+                    add_response(slice_num, position, response)
+
+            # Or make the requests directly, with a fixed number of workers
+            elif pending_slices:
+
+                async def import_subscriber(request):
+                    slice_num, position, subscriber_id = request
+                    add_response(slice_num, position,
+                                 await self.make_async_requests(
+                                     sem, request_uri.format(subscriber_id),
+                                     params, session))
+
+                # One worker per connection the limiter can grow to
+                await run_workers(
+                    'activity workers', self.MAX_API_CONNECTIONS,
+                    import_subscriber, (
+                        (slice_num, position, subscriber_id)
+                        for slice_num, slice_rows in pending_slices.items()
+                        for position, subscriber_id in enumerate(
+                            ids[slice_rows].astype(str).tolist())))
+
+        self.merge_recent_opens(activities)
+
+    @classmethod
+    def parse_sub_activities(cls, responses, one_year_ago, rows=None):
+        """Extracts each subscriber's most recent open from their activity.
+
+        Rather than parsing and comparing each activity record's timestamp
+        one at a time, the records of every subscriber in the responses
+        are flattened into arrays of the subscriber's position, the action
+        and the timestamp, which are then filtered and reduced in a few
+        vectorized passes (see latest_opens()).
+
+        Args:
+            responses: a list of subscribers' activity, as returned by the
+                API.
+            one_year_ago: opens before this datetime are ignored.
+            rows: the subscribers' rows in the members dataframe, if known.
+
+        Returns:
+            A dictionary of activity arrays, see merge_recent_opens().
+        """
+        activity = [response['activity'] for response in responses]
+        records = [record for subscriber_activity in activity
+                   for record in subscriber_activity]
+        positions = np.repeat(
+            np.arange(len(responses), dtype=np.int32),
+            [len(subscriber_activity) for subscriber_activity in activity])
+        is_open = np.array(
+            [record['action'] for record in records], dtype=str) == 'open'
+        timestamps = MemberBuffer.parse_timestamps(
+            [record['timestamp'] for record in records])
+        return cls.latest_opens(
+            [response['email_id'] for response in responses],
+            positions[is_open], timestamps[is_open], one_year_ago, rows)
+
+    @staticmethod
+    def latest_opens(ids, positions, timestamps, since, rows=None):
+        """Reduces a flat array of opens to each subscriber's latest open.
+
+        Args:
+            ids: a list of subscriber ids.
+            positions: an array containing the position in ids of the
+                subscriber who made each open.
+            timestamps: a datetime64 array containing the time of each
+                open, in UTC.
+            since: a timezone-aware datetime. Opens before this are
+                ignored.
+            rows: the subscribers' rows in the members dataframe, if known.
+
+        Returns:
+            A dictionary of activity arrays, see merge_recent_opens().
+                Subscribers without an open are left out, so the arrays
+                only grow with the number of recently active subscribers.
+        """
+        is_recent = timestamps > np.datetime64(
+            since.astimezone(timezone.utc).replace(tzinfo=None))
+
+        # Keep the maximum timestamp at each subscriber's position
+        # NaT is the smallest datetime64, so it's replaced by any open
+        recent_opens = np.full(len(ids), np.datetime64('NaT'),
+                               dtype='datetime64[ns]')
+        np.maximum.at(recent_opens.view('i8'), positions[is_recent], # pylint: disable=no-member
+                      timestamps[is_recent].view('i8'))
+        has_open = ~np.isnat(recent_opens)
+        activity = {'ids': np.array(ids, dtype=MemberBuffer.DTYPES['id'])[
+            has_open], 'recent_opens': recent_opens[has_open]}
+        if rows is not None:
+            activity['rows'] = np.asarray(rows, dtype=np.int32)[has_open]
+        return activity
+
+    async def import_recent_activity(
+            self, since=None, subscriber_rows=None, activity_strategy=None):
+        """Imports subscribers' recent activity using the activity strategy.
+
+        If the strategy is campaign_reports but the reports can't be
+        imported, falls back to requesting each subscriber's activity
+        individually.
+
+        Args:
+            since: see import_campaign_opens().
+            subscriber_rows: see import_sub_activity().
+            activity_strategy: one of ACTIVITY_STRATEGIES. Defaults to the
+                list's activity strategy.
+        """
+        if (activity_strategy or
+                self.activity_strategy) == 'campaign_reports':
+            try:
+                await self.import_campaign_opens(since)
+                return
+            except MailChimpImportError:
+                self.logger.warning(
+                    'Unable to import campaign reports for list %s. '
+                    'Falling back to member activity.', self.id)
+        await self.import_sub_activity(subscriber_rows)
+
+    async def import_campaign_opens(self, since=None): # pylint: disable=too-many-locals
+        """Determines subscribers' recent opens from campaign reports.
+
+        First, gets a list of campaigns sent to the list in the past year.
+        Then requests the open details report for each campaign, which
+        lists every member who opened the campaign along with the
+        timestamp of each open. This needs roughly one request per
+        REPORT_CHUNK_SIZE opens, rather than one request per subscriber.
+        Each campaign's opens are checkpointed once its report completes,
+        and reports checkpointed by a previous attempt at the run aren't
+        requested again.
+        Finally, merges each subscriber's most recent open with the
+        members dataframe created by import_list_members().
+
+        Args:
+            since: a timezone-aware datetime. If given, only opens after
+                this are imported. Defaults to one year ago.
+        """
+
+        # Calculate timestamp for one year ago
+        now = datetime.now(timezone.utc)
+        one_year_ago = now - timedelta(days=365)
+        opens_since = max(since or one_year_ago, one_year_ago)
+
+        # Non-subscribers may appear in the reports, but aren't counted
+        id_dtype = self.get_column('id').dtype
+        is_subscribed = (self.get_status_codes() ==
+                         MemberBuffer.STATUS_CODES['subscribed'])
+
+        # Store the number of subscribers for later
+        self.subscribers = int(np.count_nonzero(is_subscribed))
+
+        campaigns_uri = self.api_root + '/campaigns'
+        campaigns_params = (
+            ('fields', 'campaigns.id,total_items'),
+            ('list_id', self.id),
+            ('status', 'sent'),
+            ('since_send_time', one_year_ago.isoformat()),
+        )
+
+        open_details_uri = self.api_root + '/reports/{}/open-details'
+        open_details_params = (
+            ('fields', 'members.email_id,members.opens,total_items'),
+            ('since', opens_since.isoformat()),
+        )
+
+        # Placeholder for each campaign's most recent opens
+        activities = []
+
+        # Limit simultaneous connections to MailChimp API
+        sem = AdaptiveConcurrencyLimiter(
+            self.MAX_CONNECTIONS, self.MAX_API_CONNECTIONS)
+
+        async with WorkerConnections.client_session() as session:
+            campaigns = await self.make_paginated_requests(
+                sem, campaigns_uri, campaigns_params, session, 'campaigns')
+
+            # Request every page of a campaign's open details report
+            async def import_open_details(campaign_id):
+                members = await self.make_paginated_requests(
+                    sem, open_details_uri.format(campaign_id),
+                    open_details_params, session, 'members')
+                return campaign_id, members
+
+            # Load any reports imported by a previous attempt
+            # Otherwise request the campaign's open details
+            # If a report fails, the others are cancelled
+            async with TaskGroup('campaign reports') as reports:
+                for campaign in campaigns:
+                    saved_opens = self.load_checkpoint(
+                        'opens-{}'.format(campaign['id']))
+                    if saved_opens is None:
+                        reports.spawn(import_open_details(campaign['id']))
+                    else:
+                        activities.append(saved_opens)
+
+                # Keep each subscriber's most recent open in the campaign
+                # Filtering out opens older than one year
+                # The latest open across campaigns is kept when merging
+                for next_report in reports.as_completed():
+                    campaign_id, members = await next_report
+                    rows = self.find_rows(np.array(
+                        [member['email_id'] for member in members]).astype(
+                            id_dtype))
+                    # -1, i.e. not a member, picks the appended False
+                    is_counted = np.append(is_subscribed, False)[rows]
+                    members = list(compress(members, is_counted))
+                    campaign_opens = self.latest_opens(
+                        [member['email_id'] for member in members],
+                        np.repeat(np.arange(len(members), dtype=np.int32),
+                                  [len(member['opens']) for member in members]),
+                        MemberBuffer.parse_timestamps(
+                            [member_open['timestamp'] for member in members
+                             for member_open in member['opens']]),
+                        one_year_ago, rows[is_counted])
+                    self.save_checkpoint(
+                        'opens-{}'.format(campaign_id), **campaign_opens)
+                    activities.append(campaign_opens)
+
+        self.merge_recent_opens(activities)
+
+    async def make_paginated_requests( # pylint: disable=too-many-arguments
+            self, sem, url, params, session, items_key, page_size=None):
+        """Requests every page of a paginated MailChimp endpoint.
+
+        The first page tells us the total number of items, after which
+        the remaining pages are requested concurrently.
+
+        Args:
+            sem: see make_async_requests().
+            url: see make_async_request().
+            params: see make_async_request(). Should request the total_items
+                field as well as the items themselves.
+            session: see make_async_request().
+            items_key: the key of the list of items in each response,
+                e.g. 'members'.
+            page_size: the number of items per page. Defaults to
+                REPORT_CHUNK_SIZE.
+
+        Returns:
+            A list containing the items from every page.
+        """
+        page_size = page_size or self.REPORT_CHUNK_SIZE
+
+        def page_params(offset):
+            return (*params,
+                    ('count', str(page_size)),
+                    ('offset', str(offset)))
+
+        first_page = await self.make_async_requests(
+            sem, url, page_params(0), session)
+        items = first_page[items_key]
+
+        async with TaskGroup('pages') as pages:
+            for offset in range(page_size, first_page['total_items'],
+                                page_size):
+                pages.spawn(self.make_async_requests(
+                    sem, url, page_params(offset), session))
+            for page in await pages.gather():
+                items.extend(page[items_key])
+
+        return items
+
+    def merge_recent_opens(self, activities):
+        """Merges subscribers' most recent opens into the members dataframe.
+
+        Rather than merging dataframes on the subscribers' string ids, each
+        subscriber's open is written straight to their row of a datetime64
+        column. Activity which knows its subscribers' rows is written back
+        positionally, as long as the rows still hold those subscribers.
+        Otherwise, e.g. for activity checkpointed by an attempt at the run
+        whose list has since changed, subscribers are looked up by id (see
+        find_rows()). Subscribers who appear more than once, e.g. in
+        several campaign reports, keep their latest open, and subscribers
+        who aren't in the list are ignored. Out of core, the column is
+        added to the spill.
+
+        Args:
+            activities: a list of dictionaries of activity arrays, each
+                containing an array of subscriber ids ('ids'), an array of
+                the time of each subscriber's most recent open in the past
+                year ('recent_opens', NaT where there wasn't one) and,
+                optionally, an int32 array of the subscribers' rows
+                ('rows').
+        """
+        ids = self.get_column('id')
+        if self.spill is not None:
+            recent_opens = self.spill.add_column(
+                'recent_open', 'datetime64[ns]', np.datetime64('NaT'))
+        else:
+            recent_opens = np.full(len(ids), np.datetime64('NaT'),
+                                   dtype='datetime64[ns]')
+
+        def keep_latest(rows, timestamps):
+            is_merged = (rows != -1) & ~np.isnat(timestamps)
+            np.maximum.at(recent_opens.view('i8'), rows[is_merged], # pylint: disable=no-member
+                          timestamps[is_merged].view('i8'))
+
+        # Write back the activity whose rows are known
+        # Collecting the rest, to be looked up together
+        unknown_ids = []
+        unknown_timestamps = []
+        for activity in activities:
+            activity_ids = activity['ids']
+            timestamps = activity['recent_opens']
+            rows = activity.get('rows')
+            if (rows is None or np.any(rows >= len(ids)) or
+                    not np.array_equal(ids[rows], activity_ids)):
+                unknown_ids.append(activity_ids)
+                unknown_timestamps.append(timestamps)
+            else:
+                keep_latest(rows, timestamps)
+        if unknown_ids:
+            keep_latest(self.find_rows(np.concatenate(unknown_ids)),
+                        np.concatenate(unknown_timestamps))
+
+        # This allows us to assume that a 'recent open' column exists
+        if self.spill is not None:
+            recent_opens.flush()
+        else:
+            self.df['recent_open'] = recent_opens
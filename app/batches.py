@@ -0,0 +1,137 @@
+"""This module handles requests made as MailChimp batch operations."""
+import asyncio
+import tarfile
+import tempfile
+from collections import OrderedDict
+from app.decoding import loads
+from app.errors import MailChimpImportError
+
+class BatchOperationsMixin():
+    """Makes requests to the MailChimp API as batch operations.
+
+    Mixed into MailChimpList, which makes the requests to submit and poll
+    each batch.
+    """
+
+    # The number of seconds to wait between checks on a batch operation
+    BATCH_POLL_INTERVAL = 30
+
+    # The max number of seconds to wait for a batch operation to finish
+    MAX_BATCH_WAIT = 6 * 60 * 60
+
+    # The size in bytes of each chunk when downloading batch results
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+    @staticmethod
+    def make_batch_operation(operation_id, path, params):
+        """Describes a GET request as an operation in a batch.
+
+        Args:
+            operation_id: a unique identifier for the operation, which is
+                returned alongside its results.
+            path: the path of the request, relative to the API root.
+            params: see make_async_request().
+
+        Returns:
+            A dictionary in the format expected by the batches endpoint.
+        """
+        return {'method': 'GET',
+                'path': path,
+                'params': dict(params),
+                'operation_id': operation_id}
+
+    async def make_batch_requests(self, session, operations):
+        """Makes a number of requests as a single MailChimp batch operation.
+
+        An alternative to make_async_requests() for large numbers of
+        requests. Submits the requests to the batches endpoint, then polls
+        the batch until MailChimp has finished running it. The results are
+        streamed to a temporary file as a gzipped tar archive, and each
+        result is parsed as it's read from the archive.
+
+        Args:
+            session: see make_async_request().
+            operations: a list of operations, see make_batch_operation().
+
+        Yields:
+            A tuple containing each operation's id and a dictionary
+                containing its results.
+
+        Throws:
+            MailChimpImportError: the batch didn't finish in time, its
+                results couldn't be downloaded, or one of the operations
+                failed.
+        """
+        batches_uri = self.api_root + '/batches'
+        batch = loads(await self.make_async_request(
+            batches_uri, None, session, json_body={'operations': operations}))
+        self.logger.info('Submitted batch %s (%s operations) for list %s.',
+                         batch['id'], len(operations), self.id)
+
+        # Wait for MailChimp to finish running the batch
+        batch_uri = '{}/{}'.format(batches_uri, batch['id'])
+        batch_params = (
+            ('fields', 'id,status,finished_operations,'
+                       'errored_operations,response_body_url'),
+        )
+        seconds_waited = 0
+        while batch['status'] != 'finished':
+            if seconds_waited >= self.MAX_BATCH_WAIT:
+                error_details = OrderedDict([
+                    ('err_desc', 'MailChimp took too long to process '
+                                 'your data.'),
+                    ('mailchimp_url', batch_uri),
+                    ('api_key', self.api_key)])
+                self.logger.error('Batch %s timed out. List: %s.',
+                                  batch['id'], self.id)
+                raise MailChimpImportError(
+                    'MailChimp batch operation timed out', error_details)
+            await asyncio.sleep(self.BATCH_POLL_INTERVAL)
+            seconds_waited += self.BATCH_POLL_INTERVAL
+            batch = loads(await self.make_async_request(
+                batch_uri, batch_params, session))
+
+        self.logger.info('Batch %s finished. List: %s.', batch['id'], self.id)
+
+        with tempfile.TemporaryFile() as archive:
+            await self.download_batch_results(
+                batch['response_body_url'], session, archive)
+            archive.seek(0)
+
+            # Read the archive as a stream, one results file at a time
+            with tarfile.open(fileobj=archive, mode='r|gz') as tar:
+                for tar_member in tar:
+                    if not tar_member.isfile():
+                        continue
+                    results = loads(tar.extractfile(tar_member).read())
+                    for result in results:
+                        if result['status_code'] != 200:
+                            self.logger.error(
+                                'Batch operation %s failed. Batch: %s.',
+                                result['operation_id'], batch['id'])
+                            raise MailChimpImportError.from_response(
+                                batch_uri, self.api_key,
+                                result['status_code'], result['response'])
+                        yield (result['operation_id'],
+                               loads(result['response']))
+
+    async def download_batch_results(self, url, session, archive):
+        """Downloads the results of a batch operation chunk by chunk.
+
+        Args:
+            url: the url of the batch's results.
+            session: see make_async_request().
+            archive: a binary file to write the results to.
+
+        Throws:
+            MailChimpImportError: the results couldn't be downloaded.
+        """
+        async with session.get(url, proxy=self.proxy) as response:
+            if response.status != 200:
+                self.logger.error('Unable to download batch results. '
+                                  'URL: %s.', url)
+                raise MailChimpImportError.from_response(
+                    url, self.api_key, response.status, response.reason)
+            async for data in response.content.iter_chunked(
+                    self.DOWNLOAD_CHUNK_SIZE):
+                archive.write(data)
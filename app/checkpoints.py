@@ -0,0 +1,128 @@
+"""This module contains on-disk checkpoints for resuming list imports."""
+import os
+import glob
+import time
+import shutil
+import tempfile
+import numpy as np
+
+class ImportCheckpoint():
+    """Saves the completed parts of a list import to local disk.
+
+    Each part, e.g. a chunk of members, is saved as an uncompressed numpy
+    archive in a directory for the list and the import run. If the run
+    fails part of the way through and is then retried under the same run
+    id (e.g. a retried Celery task), the parts which were already imported
+    are loaded back from disk instead of being requested again.
+    """
+
+    # Checkpoints for runs which weren't touched in this many seconds
+    # Are assumed to be abandoned, and are removed
+    # They hold member data, so this is also how long it can outlive a run
+    MAX_AGE = 7 * 24 * 60 * 60
+
+    def __init__(self, list_id, run_id, directory=None):
+        """Initializes the checkpoint.
+
+        Args:
+            list_id: the list's unique MailChimp id.
+            run_id: a unique id for the import run, e.g. the Celery
+                task id.
+            directory: the directory to keep checkpoints in. Defaults to
+                the CHECKPOINT_DIR environment variable, or a folder in
+                the system's temporary directory.
+
+        Other class variables:
+            directory: the directory containing every list's runs.
+            list_dir: the directory containing the list's runs.
+            run_dir: the directory containing the run's parts.
+        """
+        self.directory = self.get_directory(directory)
+        self.list_dir = os.path.join(self.directory, str(list_id))
+        self.run_dir = os.path.join(self.list_dir, str(run_id))
+        self.remove_abandoned_runs()
+        os.makedirs(self.run_dir, exist_ok=True)
+
+    @staticmethod
+    def get_directory(directory=None):
+        """Returns the directory checkpoints are kept in.
+
+        Args:
+            directory: see __init__().
+        """
+        return (directory or os.environ.get('CHECKPOINT_DIR') or
+                os.path.join(tempfile.gettempdir(), 'benchmarks-checkpoints'))
+
+    @classmethod
+    def has_parts(cls, list_id, run_id, directory=None):
+        """Checks whether a run saved any parts, e.g. before it failed.
+
+        Checkpoints are only found on the machine which saved them, unless
+        the directory is shared, so a retry on another machine starts over.
+
+        Args:
+            list_id: see __init__().
+            run_id: see __init__().
+            directory: see __init__().
+        """
+        return bool(glob.glob(os.path.join(
+            cls.get_directory(directory), str(list_id), str(run_id),
+            '*.npz')))
+
+    def get_path(self, name):
+        """Returns the path of the archive for a part of the import."""
+        return os.path.join(self.run_dir, '{}.npz'.format(name))
+
+    def save(self, name, **arrays):
+        """Saves a part of the import.
+
+        The archive is written to a temporary file which is then renamed,
+        so a run which dies part of the way through a save doesn't leave
+        behind a corrupt archive.
+
+        Args:
+            name: the name of the part, e.g. 'members-0'.
+            arrays: the numpy arrays making up the part, by name.
+        """
+        with tempfile.NamedTemporaryFile(
+                dir=self.run_dir, suffix='.tmp', delete=False) as tmp_file:
+            np.savez(tmp_file, **arrays)
+        os.replace(tmp_file.name, self.get_path(name))
+
+    def load(self, name):
+        """Loads a part of the import.
+
+        Args:
+            name: see save().
+
+        Returns:
+            A dictionary containing the part's numpy arrays, by name, or
+                None if the part hasn't been saved.
+        """
+        try:
+            with np.load(self.get_path(name)) as archive:
+                return {key: archive[key] for key in archive.files}
+        except FileNotFoundError:
+            return None
+
+    def clear(self):
+        """Removes the run's checkpoints, e.g. once the import succeeds."""
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def remove_abandoned_runs(self):
+        """Removes the checkpoints of every list's abandoned runs.
+
+        Every list's runs are checked, not just this list's, so a failed
+        run's checkpoints are removed even if its list is never imported
+        again.
+        """
+        oldest_mtime = time.time() - self.MAX_AGE
+        for run_dir in glob.glob(os.path.join(self.directory, '*', '*')):
+
+            # Another worker may be removing the same run
+            try:
+                is_abandoned = os.path.getmtime(run_dir) < oldest_mtime
+            except FileNotFoundError:
+                continue
+            if is_abandoned:
+                shutil.rmtree(run_dir, ignore_errors=True)
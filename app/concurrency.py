@@ -0,0 +1,149 @@
+"""This module contains a structured way of running concurrent requests."""
+import asyncio
+from celery.utils.log import get_task_logger
+
+class TaskGroup():
+    """An async context manager for a group of tasks which fail together.
+
+    asyncio.gather() and asyncio.as_completed() raise the first error as
+    soon as it occurs, but leave the other tasks running, so they keep
+    making (and retrying) requests whose results will be thrown away.
+    Instead, as soon as one of the group's tasks fails, or the block
+    raises an exception, the group cancels the rest of its tasks and waits
+    for them to stop before the exception propagates.
+
+    If the exception has error details, e.g. a MailChimpImportError, the
+    group adds how many of its tasks had completed. Completed tasks are
+    usually checkpointed, so this is roughly what a retry can skip.
+    """
+
+    def __init__(self, description):
+        """Initializes the group.
+
+        Args:
+            description: what the tasks are, e.g. 'member chunks'. Used
+                in logs and error details.
+
+        Other class variables:
+            tasks: the tasks started in the group.
+            completed: the number of tasks which completed successfully.
+            failure: the first exception raised by one of the tasks.
+        """
+        self.description = description
+        self.logger = get_task_logger(__name__)
+        self.tasks = []
+        self.completed = 0
+        self.failure = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            return
+
+        # Wait for the cancelled tasks to stop
+        self.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        cancelled = sum(task.cancelled() for task in self.tasks)
+        if cancelled:
+            self.logger.warning(
+                'Cancelled %s of %s %s after an error (%s of %s completed).',
+                cancelled, len(self.tasks), self.description,
+                self.completed, len(self.tasks))
+
+        # Awaiting a task cancelled by the group raises a CancelledError
+        # But the error worth reporting is the one which caused it
+        error = self.failure or exc
+        error_details = getattr(error, 'error_details', None)
+        if isinstance(error_details, dict):
+            error_details['{}_completed'.format(
+                self.description.replace(' ', '_'))] = '{} of {}'.format(
+                    self.completed, len(self.tasks))
+        if error is not exc:
+            raise error
+
+    def spawn(self, coroutine):
+        """Starts running a coroutine as one of the group's tasks.
+
+        Returns:
+            The task.
+        """
+        task = asyncio.ensure_future(coroutine)
+        task.add_done_callback(self.task_done)
+        self.tasks.append(task)
+        return task
+
+    def task_done(self, task):
+        """Keeps count of completed tasks, and cancels the rest if one
+        fails."""
+        if task.cancelled():
+            return
+        if task.exception() is None:
+            self.completed += 1
+        elif self.failure is None:
+            self.failure = task.exception()
+            self.cancel()
+
+    def cancel(self):
+        """Cancels the group's unfinished tasks."""
+        for task in self.tasks:
+            if not task.done():
+                task.cancel()
+
+    def as_completed(self):
+        """Returns the group's tasks in the order they complete.
+
+        See asyncio.as_completed().
+        """
+        return asyncio.as_completed(self.tasks)
+
+    async def gather(self):
+        """Waits for the group's tasks.
+
+        Returns:
+            A list of the tasks' results, in the order they were started.
+        """
+        return await asyncio.gather(*self.tasks)
+
+async def run_workers(description, num_workers, handle, items):
+    """Handles a stream of items with a fixed number of workers.
+
+    Rather than starting a task per item up front, starts num_workers
+    tasks which take items off a bounded queue one at a time. So the
+    number of coroutines, futures and queued items stays the same no
+    matter how many items there are. The workers run in a TaskGroup, so
+    if one fails the rest are cancelled.
+
+    Args:
+        description: what the workers are, see TaskGroup.
+        num_workers: the number of workers.
+        handle: a coroutine function which handles an item.
+        items: an iterable or async iterable of items. Consumed lazily, as
+            workers free up.
+    """
+    queue = asyncio.Queue(maxsize=num_workers)
+    done = object()
+
+    async def queue_items():
+        if hasattr(items, '__aiter__'):
+            async for item in items:
+                await queue.put(item)
+        else:
+            for item in items:
+                await queue.put(item)
+        for _ in range(num_workers):
+            await queue.put(done)
+
+    async def work():
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            await handle(item)
+
+    async with TaskGroup(description) as workers:
+        workers.spawn(queue_items())
+        for _ in range(num_workers):
+            workers.spawn(work())
+        await workers.gather()
@@ -0,0 +1,107 @@
+"""This module contains the connections shared by a worker's imports."""
+import asyncio
+from aiohttp import ClientSession, TCPConnector
+from celery.signals import worker_process_init, worker_process_shutdown
+
+class WorkerConnections():
+    """An event loop and HTTP session which last as long as the worker.
+
+    Each Celery worker process opens them when it starts (see
+    open_worker_connections()). Imports then run on the same event loop and
+    share a keep-alive session, so they reuse warm connections and cached
+    DNS lookups instead of opening new ones for each phase of each import.
+    Outside of a worker process, e.g. in tests, each import gets its own
+    session.
+    """
+
+    # The max number of connections the session keeps open
+    MAX_CONNECTIONS = 100
+
+    # The max number of connections to a single host, e.g. a MailChimp
+    # data center. Matches the number of connections allowed per API key
+    # (see MailChimpList.MAX_API_CONNECTIONS)
+    MAX_CONNECTIONS_PER_HOST = 10
+
+    # The number of seconds to cache DNS lookups for
+    DNS_CACHE_TTL = 300
+
+    # The number of seconds to keep idle connections alive for
+    KEEPALIVE_TIMEOUT = 60
+
+    # The worker's event loop and session, if it has opened them
+    loop = None
+    session = None
+
+    @classmethod
+    def open(cls):
+        """Opens the worker's event loop and session.
+
+        A process forked from another process which used its event loop
+        would inherit that loop, so a new one is always created.
+        """
+        cls.close()
+        cls.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(cls.loop)
+        cls.session = cls.loop.run_until_complete(cls.create_session())
+
+    @classmethod
+    async def create_session(cls):
+        """Creates a keep-alive session. Must be called on the event loop."""
+        return ClientSession(connector=TCPConnector(
+            limit=cls.MAX_CONNECTIONS,
+            limit_per_host=cls.MAX_CONNECTIONS_PER_HOST,
+            use_dns_cache=True,
+            ttl_dns_cache=cls.DNS_CACHE_TTL,
+            keepalive_timeout=cls.KEEPALIVE_TIMEOUT))
+
+    @classmethod
+    def close(cls):
+        """Closes the worker's session and event loop, if they're open."""
+        if cls.session is not None:
+            cls.loop.run_until_complete(cls.session.close())
+            cls.session = None
+        if cls.loop is not None:
+            cls.loop.close()
+            cls.loop = None
+
+    @classmethod
+    def client_session(cls):
+        """Returns an async context manager which provides a session.
+
+        Provides the worker's shared session if it's open, and if the
+        caller is running on the worker's event loop. Otherwise provides
+        a new session, which is closed on exit.
+        """
+        return ClientSessionContext(
+            cls.session if cls.loop is asyncio.get_event_loop() else None)
+
+class ClientSessionContext():
+    """An async context manager providing a shared or a new session."""
+
+    def __init__(self, shared_session):
+        """Initializes the context manager.
+
+        Args:
+            shared_session: the session to provide, or None to provide a
+                new session.
+        """
+        self.shared_session = shared_session
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = self.shared_session or ClientSession()
+        return self.session
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if self.session is not self.shared_session:
+            await self.session.close()
+
+@worker_process_init.connect
+def open_worker_connections(**kwargs): # pylint: disable=unused-argument
+    """Opens a Celery worker process's connections when it starts."""
+    WorkerConnections.open()
+
+@worker_process_shutdown.connect
+def close_worker_connections(**kwargs): # pylint: disable=unused-argument
+    """Closes a Celery worker process's connections when it shuts down."""
+    WorkerConnections.close()
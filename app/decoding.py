@@ -0,0 +1,18 @@
+"""This module contains the JSON decoder used for MailChimp responses.
+
+Responses are decoded straight from the bytes read off the wire, rather
+than first being decoded to a str, using the fastest JSON library which
+is installed. orjson and ujson are optional: without either of them,
+the standard library's json module is used.
+"""
+# pylint: disable=import-error, unused-import, ungrouped-imports
+try:
+    from orjson import loads
+    BACKEND = 'orjson'
+except ImportError:
+    try:
+        from ujson import loads
+        BACKEND = 'ujson'
+    except ImportError:
+        from json import loads
+        BACKEND = 'json'
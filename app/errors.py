@@ -0,0 +1,28 @@
+"""This module contains the errors raised by list imports."""
+from collections import OrderedDict
+
+class MailChimpImportError(ConnectionError):
+    """A custom exception raised when async imports fail."""
+    def __init__(self, message, error_details):
+        super().__init__(message)
+        self.error_details = error_details
+
+    @classmethod
+    def from_response(cls, url, api_key, status, reason):
+        """Creates the error raised when MailChimp returns a bad status code.
+
+        Args:
+            url: the url of the request.
+            api_key: the api key the request was made with.
+            status: the HTTP status code returned.
+            reason: the reason MailChimp gave for the status code.
+        """
+        error_details = OrderedDict([
+            ('err_desc', 'An error occurred when '
+                         'trying to import your data '
+                         'from MailChimp.'),
+            ('mailchimp_err_code', status),
+            ('mailchimp_url', url),
+            ('api_key', api_key),
+            ('mailchimp_err_reason', reason)])
+        return cls('Invalid response code from MailChimp', error_details)
@@ -82,6 +82,12 @@ class ApiKeyForm(FlaskForm):
                                     'for benchmarking')
     monthly_updates = BooleanField('I would like to receive monthly'
                                    'benchmarking updates')
+    activity_strategy = SelectField(
+        'Recent Activity',
+        choices=[('member_activity', 'Request each subscriber\'s activity'),
+                 ('campaign_reports', 'Use campaign open reports (faster '
+                                      'for large lists)')],
+        default='member_activity')
     submit = SubmitField('Submit')
 
     def validate(self):
@@ -131,5 +137,6 @@ class ApiKeyForm(FlaskForm):
         session['num_lists'] = response.json().get('total_items')
         session['store_aggregates'] = self.store_aggregates.data
         session['monthly_updates'] = self.monthly_updates.data
+        session['activity_strategy'] = self.activity_strategy.data
 
         return True
@@ -1,23 +1,30 @@
 """This module handles the data science operations on email lists."""
 import io
 import os
-import json
 import asyncio
 from collections import OrderedDict
-from datetime import datetime, timedelta, timezone
-from billiard import current_process # pylint: disable=no-name-in-module
-import requests
-from requests.exceptions import ConnectionError as ConnError
 import pandas as pd
-from pandas.io.json import json_normalize
 import numpy as np
-from aiohttp import ClientSession, BasicAuth
-import iso8601
+from aiohttp import BasicAuth
 from celery.utils.log import get_task_logger
+from app.activity import ActivityImportMixin
+from app.batches import BatchOperationsMixin
+from app.checkpoints import ImportCheckpoint
+from app.concurrency import TaskGroup
+from app.decoding import loads
+from app.errors import MailChimpImportError
+from app.members import MemberBuffer, MemberImportMixin
+from app.proxies import ProxyPool
+from app.snapshots import SnapshotStore
+from app.stats import ListStatsMixin
+from app.throttling import ApiKeyConnectionSlots, RetryPolicy
 
 def do_async_import(coroutine):
     """Generic wrapper function to run async imports.
 
+    Runs the coroutine on the current event loop. In a Celery worker, this
+    is the worker's persistent loop (see WorkerConnections).
+
     Args:
         coroutine: the coroutine to be run asynchronously
     """
@@ -25,29 +32,42 @@ def do_async_import(coroutine):
     future = asyncio.ensure_future(coroutine)
     loop.run_until_complete(future)
 
-class MailChimpImportError(ConnectionError):
-    """A custom exception raised when async imports fail."""
-    def __init__(self, message, error_details):
-        super().__init__(message)
-        self.error_details = error_details
-
-class MailChimpList(): # pylint: disable=too-many-instance-attributes
-    """A class representing a MailChimp list."""
+class MailChimpList( # pylint: disable=too-many-instance-attributes
+        MemberImportMixin, ActivityImportMixin, BatchOperationsMixin,
+        ListStatsMixin):
+    """A class representing a MailChimp list.
 
-    # The max size of a request to the MailChimp API
-    # This is for direct requests to the members endpoint
-    CHUNK_SIZE = 5000
+    Importing the list's members and their activity, making requests as
+    batch operations and calculating the list's stats are mixed in from
+    their own modules.
+    """
 
-    # The number of simultaneous connections we'll make to the API
-    # The API limit is 10
-    # But we want to make sure we don't interrupt other tasks
+    # The number of simultaneous connections we'll start with
+    # This adapts as responses come in (see AdaptiveConcurrencyLimiter)
+    # Connections are also shared with other tasks using the same API key
+    # (see ApiKeyConnectionSlots)
     MAX_CONNECTIONS = 4
 
-    # The number of simultanous connections for the activity import phase
-    # This number is lower than MAX_CONNECTIONS
-    # Otherwise MailChimp will flag as too many requests
-    # (Each request takes very little time to complete)
-    MAX_ACTIVITY_CONNECTIONS = 2
+    # The API limit on simultaneous connections per API key
+    # Neither a single import nor all imports using a key go above this
+    MAX_API_CONNECTIONS = 10
+
+    # The headers sent with every request to the MailChimp API
+    # Responses are gzipped, and aiohttp inflates them as they stream in
+    REQUEST_HEADERS = {'Accept-Encoding': 'gzip'}
+
+    # The number of members to export at a time
+    # When exporting a list to CSV from its snapshot
+    CSV_CHUNK_SIZE = 50000
+
+    # The backends used to import members and member activity
+    # async_requests: makes the requests directly, a few at a time
+    # batch_operations: submits the requests as a MailChimp batch operation,
+    #   which MailChimp runs server-side, then downloads the results
+    IMPORT_BACKENDS = ('async_requests', 'batch_operations')
+
+    # The root of the MailChimp API, formatted with the list's data center
+    API_ROOT = 'https://{}.api.mailchimp.com/3.0'
 
     # The http status codes we'd like to retry in case of a connection issue
     HTTP_STATUS_CODES_TO_RETRY = [429, 504]
@@ -55,13 +75,27 @@ class MailChimpList(): # pylint: disable=too-many-instance-attributes
     # The number of times to retry an http request in case of a timeout
     MAX_RETRIES = 3
 
-    # The base backoff time in seconds
-    BACKOFF_INTERVAL = 5
+    # The min and max backoff times in seconds
+    # Longer backoffs only happen if MailChimp asks for them (Retry-After)
+    BACKOFF_INTERVAL = 1
+    MAX_BACKOFF_INTERVAL = 30
+
+    # The number of retries shared by all of an import's requests
+    # Each request adds RETRY_RATIO retries, so large imports get more
+    RETRY_BUDGET = 100
+    RETRY_RATIO = 0.1
+
+    # The columns used in calculations
+    COLUMNS = (*MemberBuffer.COLUMNS, 'recent_open')
 
-    # The approximate amount of seconds it takes to cold boot a proxy
-    PROXY_BOOT_TIME = 30
+    # Lists with at least this many members are analyzed out of core
+    # I.e. members are spilled to disk rather than held in memory
+    # Overridden by the OUT_OF_CORE_MIN_COUNT environment variable
+    OUT_OF_CORE_MIN_COUNT = 1000000
 
-    def __init__(self, id, count, api_key, data_center): # pylint: disable=redefined-builtin
+    def __init__(self, id, count, api_key, data_center, # pylint: disable=redefined-builtin, too-many-arguments
+                 activity_strategy=None, import_backend=None, run_id=None,
+                 out_of_core=None):
         """Initializes a MailCimp list.
 
         Args:
@@ -71,10 +105,34 @@ class MailChimpList(): # pylint: disable=too-many-instance-attributes
             api_key: a MailChimp api key associated with the list.
             data_center: the data center where the list is stored,
                 e.g. 'us2'. Used in MailChimp api calls.
+            activity_strategy: one of ACTIVITY_STRATEGIES. Determines how
+                subscribers' recent activity is imported. Defaults to
+                the first of ACTIVITY_STRATEGIES.
+            import_backend: one of IMPORT_BACKENDS. Determines how members
+                and member activity are requested. Defaults to the first
+                of IMPORT_BACKENDS.
+            run_id: a unique id for the import run, e.g. the Celery task
+                id. If given, completed parts of the import are
+                checkpointed to disk, and a later run with the same id
+                resumes from them.
+            out_of_core: whether to spill the list's members to disk as
+                they're imported, rather than holding them in memory (see
+                ColumnSpill). Defaults to whether the list has at least
+                OUT_OF_CORE_MIN_COUNT members.
 
         Other class variables:
+            api_root: the root of the MailChimp API for the list's data
+                center.
+            connection_slots: the API key's connection slots, which are
+                shared by every worker on the machine.
+            retry_policy: decides when to retry failed requests.
+            checkpoint: the ImportCheckpoint for the run, if it has an id.
+            proxy_pool: the ProxyPool the list's proxy comes from.
             proxy: the proxy to use for making MailChimp API requests.
-            df: the pandas dataframe to perform calculations on.
+            spill: the ColumnSpill holding the list's members, once they've
+                been imported out of core. Used in place of the df.
+            df: the pandas dataframe to perform calculations on. Either
+                imported, or loaded from a snapshot by use_snapshot().
             frequency: how often a campaign is sent on average.
             subscribers: the number of active subscribers.
             open_rate: the list's open rate.
@@ -95,9 +153,33 @@ class MailChimpList(): # pylint: disable=too-many-instance-attributes
         self.count = int(count)
         self.api_key = api_key
         self.data_center = data_center
+        self.activity_strategy = (activity_strategy or
+                                  self.ACTIVITY_STRATEGIES[0])
+        self.import_backend = import_backend or self.IMPORT_BACKENDS[0]
+        self.out_of_core = (self.is_out_of_core_size(self.count)
+                            if out_of_core is None else out_of_core)
         self.logger = get_task_logger(__name__)
 
+        if self.activity_strategy not in self.ACTIVITY_STRATEGIES:
+            raise ValueError('Unknown activity strategy: {}'.format(
+                self.activity_strategy))
+        if self.import_backend not in self.IMPORT_BACKENDS:
+            raise ValueError('Unknown import backend: {}'.format(
+                self.import_backend))
+
+        self.api_root = self.API_ROOT.format(data_center)
+        self.connection_slots = ApiKeyConnectionSlots(
+            api_key, self.MAX_API_CONNECTIONS)
+        self.retry_policy = RetryPolicy(
+            self.HTTP_STATUS_CODES_TO_RETRY, self.MAX_RETRIES,
+            self.BACKOFF_INTERVAL, self.MAX_BACKOFF_INTERVAL,
+            self.RETRY_BUDGET, self.RETRY_RATIO)
+        self.checkpoint = (ImportCheckpoint(id, run_id)
+                           if run_id is not None else None)
+
+        self.proxy_pool = None
         self.proxy = None
+        self.spill = None
         self.df = None # pylint: disable=invalid-name
         self.frequency = None
         self.subscribers = None
@@ -110,12 +192,20 @@ class MailChimpList(): # pylint: disable=too-many-instance-attributes
         self.high_open_rt_pct = None
         self.cur_yr_inactive_pct = None
 
+    @classmethod
+    def is_out_of_core_size(cls, count):
+        """Checks whether a list is large enough to be analyzed out of core.
+
+        Args:
+            count: the number of members in the list.
+        """
+        return count >= int(os.environ.get('OUT_OF_CORE_MIN_COUNT') or
+                            cls.OUT_OF_CORE_MIN_COUNT)
+
     async def enable_proxy(self):
         """Enables a proxy server.
 
-        Requests are proxied through US Proxies to prevent MailChimp
-        blocks. This is an accepted technique among integrators and
-        does not violate MailChimp's Terms of Service.
+        Takes a ready proxy from the worker's pool (see ProxyPool).
         """
 
         # Don't use a proxy if environment variable is set, e.g. in development
@@ -124,187 +214,213 @@ class MailChimpList(): # pylint: disable=too-many-instance-attributes
                 'NO_PROXY environment variable set. Not using a proxy.')
             return
 
-        # Get the worker number for this Celery worker
-        # We want each worker to control its corresponding proxy process
-        # Note that workers are zero-indexed, proxy procceses are not
-        process = current_process()
-
-        # Fall back to proxy #1 if we can't ascertain the worker index
-        # e.g. anyone hacking with this app on windows
-        try:
-            proxy_process_number = str(process.index + 1)
-        except AttributeError:
-            proxy_process_number = '1'
-
-        # Use the US Proxies API to get the proxy info
-        proxy_request_uri = 'http://us-proxies.com/api.php'
-        proxy_params = (
-            ('api', ''),
-            ('uid', '9557'),
-            ('pwd', os.environ.get('PROXY_AUTH_PWD')),
-            ('cmd', 'rotate'),
-            ('process', proxy_process_number),
-        )
-
-        try:
-            proxy_response = requests.get(proxy_request_uri,
-                                          params=proxy_params)
-            proxy_response_vars = proxy_response.text.split(':')
-
-            # Set the proxy for requests from this worker
-            # Keep as None (i.e, use the server's IP)
-            # Only if we have an issue with the proxy provider
-            if proxy_response_vars[0] != 'ERROR':
-                self.proxy = ('http://{}:{}'.format(
-                    proxy_response_vars[1], proxy_response_vars[2]))
-
-        # If proxy provider is unreachable, don't use a proxy
-        except ConnError:
-            proxy_response_vars = None
-
-        # Allow some time for the proxy server to boot up
-        # We don't need to wait if we're not using a proxy
+        # Keep as None (i.e, use the server's IP)
+        # Only if we have an issue with the proxy provider
+        self.proxy_pool = ProxyPool.get_pool()
+        self.proxy = await self.proxy_pool.get()
         if self.proxy:
             self.logger.info('Using proxy: %s', self.proxy)
-            await asyncio.sleep(self.PROXY_BOOT_TIME)
         else:
             self.logger.warning('Not using a proxy. Reason: %s.',
-                                proxy_response_vars[2] if
-                                proxy_response_vars else
-                                'ConnectionError: proxy provider down.')
+                                self.proxy_pool.error)
+
+    async def rotate_proxy(self, failed_proxy):
+        """Switches to another proxy after a request through one failed.
+
+        Args:
+            failed_proxy: the proxy the request was made through.
+        """
+        if self.proxy_pool is None or failed_proxy is None:
+            return
+        self.proxy_pool.report_failure(failed_proxy)
 
-    async def make_async_request(self, url, params, session, retry=0):
+        # Concurrent requests may already have switched proxies
+        if self.proxy == failed_proxy:
+            self.proxy = await self.proxy_pool.get()
+            self.logger.info('Switched to proxy: %s', self.proxy)
+
+    async def make_async_request( # pylint: disable=too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+            self, url, params, session, json_body=None, limiter=None):
         """Makes an async request using aiohttp.
 
-        Makes a get request.
-        If successful, returns the response text future.
+        Makes a get request, or a post request if there's a request body.
+        Each attempt holds one of the API key's connection slots.
+        If successful, returns the response body future. The body is left
+        as bytes, so it can be decoded without first converting it to a
+        str (see app.decoding).
         If the request times out, or returns a status code
-        that we want to retry, recursively retry the request
-        up to MAX_RETRIES times using exponential backoff.
+        that we want to retry, retry the request for as long as
+        the list's retry policy allows, waiting in between. Requests
+        which fail because another request switched proxies under them
+        are retried without counting against the policy.
 
         Args:
             url: The url to make the request to.
             params: The HTTP GET parameters.
             session: The aiohttp ClientSession to make requests with.
-            retry: The number of previous attempts at this individual
+            json_body: An object to send as the JSON body of a post
                 request.
+            limiter: An AdaptiveConcurrencyLimiter to report the outcome
+                of each attempt to.
 
         Returns:
             An asyncio future, which, when awaited,
-            contains the request response.
+            contains the response body as bytes.
 
         Throws:
             MailChimpImportError: The request keeps returning a bad HTTP status
                 code and/or timing out with no response.
         """
-        try:
-
-            # Make the async request with aiohttp
-            async with session.get(url, params=params,
-                                   auth=BasicAuth('shorenstein',
-                                                  self.api_key),
-                                   proxy=self.proxy) as response:
-
-                # If we got a 200 OK, return the request response
-                if response.status == 200:
-                    return await response.text()
-
-                # Always log the bad response
-                self.logger.warning('Received invalid response code: '
-                                    '%s. URL: %s. API key: %s. '
-                                    'Response: %s.', response.status,
-                                    url, self.api_key,
-                                    response.reason)
-
-                # Retry if we got an error
-                # And we haven't already retried a few times
-                if (response.status in self.HTTP_STATUS_CODES_TO_RETRY
-                        and retry < self.MAX_RETRIES):
-
-                    # Increment retry count, log, sleep and then retry
-                    retry += 1
-                    self.logger.info('Retrying (%s)', retry)
-                    await asyncio.sleep(self.BACKOFF_INTERVAL ** retry)
-                    return await self.make_async_request(
-                        url, params, session, retry)
-
-                # Prepare some details for the user
-                error_details = OrderedDict([
-                    ('err_desc', 'An error occurred when '
-                                 'trying to import your data '
-                                 'from MailChimp.'),
-                    ('mailchimp_err_code', response.status),
-                    ('mailchimp_url', url),
-                    ('api_key', self.api_key),
-                    ('mailchimp_err_reason', response.reason)])
-
-                # Log the error and raise an exception
-                self.logger.exception('Invalid response code from MailChimp')
-                raise MailChimpImportError(
-                    'Invalid response code from MailChimp',
-                    error_details)
-
-        # Catch proxy problems as well as potential asyncio timeouts/disconnects
-        except Exception as e: # pylint: disable=invalid-name
-
-            exception_type = type(e).__name__
-
-            # If we're just catching the exception raised above
-            # don't need to do anything else
-            if exception_type == 'MailChimpImportError':
+        self.retry_policy.record_request()
+        retries = 0
+        delay = None
+        while True:
+            proxy = self.proxy
+            proxy_failed = False
+            collateral = False
+            slot = self.connection_slots.slot()
+            try:
+
+                # Make the async request with aiohttp
+                request = (
+                    session.get(url, params=params,
+                                auth=BasicAuth('shorenstein', self.api_key),
+                                headers=self.REQUEST_HEADERS, proxy=proxy)
+                    if json_body is None else
+                    session.post(url, json=json_body,
+                                 auth=BasicAuth('shorenstein', self.api_key),
+                                 headers=self.REQUEST_HEADERS, proxy=proxy))
+                async with slot, request as response:
+
+                    # Let the limiter know how the API is coping
+                    if limiter is not None:
+                        limiter.record(slot.acquired_at, response.status)
+
+                    # If we got a 200 OK, return the request response
+                    if response.status == 200:
+                        return await response.read()
+
+                    # Always log the bad response
+                    self.logger.warning('Received invalid response code: '
+                                        '%s. URL: %s. API key: %s. '
+                                        'Response: %s.', response.status,
+                                        url, self.api_key,
+                                        response.reason)
+
+                    # Raise an exception unless the error is worth retrying
+                    # And we haven't already retried too often
+                    retry_after = response.headers.get('Retry-After')
+                    if not self.retry_policy.should_retry(
+                            retries, response.status):
+
+                        # Log the error and raise an exception
+                        # With some details for the user
+                        self.logger.exception(
+                            'Invalid response code from MailChimp')
+                        raise MailChimpImportError.from_response(
+                            url, self.api_key, response.status,
+                            response.reason)
+
+                    # A rate limit may be specific to the proxy's IP address
+                    # Only switch if another proxy is ready, though
+                    # Otherwise rotating would take down the only proxy
+                    # every request is using, so just back off
+                    proxy_failed = (
+                        response.status == 429 and
+                        self.proxy_pool is not None and
+                        self.proxy_pool.has_other_ready_proxy(proxy))
+
+            # Let cancellations through, e.g. when a TaskGroup cancels the
+            # rest of an import after one of its requests fails
+            # On Python 3.6, CancelledError is still an Exception
+            except asyncio.CancelledError: # pylint: disable=try-except-raise
                 raise
 
-            # Otherwise, log what happened as appropriate
-            if exception_type == 'ClientHttpProxyError':
-                self.logger.warning('Failed to connect to proxy! Proxy: %s',
-                                    self.proxy)
-
-            elif exception_type == 'ServerDisconnectedError':
-                self.logger.warning('Server disconnected! URL: %s. API key: '
-                                    '%s.', url, self.api_key)
-
-            elif exception_type == 'TimeoutError':
-                self.logger.warning('Asyncio request timed out! URL: %s. '
-                                    'API key: %s.', url, self.api_key)
-
-            else:
-                self.logger.warning('An unforseen error type occurred. '
-                                    'Error type: %s. URL: %s. API Key: %s.',
-                                    exception_type, url, self.api_key)
-
-            # Retry if we haven't already retried a few times
-            if retry < self.MAX_RETRIES:
-
-                # Increment retry count, log, sleep, and then retry
-                retry += 1
-                self.logger.info('Retrying (%s)', retry)
-                await asyncio.sleep(self.BACKOFF_INTERVAL ** retry)
-                return await self.make_async_request(
-                    url, params, session, retry)
-
-            # Prepare some details for the user
-            error_details = OrderedDict([
-                ('err_desc', 'An error occurred when '
-                             'trying to import your data from MailChimp.'),
-                ('application_exception', exception_type),
-                ('mailchimp_url', url),
-                ('api_key', self.api_key)])
-
-            # Log the error and raise an exception
-            self.logger.exception('Error in async request to MailChimp (%s)',
-                                  exception_type)
-
-            raise MailChimpImportError(
-                'Error in async request to MailChimp ({})'.format(
-                    exception_type),
-                error_details)
+            # Catch proxy problems as well as potential asyncio
+            # timeouts/disconnects
+            except Exception as e: # pylint: disable=invalid-name, broad-except
+
+                exception_type = type(e).__name__
+
+                # If we're just catching the exception raised above
+                # don't need to do anything else
+                if exception_type == 'MailChimpImportError':
+                    raise
+
+                # Let the limiter know the request failed without a response
+                if limiter is not None and slot.acquired_at is not None:
+                    limiter.record(slot.acquired_at, None)
+
+                # Otherwise, log what happened as appropriate
+                if exception_type == 'ClientHttpProxyError':
+                    self.logger.warning('Failed to connect to proxy! '
+                                        'Proxy: %s', proxy)
+                    proxy_failed = True
+
+                    # Requests in flight when another request switched
+                    # proxies fail along with the old proxy
+                    # That's not their fault, so it doesn't use up a retry
+                    collateral = (
+                        self.proxy_pool is not None and
+                        not self.proxy_pool.is_current(proxy))
+
+                elif exception_type == 'ServerDisconnectedError':
+                    self.logger.warning('Server disconnected! URL: %s. '
+                                        'API key: %s.', url, self.api_key)
+
+                elif exception_type == 'TimeoutError':
+                    self.logger.warning('Asyncio request timed out! URL: %s. '
+                                        'API key: %s.', url, self.api_key)
+
+                else:
+                    self.logger.warning('An unforseen error type occurred. '
+                                        'Error type: %s. URL: %s. '
+                                        'API Key: %s.',
+                                        exception_type, url, self.api_key)
+
+                # Raise an exception if we've already retried too often
+                retry_after = None
+                if not collateral and not self.retry_policy.should_retry(
+                        retries, None):
+
+                    # Prepare some details for the user
+                    error_details = OrderedDict([
+                        ('err_desc', 'An error occurred when '
+                                     'trying to import your data '
+                                     'from MailChimp.'),
+                        ('application_exception', exception_type),
+                        ('mailchimp_url', url),
+                        ('api_key', self.api_key)])
+
+                    # Log the error and raise an exception
+                    self.logger.exception(
+                        'Error in async request to MailChimp (%s)',
+                        exception_type)
+
+                    raise MailChimpImportError(
+                        'Error in async request to MailChimp ({})'.format(
+                            exception_type),
+                        error_details)
+
+            # Switch proxies if the proxy was to blame
+            # The connection slot is released while we wait for a new one
+            if proxy_failed:
+                await self.rotate_proxy(proxy)
+
+            # Increment retry count, log, wait and then retry
+            # The connection slot is released while we wait
+            if not collateral:
+                retries += 1
+            delay = self.retry_policy.get_delay(delay, retry_after)
+            self.logger.info('Retrying (%s) in %.1f seconds', retries, delay)
+            await asyncio.sleep(delay)
 
     async def make_async_requests(self, sem, url, params, session):
-        """Makes a number of async requests using a semaphore.
+        """Makes a number of async requests using a concurrency limiter.
 
         Args:
-            sem: A semaphore to limit the number of concurrent async
-                requests.
+            sem: An AdaptiveConcurrencyLimiter to limit the number of
+                concurrent async requests.
             url: See make_async_request().
             params: See make_async_request().
             session: See make_async_request().
@@ -314,242 +430,216 @@ class MailChimpList(): # pylint: disable=too-many-instance-attributes
                 request results.
         """
         async with sem:
-            res = await self.make_async_request(url, params, session)
-            return json.loads(res)
-
-    async def import_list_members(self):
-        """Requests basic information about MailChimp list members in chunks.
-
-        This includes the member status, member stats, etc.
-        Requests are made asynchronously (up to CHUNK_SIZE members
-        per requests) using aiohttp. This speeds up the process
-        significantly and prevents timeouts.
-        After the requests have completed, parses the results and turns
-        them into a pandas dataframe.
+            res = await self.make_async_request(
+                url, params, session, limiter=sem)
+            return loads(res)
+
+    async def import_members_and_activity(self):
+        """Imports list members and their recent activity.
+
+        With the member_activity strategy and the async_requests backend,
+        the two imports are pipelined: import_list_members() produces
+        each chunk's subscribers as soon as the chunk arrives, and
+        import_queued_activity() consumes them, requesting their activity
+        while later chunks are still downloading. The queue only holds
+        ACTIVITY_QUEUE_SIZE chunks, so the member import waits for the
+        activity import rather than racing ahead of it. If either import
+        fails, the other is cancelled.
+
+        Otherwise, i.e. when activity doesn't need to be requested member
+        by member, imports the members and then their activity.
         """
+        if (self.activity_strategy != 'member_activity' or
+                self.import_backend != 'async_requests'):
+            await self.import_list_members()
+            await self.import_recent_activity()
+            return
+
+        subscriber_queue = asyncio.Queue(maxsize=self.ACTIVITY_QUEUE_SIZE)
+        async with TaskGroup('imports') as imports:
+            imports.spawn(self.import_list_members(subscriber_queue))
+            imports.spawn(self.import_queued_activity(subscriber_queue))
+            _, activities = await imports.gather()
+
+        # Store the number of subscribers for later
+        self.subscribers = len(self.get_subscriber_rows())
+
+        self.merge_recent_opens(activities)
+
+    def load_checkpoint(self, name):
+        """Loads part of the import saved by a previous attempt at the run.
+
+        Args:
+            name: see ImportCheckpoint.save().
 
-        # Enable a proxy
-        await self.enable_proxy()
-
-        # MailChimp API endpoint for requests
-        request_uri = ('https://{}.api.mailchimp.com/3.0/lists/{}/'
-                       'members'.format(self.data_center, self.id))
-
-        # List of async tasks to do
-        tasks = []
-
-        # Placeholder for async responses
-        responses = None
-
-        # Semaphore to limit max simultaneous connections to MailChimp API
-        sem = asyncio.Semaphore(self.MAX_CONNECTIONS)
-
-        # The total number of chunks, i.e. requests to make to MailChimp
-        # If list is smaller than CHUNK_SIZE, this is 1 request
-        number_of_chunks = (1 if self.count < self.CHUNK_SIZE
-                            else self.count // self.CHUNK_SIZE + 1)
-
-        # Make requests with a single session
-        async with ClientSession() as session:
-            for chunk_num in range(number_of_chunks):
-
-                # Calculate the number of members in this request
-                chunk = (str(self.count % self.CHUNK_SIZE
-                             if chunk_num == number_of_chunks - 1
-                             else self.CHUNK_SIZE))
-
-                # Calculate where to begin request from
-                offset = str(chunk_num * self.CHUNK_SIZE)
-
-                params = (
-                    ('fields', 'members.status,'
-                               'members.timestamp_opt,'
-                               'members.timestamp_signup,'
-                               'members.stats,members.id'),
-                    ('count', chunk),
-                    ('offset', offset),
-                )
-
-                # Add a new import task to the queue for each chunk
-                task = asyncio.ensure_future(
-                    self.make_async_requests(
-                        sem, request_uri, params, session))
-                tasks.append(task)
-
-            # Await completion of all requests and gather results
-            responses = await asyncio.gather(*tasks)
-
-        # Flatten the responses into a single list of dicts
-        list_data = [response
-                     for response_dict in responses
-                     for v in response_dict.values()
-                     for response in v]
-
-        # Create a pandas dataframe to store the results
-        self.df = pd.DataFrame(list_data) # pylint: disable=invalid-name
-
-    async def import_sub_activity(self): # pylint: disable=too-many-locals
-        """Requests each subscriber's recent activity.
-
-        First, gets a list of subscribers.
-        Then makes the requests one-by-one using aiohttp (MailChimp's API is
-        very inefficient and you cannot request multiple subscribers' activity
-        at the same time).
-        After the requests have completed, parses the results, turns them into
-        a pandas dataframe, and merges this dataframe with the members
-        dataframe created by import_list_members().
+        Returns:
+            See ImportCheckpoint.load(). Always None if the run isn't being
+                checkpointed.
         """
-        params = (
-            ('fields', 'activity.action,activity.timestamp,email_id'),
-            ('exclude_fields', 'total_items,_links')
-        )
+        return self.checkpoint.load(name) if self.checkpoint else None
 
-        request_uri = ('https://{}.api.mailchimp.com/3.0/lists/{}/members/'
-                       '{}/activity'.format(self.data_center, self.id, '{}'))
+    def save_checkpoint(self, name, **arrays):
+        """Saves part of the import, if the run is being checkpointed.
 
-        # List of async tasks to do
-        tasks = []
+        Args:
+            name: see ImportCheckpoint.save().
+            arrays: see ImportCheckpoint.save().
+        """
+        if self.checkpoint:
+            self.checkpoint.save(name, **arrays)
 
-        # Placeholder for async responses
-        responses = None
+    def get_snapshot_versions(self):
+        """Returns the versions of the list's snapshot, one per analysis.
 
-        # Semaphore to limit max simultaneous connections to MailChimp API
-        sem = asyncio.Semaphore(self.MAX_ACTIVITY_CONNECTIONS)
+        See SnapshotStore.get_versions().
+        """
+        return SnapshotStore().get_versions(self.id)
 
-        # Get a list of unique subscriber ids
-        subscriber_list = self.get_list_ids()
+    def load_snapshot(self, version=None):
+        """Loads the list's members dataframe from a previous analysis.
 
-        # Store the number of subscribers for later
-        self.subscribers = len(subscriber_list)
-
-        # Create a session with which to make requests
-        async with ClientSession() as session:
-            for subscriber_id in subscriber_list:
-
-                # Format the request string
-                request_string = request_uri.format(subscriber_id)
-
-                # Add a new import task to the queue for each list subscriber
-                task = asyncio.ensure_future(
-                    self.make_async_requests(
-                        sem, request_string, params, session))
-                tasks.append(task)
-
-            # Await completion of all requests and gather results
-            responses = await asyncio.gather(*tasks)
-
-        # Calculate timestamp for one year ago
-        now = datetime.now(timezone.utc)
-        one_year_ago = now - timedelta(days=365)
-
-        # Flatten responses
-        # Filter out activity older than one year
-        activities = [{**{'id': response['email_id']},
-                       **{'recent_open': d['timestamp']
-                          for d in response['activity']
-                          if d['action'] == 'open' and
-                          iso8601.parse_date(d['timestamp']) > one_year_ago}}
-                      for response in responses]
-
-        # Convert results to a dataframe
-        subscriber_activities = pd.DataFrame(activities)
-
-        # Merge dataframes if any subscribers have recently opened
-        # Else add an empty recent_open column to dataframe
-        # This allows us to assume that a 'recent open' column exists
-        if 'recent_open' in subscriber_activities:
-            self.df = pd.merge(self.df,
-                               subscriber_activities,
-                               on='id',
-                               how='left')
-        else:
-            self.df['recent_open'] = np.NaN
+        Args:
+            version: one of get_snapshot_versions(). Defaults to the
+                latest analysis.
 
-    def get_list_ids(self):
-        """Returns a list of md5-hashed email ids for subscribers only."""
-        return self.df[self.df['status'] == 'subscribed']['id'].tolist()
+        Returns:
+            See SnapshotStore.load().
+        """
+        return SnapshotStore().load(self.id, version)
+
+    def use_snapshot(self, version=None):
+        """Uses a previous analysis' members as the list's members dataframe.
+
+        This lets metrics be recomputed for past analyses without
+        requesting anything from MailChimp.
+
+        Args:
+            version: see load_snapshot().
+
+        Returns:
+            The snapshot's analysis timestamp, or None if there's no such
+                snapshot, in which case the df is left as it was.
+        """
+        snapshot = self.load_snapshot(version)
+        if snapshot is None:
+            return None
+        self.df, analysis_timestamp = snapshot # pylint: disable=invalid-name
+        return analysis_timestamp
+
+    def save_snapshot(self, analysis_timestamp):
+        """Saves the list's members dataframe for future analyses.
+
+        Args:
+            analysis_timestamp: see SnapshotStore.save().
+
+        Returns:
+            The snapshot's version.
+        """
+        if self.spill is not None:
+            return SnapshotStore().save_columns(
+                self.id, self.spill.columns, self.spill.categories,
+                analysis_timestamp)
+        return SnapshotStore().save(self.id, self.df, analysis_timestamp)
+
+    def close(self):
+        """Removes the list's spilled members from disk, if there are any."""
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+    def get_column(self, column):
+        """Returns a column of the list's members as a numpy array.
+
+        Out of core, the array is memory-mapped from the spill. Use
+        get_status_codes() for the member statuses.
+        """
+        if self.spill is not None:
+            return self.spill.columns[column]
+        return self.df[column].values
+
+    def find_rows(self, ids):
+        """Looks members up by id.
+
+        Out of core, see ColumnSpill.find_rows(). Otherwise, the ids are
+        looked up in an index of the members dataframe's ids.
+
+        Args:
+            ids: an array of member ids, of the same dtype as the list's.
+
+        Returns:
+            An array containing each member's row, or -1 where the id
+                isn't in the list.
+        """
+        if self.spill is not None:
+            return self.spill.find_rows('id', ids)
+        return pd.Index(self.df['id'].values).get_indexer(ids)
+
+    def get_subscriber_rows(self):
+        """Returns the rows of subscribers in the members dataframe.
+
+        The dataframe's row positions are a dense integer index of its
+        members, so imports refer to subscribers by row rather than by
+        their 32-character md5-hashed email ids.
+
+        Returns:
+            An int32 array of row positions.
+        """
+        return np.flatnonzero(
+            self.get_status_codes() ==
+            MemberBuffer.STATUS_CODES['subscribed']).astype(np.int32)
 
     def flatten(self):
-        """Removes nested jsons from the dataframe."""
-
-        # Extract member stats from nested json
-        # Then store them in a flattened dataframe
-        stats = json_normalize(self.df['stats'].tolist())
-
-        # Merge the dataframes
-        self.df = (self.df[['status', 'timestamp_opt', 'timestamp_signup',
-                            'id', 'recent_open']].join(stats))
-
-    def calc_list_breakdown(self):
-        """Calculates the list breakdown."""
-        statuses = self.df.status.unique()
-        self.subscribed_pct = (
-            0 if 'subscribed' not in statuses
-            else self.df.status.value_counts()['subscribed'] /
-            self.count)
-        self.unsubscribed_pct = (
-            0 if 'unsubscribed' not in statuses
-            else self.df.status.value_counts()['unsubscribed'] /
-            self.count)
-        self.cleaned_pct = (
-            0 if 'cleaned' not in statuses
-            else self.df.status.value_counts()['cleaned'] /
-            self.count)
-        self.pending_pct = (
-            0 if 'pending' not in statuses
-            else self.df.status.value_counts()['pending'] /
-            self.count)
-
-    def calc_open_rate(self, open_rate):
-        """Calculates the open rate as a decimal."""
-        self.open_rate = float(open_rate) / 100
-
-    def calc_frequency(self, date_created, campaign_count):
-        """Calculates the average number of days per campaign sent. Automatically
-        zero if fewer than 10 campaigns have been sent total."""
-        campaign_count = int(campaign_count)
-        if campaign_count < 10:
-            self.frequency = 0
-        else:
-            now = datetime.now(timezone.utc)
-            created = (iso8601.parse_date(date_created)
-                       if isinstance(date_created, str)
-                       else date_created)
-            list_age = now - created
-            self.frequency = list_age.days / campaign_count
-
-    def calc_histogram(self):
-        """Calculates the distribution for subscriber open rate."""
-        bin_boundaries = np.linspace(0, 1, num=11)
-        bins = (pd.cut(
-            self.df.loc[self.df['status'] == 'subscribed', 'avg_open_rate'],
-            bin_boundaries, include_lowest=True))
-        self.hist_bin_counts = (pd.value_counts(bins, sort=False).tolist())
-
-    def calc_high_open_rate_pct(self):
-        """Calcuates the percentage of subscribers who open >80% of emails."""
-
-        # Sum the number of rows where average open rate exceeds 0.8
-        # And the member is a subscriber
-        # Then divide by the total number of rows
-        self.high_open_rt_pct = (
-            sum(x > 0.8 for x in self.df[self.df['status'] == 'subscribed']
-                ['avg_open_rate']) / self.subscribers)
-
-    def calc_cur_yr_stats(self):
-        """Calculates metrics related to activity
-        that occured in the previous year."""
-
-        # Total number of subsribers without an open within the last year
-        cur_yr_inactive_subs = (self.subscribers -
-                                int(self.df['recent_open'].count()))
-
-        # Percent of such subscribers
-        self.cur_yr_inactive_pct = cur_yr_inactive_subs / self.subscribers
+        """Removes any columns which aren't used in calculations.
+
+        Member stats are extracted from their nested jsons while the
+        import responses are parsed (see MemberBuffer), so this is
+        usually a no-op. Spilled members only ever have the columns used
+        in calculations.
+        """
+        if self.spill is not None:
+            return
+        extra_columns = [column for column in self.df
+                         if column not in self.COLUMNS]
+        if extra_columns:
+            self.df.drop(columns=extra_columns, inplace=True)
+
+    def get_status_codes(self):
+        """Returns the member statuses as an array of MemberBuffer.STATUSES
+        codes, with -1 for unrecognized statuses."""
+        if self.spill is not None:
+            return self.spill.columns['status']
+        statuses = self.df['status']
+        if (statuses.dtype.name == 'category' and
+                tuple(statuses.cat.categories) == MemberBuffer.STATUSES):
+            return statuses.cat.codes.values
+        return pd.Categorical(
+            statuses, categories=MemberBuffer.STATUSES).codes
 
     def get_list_as_csv(self):
-        """Returns a string buffer containing a CSV of the list data."""
+        """Returns a string buffer containing a CSV of the list data.
+
+        If the list's members were spilled to disk, or weren't imported or
+        loaded, they're exported straight from the spill or the list's
+        latest snapshot, chunk by chunk, so only one chunk of members is
+        in a dataframe at a time. The whole CSV is still held in the
+        buffer.
+        """
         csv_buffer = io.StringIO()
-        self.df.to_csv(csv_buffer, index=False)
+        if self.spill is not None:
+            chunks = self.spill.iter_frames(self.CSV_CHUNK_SIZE)
+        elif self.df is not None:
+            chunks = [self.df]
+        else:
+            chunks = SnapshotStore().iter_chunks(self.id, self.CSV_CHUNK_SIZE)
+        for chunk_num, chunk in enumerate(chunks):
+
+            # Decode the member ids so they aren't written as bytes literals
+            # (Replacing the column in place would keep the bytes dtype)
+            if 'id' in chunk and chunk['id'].dtype.kind == 'S':
+                id_loc = chunk.columns.get_loc('id')
+                ids = chunk['id'].values.astype(str)
+                chunk = chunk.drop(columns='id')
+                chunk.insert(id_loc, 'id', ids)
+            chunk.to_csv(csv_buffer, index=False, header=chunk_num == 0)
         csv_buffer.seek(0)
         return csv_buffer
@@ -0,0 +1,346 @@
+"""This module handles importing the members of email lists."""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from app.concurrency import TaskGroup
+from app.connections import WorkerConnections
+from app.spill import ColumnSpill
+from app.throttling import AdaptiveConcurrencyLimiter
+
+class MemberBuffer():
+    """A columnar buffer which accumulates list members chunk by chunk.
+
+    Each chunk of members is converted into one compact, typed numpy
+    array per field as soon as it arrives, so the raw responses can be
+    discarded immediately rather than held until the whole list has been
+    downloaded.
+    """
+
+    # The nested member stats extracted into their own columns
+    STATS_FIELDS = ('avg_open_rate', 'avg_click_rate')
+
+    # The member fields we request from the MailChimp API
+    # Only the stats we use are requested, not every member stat
+    FIELDS = ('status', 'timestamp_opt', 'timestamp_signup',
+              *('stats.' + field for field in STATS_FIELDS), 'id')
+
+    # The columns of the resulting dataframe
+    COLUMNS = ('status', 'timestamp_opt', 'timestamp_signup',
+               *STATS_FIELDS, 'id')
+
+    # The possible values of a member's status
+    # Stored as a categorical, so the order here determines the codes
+    STATUSES = ('subscribed', 'unsubscribed', 'cleaned', 'pending',
+                'transactional', 'archived')
+    STATUS_CODES = dict(zip(STATUSES, range(len(STATUSES))))
+
+    # The numpy dtype used to store each column
+    # Member ids are md5 hashes, i.e. 32 hexadecimal characters
+    DTYPES = {'status': np.int8,
+              'timestamp_opt': 'datetime64[ns]',
+              'timestamp_signup': 'datetime64[ns]',
+              'avg_open_rate': np.float32,
+              'avg_click_rate': np.float32,
+              'id': 'S32'}
+
+    # The UTC offset of the timestamps returned by the MailChimp API
+    UTC_OFFSET = '+00:00'
+
+    def __init__(self):
+        """Initializes an empty buffer.
+
+        Other class variables:
+            chunks: a dictionary mapping chunk numbers to a dictionary of
+                column arrays for that chunk.
+        """
+        self.chunks = {}
+
+    @classmethod
+    def parse_timestamps(cls, timestamps):
+        """Converts a list of ISO 8601 strings to a datetime64 array (UTC).
+
+        Empty strings, e.g. the timestamp_opt of a member who never
+        opted in, become NaT.
+        MailChimp's timestamps are all in UTC, so they're parsed by numpy
+        directly once the offset is stripped, which is several times
+        faster than parsing them with pandas. Anything else falls back to
+        pandas. Arrays which are already datetime64 are returned as is.
+        """
+        if getattr(timestamps, 'dtype', None) == np.dtype('datetime64[ns]'):
+            return timestamps
+        offset_length = len(cls.UTC_OFFSET)
+        try:
+            return np.array(
+                [timestamp[:-offset_length]
+                 if timestamp.endswith(cls.UTC_OFFSET)
+                 else timestamp and cls.UTC_OFFSET # i.e. fail to parse
+                 for timestamp in timestamps], dtype='datetime64[ns]')
+        except (AttributeError, ValueError):
+            return pd.to_datetime(
+                timestamps, utc=True, errors='coerce').tz_convert(None).values
+
+    def append(self, chunk_num, members):
+        """Adds a chunk of members to the buffer.
+
+        Args:
+            chunk_num: the position of the chunk within the list. Used to
+                preserve the list order when chunks arrive out of order.
+            members: a list of member dictionaries as returned by the
+                MailChimp API.
+        """
+        chunk = {
+            'status': np.array(
+                [self.STATUS_CODES.get(member.get('status'), -1)
+                 for member in members], dtype=self.DTYPES['status']),
+            'timestamp_opt': self.parse_timestamps(
+                [member.get('timestamp_opt') for member in members]),
+            'timestamp_signup': self.parse_timestamps(
+                [member.get('timestamp_signup') for member in members]),
+            'id': np.array(
+                [member.get('id', '') for member in members],
+                dtype=self.DTYPES['id'])}
+
+        # Pull the member stats out of their nested jsons
+        # Straight into numeric arrays
+        stats = [member.get('stats') or {} for member in members]
+        for field in self.STATS_FIELDS:
+            chunk[field] = np.array(
+                [member_stats.get(field, np.nan) for member_stats in stats],
+                dtype=self.DTYPES[field])
+
+        self.chunks[chunk_num] = chunk
+
+    def get_column(self, field):
+        """Concatenates the buffered chunks of a single field in list order."""
+        if not self.chunks:
+            return np.empty(0, dtype=self.DTYPES[field])
+        return np.concatenate([self.chunks[chunk_num][field]
+                               for chunk_num in sorted(self.chunks)])
+
+    def to_frame(self):
+        """Returns a typed pandas dataframe containing every buffered member.
+
+        The member status is a categorical, timestamps are datetime64,
+        member stats are float32 and member ids are fixed-width bytes.
+        """
+        df = pd.DataFrame(OrderedDict([ # pylint: disable=invalid-name
+            ('status', pd.Categorical.from_codes(
+                self.get_column('status'), self.STATUSES)),
+            ('timestamp_opt', self.get_column('timestamp_opt')),
+            ('timestamp_signup', self.get_column('timestamp_signup')),
+            *((field, self.get_column(field))
+              for field in self.STATS_FIELDS)]))
+
+        # Assigned separately as the DataFrame constructor would
+        # otherwise convert the fixed-width bytes to python objects
+        df['id'] = self.get_column('id')
+        return df
+
+class MemberImportMixin():
+    """Imports a MailChimp list's members.
+
+    Mixed into MailChimpList, which makes the requests and holds the
+    imported members.
+    """
+
+    # The max size of a request to the MailChimp API
+    # This is for direct requests to the members endpoint
+    CHUNK_SIZE = 5000
+
+    async def import_list_members(self, subscriber_queue=None):
+        """Requests basic information about MailChimp list members in chunks.
+
+        This includes the member status, member stats, etc.
+        Requests are made asynchronously (up to CHUNK_SIZE members
+        per requests) using aiohttp. This speeds up the process
+        significantly and prevents timeouts.
+        Each chunk is parsed into a columnar buffer as soon as it arrives,
+        so only a handful of raw responses are held in memory at any one
+        time. Once every chunk has arrived, the buffer is turned into a
+        pandas dataframe.
+        Parsed chunks are checkpointed, and chunks checkpointed by a
+        previous attempt at the run aren't requested again.
+
+        Args:
+            subscriber_queue: an asyncio queue. If given, the subscribers in
+                each chunk are put on the queue as soon as the chunk is
+                parsed (see queue_subscribers()), so that their activity can
+                be imported while the rest of the list is still being
+                imported. None is put on the queue once every chunk has
+                been queued, or if the import fails.
+        """
+        try:
+            await self.import_list_member_chunks(subscriber_queue)
+        finally:
+            if subscriber_queue is not None:
+                await subscriber_queue.put(None)
+
+    async def import_list_member_chunks(self, subscriber_queue): # pylint: disable=too-many-locals
+        """Requests list members in chunks, see import_list_members().
+
+        Args:
+            subscriber_queue: see import_list_members().
+        """
+
+        # Enable a proxy
+        await self.enable_proxy()
+
+        # MailChimp API endpoint for requests
+        request_path = '/lists/{}/members'.format(self.id)
+        request_uri = self.api_root + request_path
+
+        # Columnar buffer which accumulates members as chunks arrive
+        # Out of core, each chunk is moved on to disk once it's handled
+        member_buffer = MemberBuffer()
+        if self.out_of_core:
+            self.spill = ColumnSpill(
+                OrderedDict((column, MemberBuffer.DTYPES[column])
+                            for column in MemberBuffer.COLUMNS),
+                {'status': list(MemberBuffer.STATUSES)})
+
+        # Limit simultaneous connections to MailChimp API
+        sem = AdaptiveConcurrencyLimiter(
+            self.MAX_CONNECTIONS, self.MAX_API_CONNECTIONS)
+
+        # The total number of chunks, i.e. requests to make to MailChimp
+        # If list is smaller than CHUNK_SIZE, this is 1 request
+        number_of_chunks = (1 if self.count < self.CHUNK_SIZE
+                            else self.count // self.CHUNK_SIZE + 1)
+
+        # The request parameters for each chunk still to be imported
+        chunk_params = OrderedDict()
+        for chunk_num in range(number_of_chunks):
+
+            # Load the chunk if it was imported by a previous attempt
+            saved_chunk = self.load_checkpoint('members-{}'.format(chunk_num))
+            if saved_chunk is not None:
+                member_buffer.chunks[chunk_num] = saved_chunk
+                await self.queue_subscribers(
+                    subscriber_queue, chunk_num, saved_chunk)
+                self.spill_chunk(member_buffer, chunk_num)
+                continue
+
+            # Calculate the number of members in this request
+            chunk = (str(self.count % self.CHUNK_SIZE
+                         if chunk_num == number_of_chunks - 1
+                         else self.CHUNK_SIZE))
+
+            # Calculate where to begin request from
+            offset = str(chunk_num * self.CHUNK_SIZE)
+
+            chunk_params[chunk_num] = (
+                ('fields', ','.join(
+                    'members.' + field for field in MemberBuffer.FIELDS)),
+                ('count', chunk),
+                ('offset', offset),
+            )
+
+        # Make requests with a single session
+        async with WorkerConnections.client_session() as session:
+
+            # Either submit every chunk as a single batch operation
+            # And parse each chunk as it's read from the results
+            if self.import_backend == 'batch_operations' and chunk_params:
+                operations = [
+                    self.make_batch_operation(
+                        'members-{}'.format(chunk_num), request_path, params)
+                    for chunk_num, params in chunk_params.items()]
+                async for operation_id, response in self.make_batch_requests(
+                        session, operations):
+                    chunk_num = int(operation_id.split('-')[1])
+                    member_buffer.append(chunk_num, response['members'])
+                    self.save_checkpoint(operation_id,
+                                         **member_buffer.chunks[chunk_num])
+                    await self.queue_subscribers(
+                        subscriber_queue, chunk_num,
+                        member_buffer.chunks[chunk_num])
+                    self.spill_chunk(member_buffer, chunk_num)
+
+            # Or request each chunk directly
+            # And parse each chunk as soon as it completes
+            # If a chunk fails, the others are cancelled
+            elif chunk_params:
+
+                async def import_chunk(chunk_num, params):
+                    response = await self.make_async_requests(
+                        sem, request_uri, params, session)
+                    return chunk_num, response
+
+                async with TaskGroup('member chunks') as chunks:
+                    for chunk_num, params in chunk_params.items():
+                        chunks.spawn(import_chunk(chunk_num, params))
+                    for next_chunk in chunks.as_completed():
+                        chunk_num, response = await next_chunk
+                        member_buffer.append(chunk_num, response['members'])
+                        self.save_checkpoint(
+                            'members-{}'.format(chunk_num),
+                            **member_buffer.chunks[chunk_num])
+                        await self.queue_subscribers(
+                            subscriber_queue, chunk_num,
+                            member_buffer.chunks[chunk_num])
+                        self.spill_chunk(member_buffer, chunk_num)
+
+        # Memory-map the spilled members
+        # Or create a pandas dataframe to store the results
+        if self.spill is not None:
+            self.spill.finish()
+        else:
+            self.df = member_buffer.to_frame() # pylint: disable=invalid-name
+
+    def spill_chunk(self, member_buffer, chunk_num):
+        """Moves a chunk of members from the buffer to the spill.
+
+        Does nothing unless the list is being imported out of core.
+
+        Args:
+            member_buffer: the MemberBuffer holding the chunk.
+            chunk_num: the position of the chunk within the list.
+        """
+        if self.spill is not None:
+            self.spill.append(chunk_num, member_buffer.chunks.pop(chunk_num))
+
+    async def update_members(self, snapshot_df):
+        """Brings the members dataframe from a previous analysis up to date.
+
+        Every member is imported again, rather than only those who changed
+        since the previous analysis. MailChimp only updates a member's
+        last_changed when the member record changes, not when their stats
+        (e.g. their open rate) do. Importing the members is cheap next to
+        importing their activity: one request per CHUNK_SIZE members.
+        Members keep their previous recent opens, which
+        update_recent_activity() brings up to date.
+
+        Args:
+            snapshot_df: the members dataframe from the previous analysis,
+                see load_snapshot().
+        """
+        await self.import_list_members()
+
+        # Carry over the members' previous recent opens
+        # New members, i.e. -1, pick the appended NaT
+        rows = pd.Index(snapshot_df['id'].values).get_indexer(
+            self.df['id'].values)
+        self.df['recent_open'] = np.append(
+            MemberBuffer.parse_timestamps(snapshot_df['recent_open'].values),
+            np.datetime64('NaT'))[rows]
+
+    @staticmethod
+    async def queue_subscribers(subscriber_queue, chunk_num, chunk):
+        """Puts the subscribers in a chunk of members on a queue.
+
+        Args:
+            subscriber_queue: see import_list_members(). Nothing is queued
+                if this is None.
+            chunk_num: the position of the chunk within the list.
+            chunk: a dictionary of column arrays, see MemberBuffer.
+
+        Returns:
+            Nothing. Puts a tuple containing the chunk number and a list of
+                the chunk's subscriber ids on the queue.
+        """
+        if subscriber_queue is None:
+            return
+        is_subscribed = chunk['status'] == MemberBuffer.STATUSES.index(
+            'subscribed')
+        await subscriber_queue.put(
+            (chunk_num, chunk['id'][is_subscribed].astype(str).tolist()))
@@ -59,6 +59,7 @@ class EmailList(db.Model): # pylint: disable=too-few-public-methods
     data_center = db.Column(db.String(64))
     store_aggregates = db.Column(db.Boolean)
     monthly_updates = db.Column(db.Boolean)
+    activity_strategy = db.Column(db.String(32))
     monthly_update_users = db.relationship(
         AppUser, secondary=list_users, backref='lists', lazy='subquery')
     org_id = db.Column(db.Integer, db.ForeignKey('organization.id',
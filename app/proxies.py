@@ -0,0 +1,312 @@
+"""This module contains the pool of proxy servers used by a worker."""
+import os
+import time
+import asyncio
+from aiohttp import ClientError, ClientTimeout
+from billiard import current_process # pylint: disable=no-name-in-module
+from celery.signals import worker_process_init
+from celery.utils.log import get_task_logger
+from app.connections import WorkerConnections
+
+class ProxyError(Exception):
+    """A custom exception raised when a proxy can't be obtained."""
+
+class ProxyProvider(): # pylint: disable=too-few-public-methods
+    """Obtains proxy servers from US Proxies.
+
+    Requests are proxied through US Proxies to prevent MailChimp
+    blocks. This is an accepted technique among integrators and
+    does not violate MailChimp's Terms of Service.
+
+    Each proxy server is controlled by a numbered proxy process.
+    Rotating a process boots a new server, with a new IP address.
+    """
+
+    # The US Proxies API endpoint
+    API_URI = 'http://us-proxies.com/api.php'
+
+    # The number of seconds to wait for the provider to respond
+    # Rather than aiohttp's default of five minutes
+    TIMEOUT = 10
+
+    def __init__(self, uri=None):
+        """Initializes the provider.
+
+        Args:
+            uri: the provider's API endpoint. Defaults to API_URI.
+        """
+        self.uri = uri or self.API_URI
+
+    async def rotate(self, session, process_number):
+        """Boots a new proxy server for a proxy process.
+
+        Args:
+            session: the aiohttp ClientSession to make the request with.
+            process_number: the number of the proxy process.
+
+        Returns:
+            The new proxy's URL.
+
+        Throws:
+            ProxyError: the provider is unreachable or returned an error.
+        """
+        params = (
+            ('api', ''),
+            ('uid', '9557'),
+            ('pwd', os.environ.get('PROXY_AUTH_PWD') or ''),
+            ('cmd', 'rotate'),
+            ('process', str(process_number)),
+        )
+        try:
+            async with session.get(
+                    self.uri, params=params,
+                    timeout=ClientTimeout(total=self.TIMEOUT)) as response:
+                response_vars = (await response.text()).split(':')
+        except (ClientError, asyncio.TimeoutError):
+            raise ProxyError('ConnectionError: proxy provider down')
+        if response_vars[0] == 'ERROR':
+            raise ProxyError(response_vars[2])
+        return 'http://{}:{}'.format(response_vars[1], response_vars[2])
+
+class ProxyPool(): # pylint: disable=too-many-instance-attributes
+    """A pool of ready proxy servers, which lasts as long as the worker.
+
+    Each Celery worker process controls its own proxy processes, and
+    rotates all of them when it starts (see open_worker_proxy_pool()).
+    The new proxies boot while the worker waits for its first task, so
+    imports don't have to wait for them. Each proxy is health-checked
+    before it's first handed out, and is then kept until a request
+    through it fails, or is rate limited while another proxy is ready,
+    at which point it's rotated and requests move on to the pool's other
+    proxies. Outside of a
+    worker process, e.g. in tests, each import gets its own pool.
+    """
+
+    # The approximate amount of seconds it takes to cold boot a proxy
+    BOOT_TIME = 30
+
+    # The URL requested through a new proxy to check that it works
+    # Any response short of a server error or rate limit will do
+    HEALTH_CHECK_URL = 'https://login.mailchimp.com/'
+
+    # The number of seconds to wait for a health check
+    HEALTH_CHECK_TIMEOUT = 10
+
+    # The max number of seconds a starting worker process waits for its
+    # proxies to rotate
+    # Celery kills worker processes which take more than four seconds to
+    # start, and rotations which take longer carry on during the first task
+    WARM_TIMEOUT = 2
+
+    # The worker's pool, if it has opened one
+    worker_pool = None
+
+    def __init__(self, process_numbers, provider=None):
+        """Initializes the pool.
+
+        Args:
+            process_numbers: the numbers of the proxy processes to use.
+            provider: the ProxyProvider to obtain proxies from.
+
+        Other class variables:
+            proxies: the current proxy of each proxy process, by process
+                number. Processes without a working proxy are left out.
+            ready_at: when each proxy process's current proxy will have
+                booted, in time.monotonic() seconds.
+            healthy: the proxies which have passed a health check.
+            rotations: the in-progress rotations, by process number.
+            next_index: the index of the next process to hand out.
+            error: the reason the last proxy couldn't be obtained.
+        """
+        self.process_numbers = list(process_numbers)
+        self.provider = provider or ProxyProvider()
+        self.logger = get_task_logger(__name__)
+        self.proxies = {}
+        self.ready_at = {}
+        self.healthy = set()
+        self.rotations = {}
+        self.next_index = 0
+        self.error = None
+
+    @staticmethod
+    def get_process_numbers(size):
+        """Returns the numbers of the proxy processes this worker controls.
+
+        Args:
+            size: the number of proxy processes per worker.
+        """
+
+        # Get the worker number for this Celery worker
+        # We want each worker to control its corresponding proxy processes
+        # Note that workers are zero-indexed, proxy procceses are not
+        process = current_process()
+
+        # Fall back to worker #0 if we can't ascertain the worker index
+        # e.g. anyone hacking with this app on windows
+        try:
+            worker_index = process.index
+        except AttributeError:
+            worker_index = 0
+        return range(worker_index * size + 1, (worker_index + 1) * size + 1)
+
+    @classmethod
+    def create(cls):
+        """Creates a pool of this worker's proxy processes.
+
+        The number of proxies per worker is set by the PROXY_POOL_SIZE
+        environment variable, and defaults to one.
+        """
+        size = int(os.environ.get('PROXY_POOL_SIZE') or 1)
+        return cls(cls.get_process_numbers(size))
+
+    @classmethod
+    def open(cls):
+        """Opens the worker's pool and starts booting its proxies.
+
+        Waits up to WARM_TIMEOUT seconds for the proxies to rotate. Must be
+        called once the worker's connections have been opened.
+        """
+        if os.environ.get('NO_PROXY'):
+            cls.worker_pool = None
+            return
+        cls.worker_pool = cls.create()
+        loop = WorkerConnections.loop
+        warming = asyncio.ensure_future(cls.worker_pool.warm(), loop=loop)
+        loop.run_until_complete(asyncio.wait(
+            [warming], timeout=cls.WARM_TIMEOUT, loop=loop))
+
+    @classmethod
+    def get_pool(cls):
+        """Returns the worker's pool, or a new pool outside of a worker.
+
+        Like WorkerConnections.client_session(), the worker's pool is only
+        used by callers running on the worker's event loop.
+        """
+        if (cls.worker_pool is not None and
+                WorkerConnections.loop is asyncio.get_event_loop()):
+            return cls.worker_pool
+        return cls.create()
+
+    def start_rotation(self, process_number):
+        """Starts rotating a proxy process, unless it's already rotating.
+
+        Returns:
+            The rotation's future.
+        """
+        if process_number not in self.rotations:
+            self.proxies.pop(process_number, None)
+            self.rotations[process_number] = asyncio.ensure_future(
+                self.rotate(process_number))
+        return self.rotations[process_number]
+
+    async def rotate(self, process_number):
+        """Boots a new proxy for a proxy process."""
+        try:
+            async with WorkerConnections.client_session() as session:
+                proxy = await self.provider.rotate(session, process_number)
+            self.proxies[process_number] = proxy
+            self.ready_at[process_number] = time.monotonic() + self.BOOT_TIME
+            self.healthy.discard(proxy)
+            self.logger.info('Booting proxy: %s', proxy)
+        except ProxyError as e: # pylint: disable=invalid-name
+            self.error = str(e)
+            self.logger.warning('Unable to obtain proxy #%s. Reason: %s.',
+                                process_number, self.error)
+        finally:
+            del self.rotations[process_number]
+
+    async def warm(self):
+        """Rotates every proxy process which doesn't have a proxy."""
+        await asyncio.gather(*(
+            self.start_rotation(process_number)
+            for process_number in self.process_numbers
+            if process_number not in self.proxies))
+
+    async def check_health(self, proxy):
+        """Checks whether a request can be made through a proxy."""
+        try:
+            async with WorkerConnections.client_session() as session:
+                async with session.get(
+                        self.HEALTH_CHECK_URL, proxy=proxy,
+                        timeout=ClientTimeout(
+                            total=self.HEALTH_CHECK_TIMEOUT)) as response:
+                    return response.status < 500 and response.status != 429
+        except (ClientError, asyncio.TimeoutError):
+            return False
+
+    async def get(self):
+        """Hands out a ready proxy.
+
+        Proxy processes take turns, so requests are spread across them.
+        Waits for proxies which are still rotating or booting, and rotates
+        proxies which fail their health check. Each process is tried
+        twice, i.e. once more after it's been rotated.
+
+        Returns:
+            A proxy URL, or None if no proxy is available.
+        """
+        for _ in range(2 * len(self.process_numbers)):
+            process_number = self.process_numbers[
+                self.next_index % len(self.process_numbers)]
+            self.next_index += 1
+            if process_number not in self.proxies:
+                await asyncio.shield(self.start_rotation(process_number))
+            proxy = self.proxies.get(process_number)
+            if proxy is None:
+                continue
+
+            # Allow some time for the proxy server to boot up
+            await asyncio.sleep(max(
+                self.ready_at[process_number] - time.monotonic(), 0))
+            if proxy not in self.healthy:
+                if not await self.check_health(proxy):
+                    self.error = 'Proxy {} failed its health check'.format(
+                        proxy)
+                    self.report_failure(proxy)
+                    continue
+                self.healthy.add(proxy)
+
+            # The proxy may have failed while we waited for it
+            if self.proxies.get(process_number) == proxy:
+                return proxy
+        return None
+
+    def is_current(self, proxy):
+        """Checks whether a proxy is still in the pool, i.e. hasn't been
+        rotated since it was handed out."""
+        return proxy in self.proxies.values()
+
+    def has_other_ready_proxy(self, proxy):
+        """Checks whether requests could move on from a proxy right away.
+
+        Args:
+            proxy: the proxy to move on from.
+
+        Returns:
+            True if another proxy has booted and passed its health check.
+        """
+        now = time.monotonic()
+        return any(
+            other_proxy != proxy and other_proxy in self.healthy and
+            self.ready_at[process_number] <= now
+            for process_number, other_proxy in self.proxies.items())
+
+    def report_failure(self, proxy):
+        """Rotates a proxy after a request through it failed.
+
+        Proxies which have already been rotated are ignored, so a proxy
+        shared by many requests is only rotated once.
+        """
+        for process_number, current_proxy in list(self.proxies.items()):
+            if current_proxy == proxy:
+                self.healthy.discard(proxy)
+                self.start_rotation(process_number)
+
+@worker_process_init.connect
+def open_worker_proxy_pool(**kwargs): # pylint: disable=unused-argument
+    """Opens a Celery worker process's proxy pool when it starts.
+
+    Connected after open_worker_connections(), since app.connections is
+    imported first, so the pool can boot proxies on the worker's loop.
+    """
+    ProxyPool.open()
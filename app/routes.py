@@ -368,6 +368,7 @@ def analyze_list():
                  'data_center': session['data_center'],
                  'monthly_updates': session['monthly_updates'],
                  'store_aggregates': session['store_aggregates'],
+                 'activity_strategy': session.get('activity_strategy'),
                  'total_count': content['total_count'],
                  'open_rate': content['open_rate'],
                  'creation_timestamp': content['date_created'],
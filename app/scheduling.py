@@ -0,0 +1,118 @@
+"""This module contains the scheduler for nightly stored list updates."""
+from datetime import timedelta, timezone
+from app.lists import MailChimpList
+from app.snapshots import SnapshotStore
+
+class ListUpdateScheduler():
+    """Decides which stored lists to update each night, and in what order.
+
+    Each list is due for an update UPDATE_INTERVAL after its last analysis.
+    Updating lists only once they're due bunches the work up on the nights
+    when many lists happen to be due. Instead, the scheduler aims to spread
+    the work evenly over the interval: each night it sets a budget of
+    1 / UPDATE_INTERVAL days of the total estimated cost of updating every
+    list. Lists which are due are always updated. If they don't use up the
+    budget, lists which will be due within EARLY_UPDATE_WINDOW are updated
+    early, oldest first, as long as they fit in the rest of the budget.
+
+    The lists to update are ordered from most to least costly. Workers
+    take the next list whenever they're free, so this amounts to
+    longest-processing-time-first bin packing: large lists don't end up
+    starting last and leaving the other workers idle.
+    """
+
+    # How often each stored list is updated
+    UPDATE_INTERVAL = timedelta(days=30)
+
+    # How long before they're due lists may be updated
+    # In order to even out the nightly load
+    EARLY_UPDATE_WINDOW = timedelta(days=7)
+
+    def __init__(self, analyses, now):
+        """Initializes the scheduler.
+
+        Args:
+            analyses: the most recent ListStats object for each stored list.
+            now: the current timezone-aware datetime.
+
+        Other class variables:
+            costs: the estimated cost of updating each list, by list id.
+            daily_budget: the total cost of the lists to update each night.
+        """
+        self.analyses = analyses
+        self.now = now
+        self.costs = {analysis.list_id: self.estimate_cost(analysis)
+                      for analysis in analyses}
+        self.daily_budget = (sum(self.costs.values()) /
+                             self.UPDATE_INTERVAL.days)
+
+    @staticmethod
+    def estimate_cost(analysis):
+        """Estimates the cost of updating a list from its last analysis.
+
+        The cost is the approximate number of API requests needed, which
+        depends on how the list will be updated (see analyze_store_list()).
+        Every update requests the members one chunk at a time. Lists with
+        a snapshot which aren't analyzed out of core are then updated
+        incrementally: their opens are pulled from campaign reports, about
+        one request per chunk of opens. Other lists are imported in full
+        using their activity strategy. With campaign_reports, that costs
+        the same as an incremental update, but with member_activity it
+        requests each subscriber's activity, i.e. one request per
+        subscriber. An import whose reports can't be imported falls back
+        to the latter, but that can't be told in advance.
+
+        Args:
+            analysis: a ListStats object.
+
+        Returns:
+            The estimated number of requests.
+        """
+        subscribers = analysis.subscribers or 0
+
+        # The stats only count subscribers
+        # But every member is imported
+        members = (subscribers / analysis.subscribed_pct
+                   if analysis.subscribed_pct else subscribers)
+        uses_reports = (
+            analysis.list.activity_strategy == 'campaign_reports' or
+            (not MailChimpList.is_out_of_core_size(members) and
+             SnapshotStore().get_versions(analysis.list_id)))
+        if not uses_reports:
+            return members / MailChimpList.CHUNK_SIZE + subscribers
+
+        # Only subscribers who opened in the past year show up in reports
+        active_subscribers = subscribers * (
+            1 - (analysis.cur_yr_inactive_pct or 0))
+        return (members / MailChimpList.CHUNK_SIZE +
+                active_subscribers / MailChimpList.REPORT_CHUNK_SIZE)
+
+    def get_age(self, analysis):
+        """Returns how long ago a list was last analyzed."""
+        return self.now - analysis.analysis_timestamp.replace(
+            tzinfo=timezone.utc)
+
+    def schedule(self):
+        """Picks the lists to update tonight.
+
+        Returns:
+            A list of ListStats objects, ordered from most to least costly.
+        """
+        oldest_first = sorted(self.analyses, key=self.get_age, reverse=True)
+        due = [analysis for analysis in oldest_first
+               if self.get_age(analysis) >= self.UPDATE_INTERVAL]
+        scheduled = list(due)
+        spent = sum(self.costs[analysis.list_id] for analysis in due)
+
+        # Fill up the rest of the budget with lists which are nearly due
+        for analysis in oldest_first[len(due):]:
+            if (self.get_age(analysis) <
+                    self.UPDATE_INTERVAL - self.EARLY_UPDATE_WINDOW):
+                break
+            cost = self.costs[analysis.list_id]
+            if spent + cost <= self.daily_budget:
+                scheduled.append(analysis)
+                spent += cost
+
+        return sorted(scheduled, key=lambda analysis: self.costs[
+            analysis.list_id], reverse=True)
@@ -0,0 +1,259 @@
+"""This module contains an on-disk store for analyzed lists' member data."""
+import os
+import json
+import shutil
+import tempfile
+from datetime import timezone
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import iso8601
+
+class SnapshotStore():
+    """Stores a snapshot of each analysis of a list's member dataframe.
+
+    Each snapshot is a directory holding one .npy file per column, along
+    with a metadata file recording the column order, the categories of
+    any categorical columns, and when the list was analyzed. Columns must
+    be numeric, datetime, fixed-width bytes, or categorical.
+
+    Snapshots are kept in a directory per list, one per analysis (a
+    "version"), named after the analysis timestamp so they sort in
+    order. Columns are memory-mapped when loaded, so reading part of a
+    snapshot, e.g. a chunk of rows, only reads that part from disk.
+    """
+
+    # The name of the metadata file in each snapshot
+    META_FILE = 'meta.json'
+
+    # The format of snapshot version names
+    VERSION_FORMAT = '%Y%m%dT%H%M%S%fZ'
+
+    # The suffix of the directories new versions are written to
+    # A save which dies part of the way through can leave one behind
+    STAGING_SUFFIX = '.tmp'
+
+    # The number of versions to keep per list
+    # I.e. about a year's worth of monthly updates
+    MAX_VERSIONS = 13
+
+    def __init__(self, directory=None):
+        """Initializes the store.
+
+        Args:
+            directory: the directory to keep snapshots in. Defaults to the
+                SNAPSHOT_DIR environment variable, or a
+                benchmarks-snapshots folder in the home directory, i.e.
+                outside the deployed application, which is replaced on
+                every deploy.
+        """
+        self.directory = (directory or os.environ.get('SNAPSHOT_DIR') or
+                          os.path.join(os.path.expanduser('~'),
+                                       'benchmarks-snapshots'))
+
+    def get_path(self, list_id, version=None):
+        """Returns the path of a list's snapshots, or of one version."""
+        list_path = os.path.join(self.directory, str(list_id))
+        return (list_path if version is None
+                else os.path.join(list_path, version))
+
+    def get_versions(self, list_id):
+        """Returns the versions of a list's snapshot, oldest first.
+
+        Staging directories are left out, even if a save got as far as
+        writing their metadata file before it died.
+        """
+        list_path = self.get_path(list_id)
+        if not os.path.isdir(list_path):
+            return []
+        return sorted(
+            version for version in os.listdir(list_path)
+            if not version.endswith(self.STAGING_SUFFIX) and
+            os.path.isfile(os.path.join(list_path, version, self.META_FILE)))
+
+    def save(self, list_id, df, analysis_timestamp): # pylint: disable=invalid-name
+        """Saves a new version of a list's snapshot.
+
+        Args:
+            list_id: the list's unique MailChimp id.
+            df: the list's member dataframe.
+            analysis_timestamp: see save_columns().
+
+        Returns:
+            The new version's name.
+
+        Throws:
+            ValueError: a column can't be stored as a numpy array.
+        """
+        columns = OrderedDict()
+        categories = {}
+        for column in df:
+            values = df[column]
+            if values.dtype.name == 'category':
+                categories[column] = values.cat.categories.tolist()
+                values = values.cat.codes
+            columns[column] = values.values
+        return self.save_columns(
+            list_id, columns, categories, analysis_timestamp)
+
+    def save_columns(self, list_id, columns, categories, analysis_timestamp): # pylint: disable=too-many-locals
+        """Saves a new version of a list's snapshot from column arrays.
+
+        The snapshot is written to a temporary directory which is then
+        renamed, so readers never see a partially written snapshot. Once
+        the new version is saved, versions beyond MAX_VERSIONS are removed.
+        Memory-mapped columns, e.g. from a ColumnSpill, are written
+        straight from disk.
+
+        Args:
+            list_id: the list's unique MailChimp id.
+            columns: an ordered dictionary of the member columns' numpy
+                arrays, by name.
+            categories: a dictionary containing the categories of any
+                categorical columns, by name. Those columns hold codes.
+            analysis_timestamp: a timezone-aware datetime. Members who
+                changed after this will be updated by the next
+                incremental analysis.
+
+        Returns:
+            The new version's name.
+
+        Throws:
+            ValueError: a column can't be stored as a numpy array.
+        """
+        list_path = self.get_path(list_id)
+        os.makedirs(list_path, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(
+            dir=list_path, suffix=self.STAGING_SUFFIX)
+        version = analysis_timestamp.astimezone(timezone.utc).strftime(
+            self.VERSION_FORMAT)
+        try:
+            num_rows = 0
+            for column_num, (column, values) in enumerate(columns.items()):
+                if values.dtype.kind not in 'biufMS':
+                    raise ValueError('Column {} has unsupported dtype {}.'
+                                     .format(column, values.dtype))
+                np.save(os.path.join(tmp_path, '{}.npy'.format(column_num)),
+                        values)
+                num_rows = len(values)
+            with open(os.path.join(tmp_path, self.META_FILE), 'w') as meta:
+                json.dump({'columns': list(columns),
+                           'categories': categories,
+                           'num_rows': num_rows,
+                           'analysis_timestamp':
+                               analysis_timestamp.isoformat()}, meta)
+
+            # Re-saving a version (e.g. a retried analysis) replaces it
+            path = self.get_path(list_id, version)
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(tmp_path, path)
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        # Remove the oldest versions
+        for old_version in self.get_versions(list_id)[:-self.MAX_VERSIONS]:
+            shutil.rmtree(self.get_path(list_id, old_version),
+                          ignore_errors=True)
+        return version
+
+    def open(self, list_id, version=None):
+        """Memory-maps a version of a list's snapshot.
+
+        Args:
+            list_id: the list's unique MailChimp id.
+            version: the version to open. Defaults to the latest.
+
+        Returns:
+            A tuple containing the snapshot's metadata and an ordered
+                dictionary of read-only, memory-mapped column arrays,
+                or None if there's no such snapshot.
+        """
+        if version is None:
+            versions = self.get_versions(list_id)
+            if not versions:
+                return None
+            version = versions[-1]
+        path = self.get_path(list_id, version)
+        try:
+            with open(os.path.join(path, self.META_FILE)) as meta_file:
+                meta = json.load(meta_file)
+        except FileNotFoundError:
+            return None
+        columns = OrderedDict(
+            (column, np.load(os.path.join(path, '{}.npy'.format(column_num)),
+                             mmap_mode='r'))
+            for column_num, column in enumerate(meta['columns']))
+        return meta, columns
+
+    @staticmethod
+    def to_frame(meta, columns, start=0, stop=None):
+        """Reads rows of an opened snapshot into a dataframe.
+
+        Only the requested rows are read from disk, and they're copied
+        into memory, so the dataframe can be modified freely.
+
+        Args:
+            meta: see open().
+            columns: see open().
+            start: the first row to read.
+            stop: the row to stop reading at. Defaults to the last row.
+
+        Returns:
+            A pandas dataframe.
+        """
+        rows = OrderedDict()
+        for column, values in columns.items():
+            values = np.array(values[start:stop])
+            if column in meta['categories']:
+                values = pd.Categorical.from_codes(
+                    values, meta['categories'][column])
+            rows[column] = values
+
+        # Bytes columns need to be inserted separately
+        # Otherwise pandas converts them to objects
+        df = pd.DataFrame(OrderedDict( # pylint: disable=invalid-name
+            (column, values) for column, values in rows.items()
+            if values.dtype.kind != 'S'))
+        for column_num, (column, values) in enumerate(rows.items()):
+            if values.dtype.kind == 'S':
+                df.insert(column_num, column, values)
+        return df
+
+    def load(self, list_id, version=None):
+        """Loads a version of a list's snapshot.
+
+        Args:
+            list_id: see open().
+            version: see open().
+
+        Returns:
+            A tuple containing the member dataframe and the analysis
+                timestamp, or None if there's no such snapshot.
+        """
+        snapshot = self.open(list_id, version)
+        if snapshot is None:
+            return None
+        meta, columns = snapshot
+        return (self.to_frame(meta, columns),
+                iso8601.parse_date(meta['analysis_timestamp']))
+
+    def iter_chunks(self, list_id, chunk_size, version=None):
+        """Loads a version of a list's snapshot chunk by chunk.
+
+        Args:
+            list_id: see open().
+            chunk_size: the max number of rows per chunk.
+            version: see open().
+
+        Yields:
+            Member dataframes of up to chunk_size rows, in order. An
+                empty snapshot yields a single empty dataframe, and a
+                missing one yields nothing.
+        """
+        snapshot = self.open(list_id, version)
+        if snapshot is None:
+            return
+        meta, columns = snapshot
+        for start in range(0, max(meta['num_rows'], 1), chunk_size):
+            yield self.to_frame(meta, columns, start, start + chunk_size)
@@ -0,0 +1,225 @@
+"""This module contains an on-disk columnar store for very large lists."""
+import os
+import glob
+import time
+import shutil
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from app.snapshots import SnapshotStore
+
+class ColumnSpill():
+    """Spills chunks of columnar data to memory-mapped files on disk.
+
+    Used to analyze lists too large to hold in memory (see MailChimpList).
+    Each chunk is appended to one raw file per column as soon as it
+    arrives, in whatever order the chunks arrive, so only one chunk is
+    ever held in memory. Once every chunk has arrived, the columns are
+    copied into .npy files in chunk order and memory-mapped, after which
+    reading part of a column, e.g. a chunk of rows, only pages that part
+    in from disk.
+
+    The spill's directory is removed when the spill is closed, or garbage
+    collected. Spills left behind by worker processes which were killed,
+    e.g. for running out of memory, are removed by later spills.
+    """
+
+    # The number of rows read at a time when scanning a whole column
+    READ_CHUNK_SIZE = 100000
+
+    # Spills which weren't touched in this many seconds are assumed to have
+    # been left behind by a killed worker process, and are removed
+    MAX_AGE = 2 * 24 * 60 * 60
+
+    # The prefix of each spill's directory
+    PREFIX = 'benchmarks-spill-'
+
+    def __init__(self, dtypes, categories=None, directory=None):
+        """Initializes an empty spill.
+
+        Args:
+            dtypes: an ordered dictionary containing the numpy dtype of
+                each column, by name.
+            categories: a dictionary containing the categories of any
+                categorical columns, by name. Those columns hold codes,
+                see SnapshotStore.
+            directory: the directory to spill to. Defaults to the
+                SPILL_DIR environment variable, or the system's temporary
+                directory.
+
+        Other class variables:
+            tmp_dir: the spill's temporary directory.
+            chunks: a list of tuples, each containing a chunk's number,
+                its first row in the raw files and its number of rows, in
+                the order the chunks were appended.
+            num_rows: the total number of rows appended.
+            columns: an ordered dictionary containing the memory-mapped
+                column arrays, by name, once finish() has been called.
+            hash_index: the column indexed by find_rows(), along with its
+                sorted hashes and their rows.
+        """
+        self.dtypes = OrderedDict(
+            (column, np.dtype(dtype)) for column, dtype in dtypes.items())
+        self.categories = categories or {}
+        directory = (directory or os.environ.get('SPILL_DIR') or
+                     tempfile.gettempdir())
+        self.remove_abandoned_spills(directory)
+        self.tmp_dir = tempfile.TemporaryDirectory(
+            prefix=self.PREFIX, dir=directory)
+        self.chunks = []
+        self.num_rows = 0
+        self.columns = None
+        self.hash_index = None
+
+    @classmethod
+    def remove_abandoned_spills(cls, directory):
+        """Removes the spills in a directory which are older than MAX_AGE."""
+        oldest_mtime = time.time() - cls.MAX_AGE
+        for spill_dir in glob.glob(os.path.join(directory, cls.PREFIX + '*')):
+
+            # Another worker may be removing the same spill
+            try:
+                is_abandoned = os.path.getmtime(spill_dir) < oldest_mtime
+            except FileNotFoundError:
+                continue
+            if is_abandoned:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+
+    def get_path(self, column, extension):
+        """Returns the path of a column's file."""
+        return os.path.join(self.tmp_dir.name, '{}.{}'.format(
+            column, extension))
+
+    def append(self, chunk_num, chunk):
+        """Writes a chunk of rows to the end of the raw column files.
+
+        Args:
+            chunk_num: the position of the chunk. Used to put the rows in
+                order once every chunk has arrived.
+            chunk: a dictionary of column arrays of the same length.
+        """
+        num_rows = 0
+        for column, dtype in self.dtypes.items():
+            values = np.asarray(chunk[column], dtype=dtype)
+            num_rows = len(values)
+            with open(self.get_path(column, 'raw'), 'ab') as raw_file:
+                values.tofile(raw_file)
+        self.chunks.append((chunk_num, self.num_rows, num_rows))
+        self.num_rows += num_rows
+
+    def finish(self):
+        """Puts the appended rows in chunk order and memory-maps them.
+
+        Each column is copied chunk by chunk, so only one chunk of rows is
+        in memory at a time. The raw files are removed once copied.
+        """
+        self.columns = OrderedDict()
+        for column, dtype in self.dtypes.items():
+            raw_path = self.get_path(column, 'raw')
+            values = np.lib.format.open_memmap(
+                self.get_path(column, 'npy'), mode='w+', dtype=dtype,
+                shape=(self.num_rows,))
+            if self.num_rows:
+                raw_values = np.memmap(raw_path, dtype=dtype, mode='r')
+                row = 0
+                for _, start, num_rows in sorted(self.chunks):
+                    values[row:row + num_rows] = (
+                        raw_values[start:start + num_rows])
+                    row += num_rows
+                del raw_values
+            values.flush()
+            del values
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+            self.columns[column] = np.load(
+                self.get_path(column, 'npy'), mmap_mode='r')
+
+    def add_column(self, column, dtype, fill_value):
+        """Adds a writable, memory-mapped column to a finished spill.
+
+        Adding a column which already exists refills it.
+
+        Args:
+            column: the column's name.
+            dtype: the column's numpy dtype.
+            fill_value: the value to fill the column with.
+
+        Returns:
+            The column's array. Changes are written back to disk.
+        """
+        if column in self.columns and self.dtypes[column] == np.dtype(dtype):
+            values = self.columns[column]
+        else:
+            values = np.lib.format.open_memmap(
+                self.get_path(column, 'npy'), mode='w+', dtype=dtype,
+                shape=(self.num_rows,))
+            self.dtypes[column] = np.dtype(dtype)
+            self.columns[column] = values
+        values[:] = fill_value
+        return values
+
+    def iter_column(self, column):
+        """Yields a column READ_CHUNK_SIZE rows at a time."""
+        values = self.columns[column]
+        for start in range(0, self.num_rows, self.READ_CHUNK_SIZE):
+            yield values[start:start + self.READ_CHUNK_SIZE]
+
+    def find_rows(self, column, values):
+        """Looks up the rows holding values of a column, e.g. member ids.
+
+        An index of the values themselves, e.g. a pd.Index, would take
+        more memory than the column does. Instead, the column's 64-bit
+        hashes are sorted once, chunk by chunk (see pd.util.hash_array()),
+        and the values are found by binary search. Candidate rows are
+        checked against the column, so a hash collision can't match the
+        wrong row.
+
+        Args:
+            column: the column to look in. Its values must be unique.
+            values: an array of values, of the column's dtype.
+
+        Returns:
+            An int32 array containing the row of each value, or -1 where
+                the column doesn't contain the value.
+        """
+        if not self.num_rows:
+            return np.full(len(values), -1, dtype=np.int32)
+        if self.hash_index is None or self.hash_index[0] != column:
+            hashes = np.concatenate([
+                pd.util.hash_array(chunk.astype(object), categorize=False)
+                for chunk in self.iter_column(column)])
+            order = np.argsort(hashes).astype(np.int32)
+            self.hash_index = column, hashes[order], order
+        _, sorted_hashes, order = self.hash_index
+
+        values = np.asarray(values, dtype=self.dtypes[column])
+        hashes = pd.util.hash_array(values.astype(object), categorize=False)
+        positions = np.searchsorted(sorted_hashes, hashes).clip(
+            max=self.num_rows - 1)
+        rows = order[positions]
+        is_found = ((sorted_hashes[positions] == hashes) &
+                    (self.columns[column][rows] == values))
+        return np.where(is_found, rows, -1).astype(np.int32) # pylint: disable=no-member
+
+    def iter_frames(self, chunk_size):
+        """Reads a finished spill into dataframes chunk by chunk.
+
+        Args:
+            chunk_size: the max number of rows per dataframe.
+
+        Yields:
+            Dataframes of up to chunk_size rows, in order, with categorical
+                columns decoded. An empty spill yields a single empty
+                dataframe.
+        """
+        meta = {'categories': self.categories}
+        for start in range(0, max(self.num_rows, 1), chunk_size):
+            yield SnapshotStore.to_frame(
+                meta, self.columns, start, start + chunk_size)
+
+    def close(self):
+        """Removes the spill's files."""
+        self.columns = None
+        self.hash_index = None
+        self.tmp_dir.cleanup()
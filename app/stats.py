@@ -0,0 +1,174 @@
+"""This module handles calculating the statistics of email lists."""
+from collections import OrderedDict
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import iso8601
+from app.members import MemberBuffer
+
+class ListStatsMixin(): # pylint: disable=too-many-instance-attributes
+    """Calculates a MailChimp list's statistics.
+
+    Mixed into MailChimpList, which holds the members the statistics are
+    calculated from.
+    """
+
+    # The boundaries of the deciles used for the open rate histogram
+    HIST_BIN_BOUNDARIES = np.linspace(0, 1, num=11)
+
+    # Subscribers with an open rate above this are considered highly engaged
+    HIGH_OPEN_RATE = 0.8
+
+    # The number of members aggregated at a time when computing stats
+    # Out of core, only this many rows of each column are paged in at once
+    STATS_CHUNK_SIZE = 100000
+
+    def iter_member_chunks(self, *columns):
+        """Yields columns of the list's members chunk by chunk.
+
+        Statistics are aggregated over these chunks. Out of core, each
+        chunk holds STATS_CHUNK_SIZE members, so only that many rows of
+        each spilled column are in memory at a time. Otherwise, the whole
+        list is a single chunk.
+
+        Args:
+            columns: the names of the columns. The member status is given
+                as codes, see get_status_codes().
+
+        Yields:
+            Lists containing a chunk of each column's array.
+        """
+        arrays = [self.get_status_codes() if column == 'status'
+                  else self.get_column(column) for column in columns]
+        num_rows = len(arrays[0])
+        chunk_size = (self.STATS_CHUNK_SIZE if self.spill is not None
+                      else max(num_rows, 1))
+        for start in range(0, num_rows, chunk_size):
+            yield [array[start:start + chunk_size] for array in arrays]
+
+    def calc_open_rate(self, open_rate):
+        """Calculates the open rate as a decimal."""
+        self.open_rate = float(open_rate) / 100
+
+    def calc_frequency(self, date_created, campaign_count):
+        """Calculates the average number of days per campaign sent. Automatically
+        zero if fewer than 10 campaigns have been sent total."""
+        campaign_count = int(campaign_count)
+        if campaign_count < 10:
+            self.frequency = 0
+        else:
+            now = datetime.now(timezone.utc)
+            created = (iso8601.parse_date(date_created)
+                       if isinstance(date_created, str)
+                       else date_created)
+            list_age = now - created
+            self.frequency = list_age.days / campaign_count
+
+    @classmethod
+    def bin_open_rates(cls, open_rates):
+        """Counts the open rates falling into each decile.
+
+        Each bin includes its upper boundary, and the first bin also
+        includes zero, i.e. the same bins as pd.cut(include_lowest=True).
+        Missing open rates are ignored.
+
+        Args:
+            open_rates: a numpy array of open rates.
+
+        Returns:
+            A list containing the number of open rates in each decile.
+        """
+        open_rates = open_rates[~np.isnan(open_rates)]
+
+        # Compare at the open rates' own precision
+        # Otherwise e.g. a float32 0.1 would fall into the second decile
+        boundaries = cls.HIST_BIN_BOUNDARIES.astype(open_rates.dtype)
+        bin_indices = (np.searchsorted(
+            boundaries, open_rates, side='left') - 1).clip(min=0)
+        bin_counts = np.bincount(bin_indices, minlength=len(boundaries) - 1)
+        return [int(bin_count) for bin_count in bin_counts]
+
+    @classmethod
+    def count_high_open_rates(cls, open_rates):
+        """Counts the open rates exceeding HIGH_OPEN_RATE.
+
+        Args:
+            open_rates: a numpy array of open rates. Missing open rates
+                are ignored.
+        """
+        open_rates = open_rates[~np.isnan(open_rates)]
+        return int(np.count_nonzero(
+            open_rates > open_rates.dtype.type(cls.HIGH_OPEN_RATE)))
+
+    def compute_all_stats(self, open_rate, date_created, campaign_count):
+        """Calculates every list statistic in a single vectorized pass.
+
+        Only touches each member column once. The stats are aggregated
+        chunk by chunk (see iter_member_chunks()).
+
+        Args:
+            open_rate: see calc_open_rate().
+            date_created: see calc_frequency().
+            campaign_count: see calc_frequency().
+
+        Returns:
+            An OrderedDict containing the list's stats, keyed by the
+            corresponding ListStats column name.
+        """
+        self.calc_open_rate(open_rate)
+        self.calc_frequency(date_created, campaign_count)
+
+        # Count the members with each status, the subscribers' open
+        # rates in each decile, the highly engaged subscribers and the
+        # recent opens
+        status_counts = np.zeros(len(MemberBuffer.STATUSES), dtype=np.int64)
+        hist_bin_counts = np.zeros(len(self.HIST_BIN_BOUNDARIES) - 1,
+                                   dtype=np.int64)
+        high_open_rates = 0
+        recent_opens = 0
+        for status_codes, open_rates, chunk_recent_opens in (
+                self.iter_member_chunks(
+                    'status', 'avg_open_rate', 'recent_open')):
+            status_counts += np.bincount(
+                status_codes[status_codes >= 0],
+                minlength=len(MemberBuffer.STATUSES))
+
+            # Select the subscribers' open rates once per chunk
+            sub_open_rates = open_rates[
+                status_codes == MemberBuffer.STATUS_CODES['subscribed']]
+            hist_bin_counts += self.bin_open_rates(sub_open_rates)
+            high_open_rates += self.count_high_open_rates(sub_open_rates)
+            recent_opens += int(np.count_nonzero(
+                pd.notnull(chunk_recent_opens)))
+
+        status_pcts = dict(zip(MemberBuffer.STATUSES,
+                               status_counts / self.count))
+        self.subscribed_pct = float(status_pcts['subscribed'])
+        self.unsubscribed_pct = float(status_pcts['unsubscribed'])
+        self.cleaned_pct = float(status_pcts['cleaned'])
+        self.pending_pct = float(status_pcts['pending'])
+        self.subscribers = int(status_counts[
+            MemberBuffer.STATUS_CODES['subscribed']])
+        self.hist_bin_counts = hist_bin_counts.tolist()
+
+        # Share of subscribers who are highly engaged, or who haven't
+        # opened an email within the past year
+        cur_yr_inactive_subs = self.subscribers - recent_opens
+        self.high_open_rt_pct = (
+            high_open_rates / self.subscribers
+            if self.subscribers else 0)
+        self.cur_yr_inactive_pct = (
+            cur_yr_inactive_subs / self.subscribers
+            if self.subscribers else 0)
+
+        return OrderedDict([
+            ('frequency', self.frequency),
+            ('subscribers', self.subscribers),
+            ('open_rate', self.open_rate),
+            ('hist_bin_counts', self.hist_bin_counts),
+            ('subscribed_pct', self.subscribed_pct),
+            ('unsubscribed_pct', self.unsubscribed_pct),
+            ('cleaned_pct', self.cleaned_pct),
+            ('pending_pct', self.pending_pct),
+            ('high_open_rt_pct', self.high_open_rt_pct),
+            ('cur_yr_inactive_pct', self.cur_yr_inactive_pct)])
@@ -3,21 +3,24 @@ import os
 import json
 import time
 import calendar
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 import requests
 import pandas as pd
 import numpy as np
 from sqlalchemy import desc
+from celery import chord
 from celery.utils.log import get_task_logger
 from app import celery, db
+from app.checkpoints import ImportCheckpoint
 from app.emails import send_email
 from app.lists import MailChimpList, MailChimpImportError, do_async_import
 from app.models import EmailList, ListStats
 from app.dbops import associate_user_with_list
+from app.scheduling import ListUpdateScheduler
 from app.visualizations import (
     draw_bar, draw_stacked_horizontal_bar, draw_histogram, draw_donuts)
 
-@celery.task
+@celery.task(ignore_result=True)
 def send_activated_email(user_email, user_email_hash):
     """Sends an email telling a user that they've been authorized.
 
@@ -31,14 +34,26 @@ def send_activated_email(user_email, user_email_hash):
                {'title': 'You\'re all set to access our benchmarks!',
                 'email_hash': user_email_hash})
 
-def import_analyze_store_list(list_data, org_id, user_email=None):
+def import_analyze_store_list(list_data, org_id, user_email=None, run_id=None):
     """Imports a MailChimp list, performs calculations, and stores results.
 
+    If list_data requests an incremental analysis and the list has a
+    snapshot from a previous analysis, only imports opens since then,
+    unless the list is large enough to be analyzed out of core (see
+    MailChimpList). Stored lists' member dataframes are snapshotted for future
+    incremental analyses. Members spilled to disk by an out-of-core
+    analysis are removed once the analysis ends, whether or not it
+    succeeded.
+
     Args:
-        list_data: see init_list_analysis().
+        list_data: see init_list_analysis(). May also set incremental to
+            True (see update_stored_data()).
         org_id: the unique id of the organization associated with the list.
         user_email: the user's email address. Only passed when the user
             requested the analysis (as opposed to Celery Beat).
+        run_id: a unique id for the import, e.g. the Celery task id. If
+            passed, the import is checkpointed so that a retry with the
+            same id picks up where it left off (see MailChimpList).
 
     Returns:
         A dictionary containing analysis results for the list.
@@ -51,15 +66,70 @@ def import_analyze_store_list(list_data, org_id, user_email=None):
     # Create a new list instance and import member data/activity
     mailing_list = MailChimpList(
         list_data['list_id'], list_data['total_count'], list_data['key'],
-        list_data['data_center'])
+        list_data['data_center'], list_data.get('activity_strategy'),
+        list_data.get('import_backend'), run_id)
+    try:
+        return analyze_store_list(mailing_list, list_data, org_id, user_email)
+    finally:
+
+        # Remove any members spilled to disk, even if the analysis failed
+        mailing_list.close()
+
+def analyze_store_list(mailing_list, list_data, org_id, user_email=None):
+    """Imports a list's members and activity, performs calculations, and
+    stores results.
+
+    See import_analyze_store_list().
+
+    Args:
+        mailing_list: the MailChimpList to analyze.
+        list_data: see import_analyze_store_list().
+        org_id: see import_analyze_store_list().
+        user_email: see import_analyze_store_list().
+
+    Returns:
+        A dictionary containing analysis results for the list.
+
+    Throws:
+        MailChimpImportError: an error resulting from a
+            MailChimp API problem.
+    """
+
+    logger = get_task_logger(__name__)
+
+    # Members who change from now on will be picked up by the next update
+    analysis_timestamp = datetime.now(timezone.utc)
+
+    # Load the previous analysis' members, if we're updating incrementally
+    # Lists analyzed out of core are always imported in full, since an
+    # incremental update loads the whole snapshot into memory
+    snapshot = None
+    if list_data.get('incremental'):
+        if mailing_list.out_of_core:
+            logger.info('List %s is analyzed out of core. Importing it in '
+                        'full.', mailing_list.id)
+        else:
+            snapshot = mailing_list.load_snapshot()
+
+            # E.g. the snapshot was saved on another machine
+            if snapshot is None:
+                logger.warning('No snapshot of list %s found (see '
+                               'SNAPSHOT_DIR). Importing it in full.',
+                               mailing_list.id)
 
     try:
 
-        # Import basic list data
-        do_async_import(mailing_list.import_list_members())
+        if snapshot:
+
+            # Import only the opens since the previous analysis
+            snapshot_df, last_analyzed = snapshot
+            do_async_import(mailing_list.update_members(snapshot_df))
+            do_async_import(mailing_list.update_recent_activity(last_analyzed))
 
-        # Import the subscriber activity as well, and merge
-        do_async_import(mailing_list.import_sub_activity())
+        else:
+
+            # Import basic list data and the subscriber activity, and merge
+            do_async_import(mailing_list.import_members_and_activity())
 
     except MailChimpImportError as e: # pylint: disable=invalid-name
         if user_email:
@@ -71,30 +141,22 @@ def import_analyze_store_list(list_data, org_id, user_email=None):
                  'error_details': e.error_details})
         raise
 
+    # The import succeeded, so its checkpoints are no longer needed
+    if mailing_list.checkpoint:
+        mailing_list.checkpoint.clear()
+
     # Remove nested jsons from the dataframe
     mailing_list.flatten()
 
     # Do the data science shit
-    mailing_list.calc_list_breakdown()
-    mailing_list.calc_open_rate(list_data['open_rate'])
-    mailing_list.calc_frequency(list_data['creation_timestamp'],
-                                list_data['campaign_count'])
-    mailing_list.calc_histogram()
-    mailing_list.calc_high_open_rate_pct()
-    mailing_list.calc_cur_yr_stats()
+    stats = mailing_list.compute_all_stats(
+        list_data['open_rate'], list_data['creation_timestamp'],
+        list_data['campaign_count'])
 
     # Create a set of stats
     list_stats = ListStats(
-        frequency=mailing_list.frequency,
-        subscribers=mailing_list.subscribers,
-        open_rate=mailing_list.open_rate,
-        hist_bin_counts=json.dumps(mailing_list.hist_bin_counts),
-        subscribed_pct=mailing_list.subscribed_pct,
-        unsubscribed_pct=mailing_list.unsubscribed_pct,
-        cleaned_pct=mailing_list.cleaned_pct,
-        pending_pct=mailing_list.pending_pct,
-        high_open_rt_pct=mailing_list.high_open_rt_pct,
-        cur_yr_inactive_pct=mailing_list.cur_yr_inactive_pct,
+        **{k: (json.dumps(v) if k == 'hist_bin_counts' else v)
+           for k, v in stats.items()},
         list_id=list_data['list_id'])
 
     # If the user gave their permission, store the stats in the database
@@ -109,6 +171,7 @@ def import_analyze_store_list(list_data, org_id, user_email=None):
             data_center=list_data['data_center'],
             store_aggregates=list_data['store_aggregates'],
             monthly_updates=list_data['monthly_updates'],
+            activity_strategy=list_data.get('activity_strategy'),
             org_id=org_id)
         email_list = db.session.merge(email_list)
 
@@ -119,6 +182,9 @@ def import_analyze_store_list(list_data, org_id, user_email=None):
             db.session.rollback()
             raise
 
+        # Keep the members for the next incremental update
+        mailing_list.save_snapshot(analysis_timestamp)
+
     return list_stats
 
 def generate_summary_stats(list_stats_objects):
@@ -358,31 +424,57 @@ def extract_stats(list_object):
              'cur_yr_inactive_pct': list_object.cur_yr_inactive_pct}
     return stats
 
-@celery.task
-def init_list_analysis(user_data, list_data, org_id):
+@celery.task(bind=True, max_retries=2, default_retry_delay=60,
+             ignore_result=True)
+def init_list_analysis(self, user_data, list_data, org_id):
     """Celery task wrapper for each stage of analyzing a list.
 
     First checks if there is a recently cached analysis/analyses,
     i.e. already in the database. If not, calls import_analyze_store_list()
     to generate the ListStats (and an associated EmailList, if the user
-    gave permission to store their data). Next updates the user's privacy options
+    gave permission to store their data). If the import fails, the task is
+    retried, resuming the import from its checkpoints. The user is only
+    emailed about the failure once the retries run out. Next updates the
+    user's privacy options
     (e.g. store_aggregates, monthly_updates) if the list was
     cached. Then checks if the user selected monthly updates, if so,
     create the relationship. Finally, generates a benchmarking
     report with the stats.
 
     Args:
+        self: the task instance.
         user_data: a dictionary containing information about the user.
         list_data: a dictionary containing information about the list.
+            Includes the list's activity_strategy, which is stored with
+            the list, and may optionally specify its import_backend (see
+            MailChimpList).
         org_id: the id of the organization associated with the list.
     """
 
     # Try to pull the two most recent ListStats records from the database
     # Otherwise generate one
-    analyses = (ListStats.query.filter_by(
+    analyses = ListStats.query.filter_by(
         list_id=list_data['list_id']).order_by(desc(
-            'analysis_timestamp')).limit(2).all() or [
-                import_analyze_store_list(list_data, org_id, user_data['email'])])
+            'analysis_timestamp')).limit(2).all()
+    if not analyses:
+        final_attempt = self.request.retries >= self.max_retries
+
+        # A retry may run on another machine than the failed attempt
+        if self.request.retries and not ImportCheckpoint.has_parts(
+                list_data['list_id'], self.request.id):
+            logger = get_task_logger(__name__)
+            logger.warning('No checkpoints from earlier attempts to import '
+                           'list %s found (see CHECKPOINT_DIR). Importing it '
+                           'from the start.', list_data['list_id'])
+        try:
+            analyses = [import_analyze_store_list(
+                list_data, org_id,
+                user_data['email'] if final_attempt else None,
+                run_id=self.request.id)]
+        except MailChimpImportError as e: # pylint: disable=invalid-name
+            if final_attempt:
+                raise
+            raise self.retry(exc=e)
 
     # If the user chose to store their data, there will be an associated
     # EmailList object
@@ -391,11 +483,15 @@ def init_list_analysis(user_data, list_data, org_id):
 
     if list_object:
 
-        # Update the privacy options if they differ from previous selection
+        # Update the privacy and import options if they differ from
+        # previous selection
         if (list_object.monthly_updates != list_data['monthly_updates']
-                or list_object.store_aggregates != list_data['store_aggregates']):
+                or list_object.store_aggregates != list_data['store_aggregates']
+                or list_object.activity_strategy != list_data.get(
+                    'activity_strategy')):
             list_object.monthly_updates = list_data['monthly_updates']
             list_object.store_aggregates = list_data['store_aggregates']
+            list_object.activity_strategy = list_data.get('activity_strategy')
             list_object = db.session.merge(list_object)
             try:
                 db.session.commit()
@@ -413,10 +509,22 @@ def init_list_analysis(user_data, list_data, org_id):
     send_report(list_stats, agg_stats, list_data['list_id'],
                 list_data['list_name'], [user_data['email']])
 
-@celery.task
+@celery.task(ignore_result=True)
 def update_stored_data():
     """Celery task which goes through the database
-    and generates a new set of calculations for each list older than 30 days.
+    and generates a new set of calculations for each list due for an update.
+
+    Lists are due 30 days after their last analysis, and may be updated
+    up to a week early to even out the nightly load (see
+    ListUpdateScheduler).
+
+    Dispatches a separate update_stored_list() task per list, so lists are
+    updated in parallel across Celery workers and one slow list doesn't
+    hold up the others. The tasks are grouped in a chord, whose callback
+    (finish_stored_data_update()) reports any lists which failed to update.
+
+    Lists are updated incrementally where possible, i.e. only opens since
+    the previous analysis are imported.
 
     This task is called by Celery Beat, see the schedule in config.py.
     """
@@ -431,89 +539,142 @@ def update_stored_data():
         logger.warning('No lists in the database!')
         return
 
-    # Create a list of analyses which are more than 30 days old
-    now = datetime.now(timezone.utc)
-    one_month_ago = now - timedelta(days=30)
-    analyses_to_update = [
-        analysis for analysis in list_analyses
-        if (analysis.analysis_timestamp.replace(
-            tzinfo=timezone.utc)) < one_month_ago]
+    # Pick the lists to update tonight, spreading the updates out
+    # So that roughly the same amount of work is done every night
+    scheduler = ListUpdateScheduler(list_analyses, datetime.now(timezone.utc))
+    analyses_to_update = scheduler.schedule()
 
     if not analyses_to_update:
         logger.info('No old lists to update!')
         return
 
-    logger.info('Updating the following lists: %s!', analyses_to_update)
-
-    # Placeholder for lists which failed during the update process
-    failed_updates = []
-
-    # Update each list's calculations in sequence
-    for analysis in analyses_to_update:
-
-        logger.info('Updating list %s!', analysis.list_id)
-
-        # Get the list object associated with the analysis
-        associated_list_object = analysis.list
-
-        # Pull information about the list from the API
-        # This may have changed since we originally pulled the list data
-        request_uri = ('https://{}.api.mailchimp.com/3.0/lists/{}'.format(
-            associated_list_object.data_center,
-            associated_list_object.list_id))
-        params = (
-            ('fields', 'stats.member_count,'
-                       'stats.unsubscribe_count,'
-                       'stats.cleaned_count,'
-                       'stats.open_rate,'
-                       'stats.campaign_count'),
-        )
-        response = requests.get(
-            request_uri, params=params,
-            auth=('shorenstein', associated_list_object.api_key))
-        response_body = response.json()
-
-        # If we can't extract a stats object, then the API key isn't working
-        try:
-            response_stats = response_body['stats']
-        except KeyError:
-            logger.exception(
-                'Error updating list %s. API key is no longer valid '
-                'or list no longer exists.', analysis.list_id)
-            failed_updates.append(analysis.list_id)
-            continue
-
-        count = (response_stats['member_count'] +
-                 response_stats['unsubscribe_count'] +
-                 response_stats['cleaned_count'])
-
-        # Create a dictionary of list data
-        list_data = {'list_id': analysis.list_id,
-                     'list_name': associated_list_object.list_name,
-                     'key': associated_list_object.api_key,
-                     'data_center': associated_list_object.data_center,
-                     'monthly_updates': associated_list_object.monthly_updates,
-                     'store_aggregates': associated_list_object.store_aggregates,
-                     'total_count': count,
-                     'open_rate': response_stats['open_rate'],
-                     'creation_timestamp': associated_list_object.creation_timestamp,
-                     'campaign_count': response_stats['campaign_count']}
-
-        # Then re-run the calculations and update the database
-        try:
-            import_analyze_store_list(list_data, associated_list_object.org_id)
-            logger.info('Finished updating list %s!', analysis.list_id)
-        except MailChimpImportError:
-            logger.error('Error importing new data for list %s.', analysis.list_id)
-            failed_updates.append(analysis.list_id)
+    logger.info('Updating the following lists: %s! (Estimated cost %d '
+                'requests, daily budget %d requests.)', analyses_to_update,
+                sum(scheduler.costs[analysis.list_id]
+                    for analysis in analyses_to_update),
+                scheduler.daily_budget)
+
+    # Update each list's calculations in parallel, most costly first
+    # Then collect the lists which failed during the update process
+    chord(update_stored_list.s(analysis.list_id)
+          for analysis in analyses_to_update)(
+              finish_stored_data_update.s())
+
+@celery.task
+def update_stored_list(list_id):
+    """Celery task which generates a new set of calculations for a list.
+
+    Dispatched by update_stored_data(). Errors are logged rather than
+    raised, since if one of the chord's tasks fails, its callback never
+    runs and none of the night's failed lists are reported.
+
+    Args:
+        list_id: the list's unique MailChimp id.
 
-    # If any updates failed, raise an exception to send an error email
+    Returns:
+        The list's id if it failed to update, otherwise None.
+    """
+    logger = get_task_logger(__name__)
+    try:
+        return refresh_stored_list(list_id)
+    except Exception: # pylint: disable=broad-except
+        logger.exception('Error updating list %s.', list_id)
+        return list_id
+
+def refresh_stored_list(list_id):
+    """Generates a new set of calculations for a list in the database.
+
+    See update_stored_list().
+
+    Args:
+        list_id: the list's unique MailChimp id.
+
+    Returns:
+        The list's id if it failed to update, otherwise None.
+    """
+    logger = get_task_logger(__name__)
+    logger.info('Updating list %s!', list_id)
+
+    # Get the list object
+    list_object = EmailList.query.filter_by(list_id=list_id).first()
+    if not list_object:
+        logger.error('Error updating list %s. List no longer exists in the '
+                     'database.', list_id)
+        return list_id
+
+    # Pull information about the list from the API
+    # This may have changed since we originally pulled the list data
+    request_uri = ('https://{}.api.mailchimp.com/3.0/lists/{}'.format(
+        list_object.data_center, list_object.list_id))
+    params = (
+        ('fields', 'stats.member_count,'
+                   'stats.unsubscribe_count,'
+                   'stats.cleaned_count,'
+                   'stats.open_rate,'
+                   'stats.campaign_count'),
+    )
+    response = requests.get(
+        request_uri, params=params,
+        auth=('shorenstein', list_object.api_key))
+    response_body = response.json()
+
+    # If we can't extract a stats object, then the API key isn't working
+    try:
+        response_stats = response_body['stats']
+    except KeyError:
+        logger.exception(
+            'Error updating list %s. API key is no longer valid '
+            'or list no longer exists.', list_id)
+        return list_id
+
+    count = (response_stats['member_count'] +
+             response_stats['unsubscribe_count'] +
+             response_stats['cleaned_count'])
+
+    # Create a dictionary of list data
+    list_data = {'list_id': list_id,
+                 'list_name': list_object.list_name,
+                 'key': list_object.api_key,
+                 'data_center': list_object.data_center,
+                 'monthly_updates': list_object.monthly_updates,
+                 'store_aggregates': list_object.store_aggregates,
+                 'activity_strategy': list_object.activity_strategy,
+                 'total_count': count,
+                 'open_rate': response_stats['open_rate'],
+                 'creation_timestamp': list_object.creation_timestamp,
+                 'campaign_count': response_stats['campaign_count'],
+                 'incremental': True}
+
+    # Then re-run the calculations and update the database
+    try:
+        import_analyze_store_list(list_data, list_object.org_id)
+    except MailChimpImportError:
+        logger.error('Error importing new data for list %s.', list_id)
+        return list_id
+    logger.info('Finished updating list %s!', list_id)
+    return None
+
+@celery.task(ignore_result=True)
+def finish_stored_data_update(results):
+    """Celery task which reports the lists that failed to update.
+
+    Called back once every update_stored_list() task dispatched by
+    update_stored_data() has finished.
+
+    Args:
+        results: the return values of the update_stored_list() tasks.
+
+    Throws:
+        MailChimpImportError: some lists failed to update. Raised so that
+            an error email is sent.
+    """
+    failed_updates = [list_id for list_id in results if list_id]
     if failed_updates:
         raise MailChimpImportError(
             'Some lists failed to update: {}'.format(failed_updates),
             failed_updates)
 
-@celery.task
+@celery.task(ignore_result=True)
 def send_monthly_reports():
     """Celery task which sends monthly benchmarking reports
     to each user who requested one.
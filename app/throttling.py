@@ -0,0 +1,353 @@
+"""This module contains tools for pacing requests to the MailChimp API."""
+import os
+import time
+import random
+import asyncio
+import hashlib
+import tempfile
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None # pylint: disable=invalid-name
+
+class AdaptiveConcurrencyLimiter():
+    """Limits the number of concurrent requests, adapting the limit over time.
+
+    Works like an asyncio semaphore whose size follows an AIMD (additive
+    increase, multiplicative decrease) scheme. Each fast, successful
+    response grows the limit by 1 / limit, i.e. by roughly one slot per
+    round of requests. A response which signals that the API is congested
+    (see CONGESTION_STATUS_CODES), a request which fails without a response,
+    or a latency spike shrinks the limit by BACKOFF_RATIO.
+    """
+
+    # Responses with these status codes mean we're making too many requests
+    CONGESTION_STATUS_CODES = (429, 504)
+
+    # A response which takes this many times longer than the typical
+    # response is treated as a sign of congestion
+    LATENCY_SPIKE_RATIO = 2
+
+    # The weight given to each new latency in the typical latency
+    # (an exponentially weighted moving average)
+    LATENCY_SMOOTHING = 0.2
+
+    # The factor by which to shrink the limit when backing off
+    BACKOFF_RATIO = 0.5
+
+    def __init__(self, initial_limit, max_limit, min_limit=1):
+        """Initializes the limiter.
+
+        Args:
+            initial_limit: the number of concurrent requests to start with.
+            max_limit: the maximum number of concurrent requests.
+            min_limit: the minimum number of concurrent requests.
+
+        Other class variables:
+            limit: the current (fractional) number of concurrent requests
+                allowed. Only whole slots can be acquired.
+            in_flight: the number of slots currently acquired.
+            typical_latency: the moving average latency of successful
+                requests in seconds.
+            last_backoff: the time at which the limit was last shrunk.
+                Requests sent before this time can't shrink it again,
+                as they were sent at the old limit.
+        """
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self.typical_latency = None
+        self.last_backoff = None
+        self.slot_released = asyncio.Condition()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.release()
+
+    async def acquire(self):
+        """Waits until a slot is free, then takes it."""
+        async with self.slot_released:
+            await self.slot_released.wait_for(
+                lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        """Frees a slot taken with acquire()."""
+        async with self.slot_released:
+            self.in_flight -= 1
+            self.slot_released.notify_all()
+
+    def record(self, started, status):
+        """Adjusts the limit according to the outcome of a request.
+
+        Args:
+            started: the time (per time.monotonic()) at which the request
+                was sent.
+            status: the HTTP status code of the response, or None if the
+                request failed without a response, e.g. it timed out.
+        """
+        latency = time.monotonic() - started
+
+        # Back off if the API is struggling
+        if status is None or status in self.CONGESTION_STATUS_CODES:
+            self.back_off(started)
+            return
+
+        # Other errors, e.g. a 404, say nothing about congestion
+        if not 200 <= status < 300:
+            return
+
+        # Back off if the response was unusually slow
+        # Otherwise try allowing another request
+        is_spike = (self.typical_latency is not None and latency >
+                    self.typical_latency * self.LATENCY_SPIKE_RATIO)
+        self.typical_latency = (
+            latency if self.typical_latency is None
+            else self.typical_latency + self.LATENCY_SMOOTHING * (
+                latency - self.typical_latency))
+        if is_spike:
+            self.back_off(started)
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+    def back_off(self, started):
+        """Shrinks the limit, at most once per round of requests.
+
+        Args:
+            started: see record().
+        """
+        if self.last_backoff is not None and started < self.last_backoff:
+            return
+        self.limit = max(self.limit * self.BACKOFF_RATIO, self.min_limit)
+        self.last_backoff = time.monotonic()
+
+class RetryPolicy():
+    """Decides whether and when to retry failed requests.
+
+    Delays follow the "decorrelated jitter" scheme: each delay is drawn at
+    random between the base delay and three times the previous delay, up
+    to a maximum. Randomizing the delays keeps concurrent requests which
+    failed together from retrying together. A delay asked for by the API
+    via a Retry-After header is always honored. The policy is shared by
+    all of an import's requests, which together can retry retry_budget
+    times, plus retry_ratio times per request. So sporadic failures are
+    retried however large the import, but an import against an API which
+    is down fails quickly instead of retrying every request.
+    """
+
+    def __init__(self, retryable_status_codes, max_retries, # pylint: disable=too-many-arguments
+                 base_delay, max_delay, retry_budget, retry_ratio=0):
+        """Initializes the policy.
+
+        Args:
+            retryable_status_codes: the HTTP status codes worth retrying.
+                Requests which fail without a response are always worth
+                retrying.
+            max_retries: the max number of times to retry a single request.
+            base_delay: the minimum number of seconds to wait before
+                retrying.
+            max_delay: the maximum number of seconds to wait before
+                retrying, unless the API asks for longer.
+            retry_budget: the number of retries across all requests,
+                however few requests there are.
+            retry_ratio: the number of retries added to the budget by each
+                request, e.g. 0.1 to allow one retry per ten requests.
+
+        Other class variables:
+            retries_left: the number of retries left in the budget. Only
+                whole retries can be used.
+        """
+        self.retryable_status_codes = retryable_status_codes
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_ratio = retry_ratio
+        self.retries_left = retry_budget
+
+    def record_request(self):
+        """Adds a new request's share of retries to the budget."""
+        self.retries_left += self.retry_ratio
+
+    def should_retry(self, retries, status):
+        """Decides whether to retry a failed request, using up the budget.
+
+        Args:
+            retries: the number of times the request was already retried.
+            status: the HTTP status code of the response, or None if the
+                request failed without a response.
+
+        Returns:
+            True if the request should be retried.
+        """
+        if (retries >= self.max_retries or self.retries_left < 1 or
+                (status is not None and
+                 status not in self.retryable_status_codes)):
+            return False
+        self.retries_left -= 1
+        return True
+
+    def get_delay(self, previous_delay, retry_after=None):
+        """Calculates how long to wait before retrying.
+
+        Args:
+            previous_delay: the delay before the last retry of the request,
+                or None if this is the first retry.
+            retry_after: the value of the response's Retry-After header,
+                if any.
+
+        Returns:
+            The number of seconds to wait.
+        """
+        upper_bound = (previous_delay or self.base_delay) * 3
+        delay = min(random.uniform(self.base_delay, upper_bound),
+                    self.max_delay)
+        requested_delay = self.parse_retry_after(retry_after)
+        if requested_delay is not None:
+            delay = max(delay, requested_delay)
+        return delay
+
+    @staticmethod
+    def parse_retry_after(retry_after):
+        """Parses a Retry-After header.
+
+        Args:
+            retry_after: the header's value, either a number of seconds or
+                an HTTP date.
+
+        Returns:
+            The number of seconds to wait, or None if the header is missing
+                or malformed.
+        """
+        if retry_after is None:
+            return None
+        try:
+            return max(float(retry_after), 0)
+        except (TypeError, ValueError):
+            pass
+        try:
+            retry_date = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if retry_date.tzinfo is None:
+            retry_date = retry_date.replace(tzinfo=timezone.utc)
+        return max((retry_date - datetime.now(timezone.utc)).total_seconds(),
+                   0)
+
+class ApiKeyConnectionSlots():
+    """Limits concurrent connections per API key across processes.
+
+    Each API key has a fixed number of slots, each backed by a lock file in
+    a directory shared by all workers on the machine. Holding a connection
+    means holding an exclusive lock on one of the key's slot files. The
+    operating system releases the locks of a worker which dies, so slots
+    can't leak. Where file locking isn't available (i.e. Windows), slots
+    are always free.
+    """
+
+    # The number of seconds to wait before checking for a free slot again
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, api_key, num_slots, directory=None):
+        """Initializes the slots.
+
+        Args:
+            api_key: the API key the slots are for.
+            num_slots: the number of connections which may use the key at
+                once.
+            directory: the directory to keep the slot files in. Defaults
+                to the CONNECTION_SLOTS_DIR environment variable, or a
+                folder in the system's temporary directory.
+
+        Other class variables:
+            slot_paths: the paths of the slot files. The API key is hashed
+                so it doesn't show up in file names.
+        """
+        self.num_slots = num_slots
+        directory = (directory or os.environ.get('CONNECTION_SLOTS_DIR') or
+                     os.path.join(tempfile.gettempdir(),
+                                  'benchmarks-connection-slots'))
+        key_hash = hashlib.md5(api_key.encode()).hexdigest()
+        self.slot_paths = [
+            os.path.join(directory, '{}-{}.lock'.format(key_hash, slot_num))
+            for slot_num in range(num_slots)]
+        if fcntl is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def try_acquire(self):
+        """Takes a free slot, if there is one.
+
+        Returns:
+            A file descriptor holding the slot's lock, -1 if file locking
+            isn't available, or None if every slot is taken.
+        """
+        if fcntl is None:
+            return -1
+        for slot_path in self.slot_paths:
+            slot_fd = os.open(slot_path, os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(slot_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_fd
+            except BlockingIOError:
+                os.close(slot_fd)
+        return None
+
+    async def acquire(self):
+        """Waits until a slot is free, then takes it.
+
+        Returns:
+            See try_acquire().
+        """
+        slot_fd = self.try_acquire()
+        while slot_fd is None:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            slot_fd = self.try_acquire()
+        return slot_fd
+
+    @staticmethod
+    def release(slot_fd):
+        """Frees a slot taken with acquire().
+
+        Args:
+            slot_fd: the value returned by acquire().
+        """
+        if slot_fd == -1:
+            return
+        fcntl.flock(slot_fd, fcntl.LOCK_UN)
+        os.close(slot_fd)
+
+    def slot(self):
+        """Returns an async context manager which holds a slot."""
+        return HeldConnectionSlot(self)
+
+class HeldConnectionSlot():
+    """An async context manager holding one of an API key's slots.
+
+    Other class variables:
+        acquired_at: the time (per time.monotonic()) at which the slot was
+            taken, or None until then. Requests are timed from here, so
+            waiting for a slot doesn't count towards their latency.
+    """
+
+    def __init__(self, slots):
+        """Initializes the context manager.
+
+        Args:
+            slots: the ApiKeyConnectionSlots to take the slot from.
+        """
+        self.slots = slots
+        self.slot_fd = None
+        self.acquired_at = None
+
+    async def __aenter__(self):
+        self.slot_fd = await self.slots.acquire()
+        self.acquired_at = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.slots.release(self.slot_fd)
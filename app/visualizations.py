@@ -131,7 +131,7 @@ def draw_histogram(x_data, y_data, title, legend_img_uri, filename):
 
     Does not use plotly's histogram functionality
     (https://plot.ly/python/histograms) as the data is already binned
-    in pandas (see calc_histogram() in lists.py). Instead uses a bar
+    with numpy (see bin_open_rates() in stats.py). Instead uses a bar
     chart with no spacing and x-axis ticks between bars.
 
     Args:
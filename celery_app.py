@@ -2,6 +2,8 @@ import os
 import traceback
 from collections import OrderedDict
 from celery import Celery
+from celery.signals import celeryd_init
+from celery.utils.text import str_to_list
 
 def make_celery(app):
     celery = Celery(
@@ -16,6 +18,12 @@ def make_celery(app):
 
         def __call__(self, *args, **kwargs):
             with app.app_context():
+
+                # Workers push the task's request before calling the task
+                # TaskBase.__call__ would hide it behind an empty request
+                # (e.g. without the task id), so only use it for direct calls
+                if self.request_stack.top is not None:
+                    return self.run(*args, **kwargs)
                 return TaskBase.__call__(self, *args, **kwargs)
 
         def on_failure(self, exc, task_id, args, kwargs, einfo):
@@ -37,3 +45,25 @@ def make_celery(app):
     celery.Task = ContextTask
 
     return celery
+
+@celeryd_init.connect
+def set_queue_concurrency(conf=None, options=None, **kwargs): # pylint: disable=unused-argument
+    """Sizes a worker according to the queues it consumes.
+
+    Workers started with -Q but without -c get as many processes as the
+    QUEUE_CONCURRENCY config gives their queues, e.g.
+
+        celery worker -A app.celery -Q interactive
+
+    Args:
+        conf: the worker's Celery configuration.
+        options: the worker's command line options.
+    """
+    queue_concurrency = conf.get('QUEUE_CONCURRENCY')
+    if (not queue_concurrency or options.get('concurrency') or
+            not options.get('queues')):
+        return
+    concurrency = sum(queue_concurrency.get(queue, 0)
+                      for queue in str_to_list(options['queues']))
+    if concurrency:
+        conf.worker_concurrency = concurrency
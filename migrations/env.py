@@ -22,6 +22,15 @@ config.set_main_option('sqlalchemy.url',
                        current_app.config.get('SQLALCHEMY_DATABASE_URI'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+# Celery's result backend keeps its own tables in the app's database
+# (see CELERY_RESULT_BACKEND in config.py). Celery creates them itself, so
+# they're left out of autogenerated migrations rather than dropped
+CELERY_RESULT_TABLES = ('celery_taskmeta', 'celery_tasksetmeta')
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    return not (type_ == 'table' and name in CELERY_RESULT_TABLES)
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -73,6 +82,7 @@ def run_migrations_online():
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      include_object=include_object,
                       **current_app.extensions['migrate'].configure_args)
 
     try:
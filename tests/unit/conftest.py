@@ -1,9 +1,44 @@
+import io
+import json
+import tarfile
 from unittest.mock import MagicMock
 import pytest
 import pandas as pd
+import numpy as np
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from wtforms import BooleanField
 from app import app
 from app.lists import MailChimpList
+from app.members import MemberBuffer
+from app.proxies import ProxyPool, ProxyProvider
+
+@pytest.fixture(autouse=True)
+def connection_slots_dir(monkeypatch, tmpdir):
+    """Keeps each test's API key connection slots to itself."""
+    monkeypatch.setenv('CONNECTION_SLOTS_DIR', str(tmpdir))
+    yield str(tmpdir)
+
+@pytest.fixture(autouse=True)
+def snapshot_dir(monkeypatch, tmpdir):
+    """Keeps each test's list snapshots to itself."""
+    snapshot_dir = str(tmpdir.join('snapshots'))
+    monkeypatch.setenv('SNAPSHOT_DIR', snapshot_dir)
+    yield snapshot_dir
+
+@pytest.fixture(autouse=True)
+def checkpoint_dir(monkeypatch, tmpdir):
+    """Keeps each test's import checkpoints to itself."""
+    checkpoint_dir = str(tmpdir.join('checkpoints'))
+    monkeypatch.setenv('CHECKPOINT_DIR', checkpoint_dir)
+    yield checkpoint_dir
+
+@pytest.fixture(autouse=True)
+def spill_dir(monkeypatch, tmpdir):
+    """Keeps each test's spilled members to itself."""
+    spill_dir = str(tmpdir.mkdir('spills'))
+    monkeypatch.setenv('SPILL_DIR', spill_dir)
+    yield spill_dir
 
 @pytest.fixture
 def test_app():
@@ -59,6 +94,7 @@ def fake_list_data():
         'data_center': 'bar1',
         'monthly_updates': False,
         'store_aggregates': False,
+        'activity_strategy': 'campaign_reports',
         'total_count': 'baz',
         'open_rate': 'qux',
         'creation_timestamp': 'quux',
@@ -119,10 +155,138 @@ def mocked_mailchimp_list(mocker, fake_calculation_results):
     """Mocks the MailChimp list class from app/lists.py and attaches fake calculation
     results to the mock attributes."""
     mocked_mailchimp_list = mocker.patch('app.tasks.MailChimpList')
-    mocked_mailchimp_list.return_value = MagicMock(**fake_calculation_results)
+    mocked_mailchimp_list.return_value = MagicMock(
+        **fake_calculation_results, out_of_core=False)
+    mocked_mailchimp_list.return_value.compute_all_stats.return_value = dict(
+        fake_calculation_results)
     yield mocked_mailchimp_list
 
 @pytest.fixture
 def mailchimp_list():
     """Creates a MailChimpList. Used for testing class/instance methiods."""
     yield MailChimpList(1, 2, 'foo-bar1', 'bar1')
+
+@pytest.fixture
+def snapshot_df():
+    """Provides a members dataframe as loaded from a snapshot."""
+    member_buffer = MemberBuffer()
+    member_buffer.append(0, [
+        {'id': 'foo', 'status': 'subscribed'},
+        {'id': 'bar', 'status': 'subscribed'},
+        {'id': 'baz', 'status': 'subscribed'}])
+    df = member_buffer.to_frame() # pylint: disable=invalid-name
+    df['recent_open'] = np.array(
+        ['2000-06-01', '2000-11-01', '1999-06-01'], dtype='datetime64[ns]')
+    yield df
+
+@pytest.fixture
+async def fake_batch_server():
+    """Runs a local fake of the MailChimp batches endpoint.
+
+    Each submitted batch reports as started when first polled and as
+    finished afterwards. Its results are served as a gzipped tar archive
+    containing the canned response for each operation's path (set via the
+    server's responses attribute), or a 404 if there isn't one."""
+    async def submit_batch(request):
+        server.submitted.append(await request.json())
+        return web.json_response({'id': 'foo', 'status': 'pending'})
+
+    async def get_batch(request):
+        server.polls.append(request.match_info['batch_id'])
+        return web.json_response({
+            'id': request.match_info['batch_id'],
+            'status': 'finished' if len(server.polls) > 1 else 'started',
+            'response_body_url': str(server.make_url('/results.tar.gz'))})
+
+    async def get_results(request): # pylint: disable=unused-argument
+        results = [{'status_code': 200 if op['path'] in server.responses
+                                   else 404,
+                    'operation_id': op['operation_id'],
+                    'response': json.dumps(server.responses.get(
+                        op['path'], {'detail': 'Not Found'}))}
+                   for op in server.submitted[-1]['operations']]
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for file_num in range(2):
+                results_file = json.dumps(results[file_num::2]).encode()
+                tar_member = tarfile.TarInfo('{}.json'.format(file_num))
+                tar_member.size = len(results_file)
+                tar.addfile(tar_member, io.BytesIO(results_file))
+        return web.Response(body=archive.getvalue())
+
+    app = web.Application()
+    app.router.add_post('/3.0/batches', submit_batch)
+    app.router.add_get('/3.0/batches/{batch_id}', get_batch)
+    app.router.add_get('/results.tar.gz', get_results)
+    server = TestServer(app)
+    server.submitted = []
+    server.polls = []
+    server.responses = {}
+    await server.start_server()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def fake_gzip_server():
+    """Runs a local server which gzips its response, reporting the
+    Accept-Encoding header it was sent."""
+    async def echo_accept_encoding(request):
+        response = web.json_response({
+            'accept_encoding': request.headers.get('Accept-Encoding')})
+        response.enable_compression(web.ContentCoding.gzip)
+        return response
+
+    app = web.Application()
+    app.router.add_get('/', echo_accept_encoding)
+    server = TestServer(app)
+    await server.start_server()
+    yield server
+    await server.close()
+
+@pytest.fixture
+def batch_mailchimp_list(fake_batch_server):
+    """Creates a MailChimpList which imports via the fake batch server."""
+    mailchimp_list = MailChimpList(
+        1, 2, 'foo-bar1', 'bar1', import_backend='batch_operations')
+    mailchimp_list.api_root = str(fake_batch_server.make_url('/3.0'))
+    mailchimp_list.BATCH_POLL_INTERVAL = 0
+    yield mailchimp_list
+
+@pytest.fixture
+async def fake_proxy_provider():
+    """Runs a local fake of the US Proxies API, which doubles as a proxy.
+
+    Rotating a proxy process returns the server itself as the new proxy,
+    or an error if the server's error attribute is set. Requests proxied
+    through it to /health fail unless its healthy attribute is set."""
+    async def rotate(request):
+        server.rotations.append(request.query['process'])
+        if server.error:
+            return web.Response(text='ERROR:0:{}'.format(server.error))
+        return web.Response(text='OK:{}:{}'.format(server.host, server.port))
+
+    async def check_health(request): # pylint: disable=unused-argument
+        server.health_checks += 1
+        return web.Response(status=200 if server.healthy else 502)
+
+    app = web.Application()
+    app.router.add_get('/api.php', rotate)
+    app.router.add_get('/health', check_health)
+    server = TestServer(app)
+    server.rotations = []
+    server.health_checks = 0
+    server.error = None
+    server.healthy = True
+    await server.start_server()
+    yield server
+    await server.close()
+
+@pytest.fixture
+def proxy_pool(fake_proxy_provider):
+    """Creates a ProxyPool of two proxy processes which obtains proxies
+    from the fake provider."""
+    pool = ProxyPool(
+        [1, 2], ProxyProvider(str(fake_proxy_provider.make_url('/api.php'))))
+    pool.BOOT_TIME = 0
+    pool.HEALTH_CHECK_URL = 'http://mailchimp.invalid/health'
+    yield pool
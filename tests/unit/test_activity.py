@@ -0,0 +1,456 @@
+import asyncio
+import datetime
+from unittest.mock import call, ANY
+import pytest
+from asynctest import CoroutineMock
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+import numpy as np
+from app.concurrency import run_workers
+from app.lists import MailChimpImportError, MailChimpList
+from app.members import MemberBuffer
+
+@pytest.mark.asyncio
+async def test_import_sub_activity_batch_operations(
+        mocker, fake_batch_server, batch_mailchimp_list):
+    """Tests the import_sub_activity function when using the batch
+    operations backend."""
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    fake_batch_server.responses = {
+        '/lists/1/members/{}/activity'.format(subscriber_id): {
+            'email_id': subscriber_id,
+            'activity': [{'action': 'open', 'timestamp': timestamp}]}
+        for subscriber_id, timestamp in (
+            ('foo', '2000-10-01T00:00:00+00:00'),
+            ('bar', '1999-10-01T00:00:00+00:00'))}
+    batch_mailchimp_list.df = pd.DataFrame({
+        'status': ['subscribed', 'subscribed', 'cleaned']})
+    batch_mailchimp_list.df['id'] = np.array(
+        [b'foo', b'bar', b'baz'], dtype='S32')
+    await batch_mailchimp_list.import_sub_activity()
+    assert len(fake_batch_server.submitted[0]['operations']) == 2
+    assert batch_mailchimp_list.df['recent_open'].tolist() == [
+        pd.Timestamp('2000-10-01'), pd.NaT, pd.NaT]
+
+@pytest.mark.asyncio
+async def test_import_sub_activity_batch_operations_slices(mocker):
+    """Tests that the import_sub_activity function checkpoints each slice
+    of a batch operation as soon as its responses arrive."""
+    mocker.patch('app.lists.MailChimpList.get_subscriber_rows',
+                 return_value=np.arange(3, dtype=np.int32))
+    mailchimp_list = MailChimpList(
+        1, 3, 'foo-bar1', 'bar1', import_backend='batch_operations',
+        run_id='qux')
+    checkpointed = []
+
+    async def make_batch_requests(self, session, operations): # pylint: disable=unused-argument
+        for operation in operations:
+            checkpointed.append(
+                mailchimp_list.load_checkpoint('activity-0') is not None)
+            yield operation['operation_id'], {
+                'email_id': operation['path'].split('/')[-2], 'activity': []}
+
+    mocker.patch('app.lists.MailChimpList.make_batch_requests',
+                 new=make_batch_requests)
+    mailchimp_list.ACTIVITY_CHECKPOINT_SIZE = 2
+    mailchimp_list.df = pd.DataFrame({'id': ['foo', 'bar', 'baz']})
+    await mailchimp_list.import_sub_activity()
+    assert checkpointed == [False, False, True]
+    assert mailchimp_list.load_checkpoint('activity-1') is not None
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('api_results, output_df', [
+    ([
+        {
+            'activity': [{
+                'action': 'open',
+                'timestamp': '2000-10-1T00:00:00+00:00',
+                'campaign_id': 'foo',
+                'title': 'bar'
+            }],
+            'email_id': 'foo',
+            'list_id': 'qux'
+        },
+        {
+            'activity': [{
+                'action': 'open',
+                'timestamp': '1998-1-1T00:00:00+00:00',
+                'campaign_id': 'baz',
+                'title': 'bar'
+            }],
+            'email_id': 'bar',
+            'list_id': 'qux'
+        }],
+     pd.DataFrame({
+         'recent_open': np.array(['2000-10-01', 'NaT'],
+                                 dtype='datetime64[ns]')
+     })
+    ),
+    ([
+        {
+            'activity': [{
+                'action': 'open',
+                'timestamp': '1997-10-1T00:00:00+00:00',
+                'campaign_id': 'foo',
+                'title': 'bar'
+            }],
+            'email_id': 'foo',
+            'list_id': 'qux'
+        },
+        {
+            'activity': [{
+                'action': 'open',
+                'timestamp': '1998-1-1T00:00:00+00:00',
+                'campaign_id': 'baz',
+                'title': 'bar'
+            }],
+            'email_id': 'bar',
+            'list_id': 'qux'
+        }],
+     pd.DataFrame({
+         'recent_open': np.array(['NaT', 'NaT'], dtype='datetime64[ns]')
+     }),
+    )
+])
+async def test_import_sub_activity(
+        mocker, mailchimp_list, api_results, output_df):
+    """Tests the import_sub_activity function."""
+    mocked_limiter = mocker.patch('app.activity.AdaptiveConcurrencyLimiter')
+    mocked_sem = mocked_limiter.return_value
+    mocker.patch('app.lists.MailChimpList.get_subscriber_rows',
+                 return_value=np.arange(2, dtype=np.int32))
+    mocked_make_async_requests = mocker.patch(
+        'app.lists.MailChimpList.make_async_requests',
+        new=CoroutineMock(side_effect=api_results))
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list.df = pd.DataFrame(index=range(2))
+    mailchimp_list.df['id'] = np.array([b'foo', b'bar'], dtype='S32')
+    await mailchimp_list.import_sub_activity()
+    mocked_limiter.assert_called_with(
+        mailchimp_list.MAX_ACTIVITY_CONNECTIONS,
+        mailchimp_list.MAX_API_CONNECTIONS)
+    mocked_make_async_requests.assert_has_calls([
+        call(mocked_sem,
+             'https://bar1.api.mailchimp.com/3.0/lists/1/members/foo/activity',
+             ANY, ANY),
+        call(mocked_sem,
+             'https://bar1.api.mailchimp.com/3.0/lists/1/members/bar/activity',
+             ANY, ANY)])
+    assert mailchimp_list.df['id'].tolist() == [b'foo', b'bar']
+    assert_frame_equal(output_df, mailchimp_list.df[['recent_open']])
+
+@pytest.mark.asyncio
+async def test_import_sub_activity_resume(mocker):
+    """Tests that the import_sub_activity function checkpoints slices of
+    subscribers, and only requests slices not checkpointed by a previous
+    attempt."""
+    mocker.patch('app.lists.MailChimpList.get_subscriber_rows',
+                 return_value=np.arange(3, dtype=np.int32))
+    mocked_make_async_requests = mocker.patch(
+        'app.lists.MailChimpList.make_async_requests', new=CoroutineMock(
+            return_value={'email_id': 'baz', 'activity': [
+                {'action': 'open', 'timestamp': '2000-10-01T00:00:00+00:00'}]}))
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list = MailChimpList(1, 3, 'foo-bar1', 'bar1', run_id='qux')
+    mailchimp_list.ACTIVITY_CHECKPOINT_SIZE = 2
+    mailchimp_list.df = pd.DataFrame({'id': ['foo', 'bar', 'baz']})
+    mailchimp_list.save_checkpoint(
+        'activity-0', ids=np.array(['foo', 'bar']),
+        recent_opens=np.array(['2000-12-01', 'NaT'], dtype='datetime64[ns]'))
+    await mailchimp_list.import_sub_activity()
+    mocked_make_async_requests.assert_called_once_with(
+        ANY, 'https://bar1.api.mailchimp.com/3.0/lists/1/members/baz/activity',
+        ANY, ANY)
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.Timestamp('2000-12-01'), pd.NaT, pd.Timestamp('2000-10-01')]
+    saved_slice = mailchimp_list.load_checkpoint('activity-1')
+    assert saved_slice['ids'].tolist() == [b'baz']
+    assert saved_slice['recent_opens'].dtype == np.dtype('datetime64[ns]')
+
+@pytest.mark.asyncio
+async def test_import_queued_activity(mocker):
+    """Tests that the import_queued_activity function requests every
+    queued chunk with one pool of workers, and checkpoints each chunk
+    unless a previous attempt did."""
+    mocked_run_workers = mocker.patch(
+        'app.activity.run_workers', side_effect=run_workers)
+    mocked_make_async_requests = mocker.patch(
+        'app.lists.MailChimpList.make_async_requests', new=CoroutineMock(
+            side_effect=lambda sem, url, params, session: {
+                'email_id': url.split('/')[-2], 'activity': [
+                    {'action': 'open',
+                     'timestamp': '2000-10-01T00:00:00+00:00'}]}))
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list = MailChimpList(1, 5, 'foo-bar1', 'bar1', run_id='qux')
+    mailchimp_list.save_checkpoint(
+        'chunk-activity-0', ids=np.array([b'foo']),
+        recent_opens=np.array(['2000-12-01'], dtype='datetime64[ns]'))
+    subscriber_queue = asyncio.Queue()
+    for queued_chunk in ((0, ['foo']), (1, ['bar', 'baz']), (2, []),
+                         (3, ['qux']), None):
+        subscriber_queue.put_nowait(queued_chunk)
+    activities = await mailchimp_list.import_queued_activity(subscriber_queue)
+    mocked_run_workers.assert_called_once()
+    assert mocked_make_async_requests.call_count == 3
+    assert sorted(activity['ids'].tolist() for activity in activities) == [
+        [], [b'bar', b'baz'], [b'foo'], [b'qux']]
+    for chunk_num in range(1, 4):
+        assert mailchimp_list.load_checkpoint(
+            'chunk-activity-{}'.format(chunk_num)) is not None
+
+def test_parse_sub_activities():
+    """Tests that the parse_sub_activities function keeps each subscriber's
+    latest open in the past year, ignoring other actions and subscribers
+    without an open."""
+    one_year_ago = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    parsed_slice = MailChimpList.parse_sub_activities([
+        {'email_id': 'foo', 'activity': [
+            {'action': 'open', 'timestamp': '2000-10-01T00:00:00+00:00'},
+            {'action': 'click', 'timestamp': '2000-12-01T00:00:00+00:00'},
+            {'action': 'open', 'timestamp': '2000-11-01T00:00:00+00:00'}]},
+        {'email_id': 'bar', 'activity': []},
+        {'email_id': 'baz', 'activity': [
+            {'action': 'open', 'timestamp': '1999-10-01T00:00:00+00:00'}]}],
+                                                      one_year_ago)
+    assert parsed_slice['ids'].tolist() == [b'foo']
+    assert pd.Series(parsed_slice['recent_opens']).tolist() == [
+        pd.Timestamp('2000-11-01')]
+
+def test_merge_recent_opens(mailchimp_list):
+    """Tests that the merge_recent_opens function keeps the latest of a
+    subscriber's opens and ignores unknown subscribers."""
+    mailchimp_list.df = pd.DataFrame({'status': ['subscribed'] * 3})
+    mailchimp_list.df['id'] = np.array([b'foo', b'bar', b'baz'], dtype='S32')
+    mailchimp_list.merge_recent_opens([
+        {'ids': np.array([b'foo', b'qux'], dtype='S32'),
+         'recent_opens': np.array(
+             ['2000-10-01', '2000-10-01'], dtype='datetime64[ns]')},
+        {'ids': np.array([b'baz', b'foo'], dtype='S32'),
+         'recent_opens': np.array(
+             ['NaT', '2000-12-01'], dtype='datetime64[ns]')}])
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.Timestamp('2000-12-01'), pd.NaT, pd.NaT]
+
+def test_merge_recent_opens_rows(mocker, mailchimp_list):
+    """Tests that the merge_recent_opens function writes opens back to
+    their subscribers' rows, unless the rows hold other subscribers."""
+    mailchimp_list.df = pd.DataFrame({'status': ['subscribed'] * 3})
+    mailchimp_list.df['id'] = np.array([b'foo', b'bar', b'baz'], dtype='S32')
+    mocked_get_indexer = mocker.spy(pd.Index, 'get_indexer')
+    mailchimp_list.merge_recent_opens([
+        {'ids': np.array([b'bar', b'baz'], dtype='S32'),
+         'rows': np.array([1, 2], dtype=np.int32),
+         'recent_opens': np.array(
+             ['2000-10-01', '2000-11-01'], dtype='datetime64[ns]')}])
+    mocked_get_indexer.assert_not_called()
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.NaT, pd.Timestamp('2000-10-01'), pd.Timestamp('2000-11-01')]
+    mailchimp_list.merge_recent_opens([
+        {'ids': np.array([b'foo', b'bar'], dtype='S32'),
+         'rows': np.array([1, 3], dtype=np.int32),
+         'recent_opens': np.array(
+             ['2000-10-01', '2000-11-01'], dtype='datetime64[ns]')}])
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.Timestamp('2000-10-01'), pd.Timestamp('2000-11-01'), pd.NaT]
+
+@pytest.mark.asyncio
+async def test_import_campaign_opens_resume(mocker):
+    """Tests that the import_campaign_opens function checkpoints each
+    campaign's opens, and only requests reports not checkpointed by a
+    previous attempt."""
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    mocked_make_paginated_requests = mocker.patch(
+        'app.lists.MailChimpList.make_paginated_requests', new=CoroutineMock(
+            side_effect=[
+                [{'id': 'c1'}, {'id': 'c2'}],
+                [{'email_id': 'foo', 'opens': [
+                    {'timestamp': '2000-06-01T00:00:00+00:00'}]}]]))
+    mailchimp_list = MailChimpList(1, 2, 'foo-bar1', 'bar1', run_id='qux')
+    mailchimp_list.df = pd.DataFrame({
+        'id': ['foo', 'bar'], 'status': ['subscribed', 'subscribed']})
+    mailchimp_list.save_checkpoint(
+        'opens-c1', ids=np.array(['foo', 'bar']), recent_opens=np.array(
+            ['2000-03-01', '2000-04-01'], dtype='datetime64[ns]'))
+    await mailchimp_list.import_campaign_opens()
+    assert mocked_make_paginated_requests.call_count == 2
+    args, _ = mocked_make_paginated_requests.call_args
+    assert args[1] == 'https://bar1.api.mailchimp.com/3.0/reports/c2/open-details'
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.Timestamp('2000-06-01'), pd.Timestamp('2000-04-01')]
+    saved_opens = mailchimp_list.load_checkpoint('opens-c2')
+    assert saved_opens['ids'].tolist() == [b'foo']
+    assert saved_opens['rows'].tolist() == [0]
+
+@pytest.mark.asyncio
+async def test_import_recent_activity_campaign_reports(mocker, mailchimp_list):
+    """Tests the import_recent_activity function when the list uses the
+    campaign_reports strategy."""
+    mailchimp_list.activity_strategy = 'campaign_reports'
+    mocked_import_campaign_opens = mocker.patch(
+        'app.lists.MailChimpList.import_campaign_opens', new=CoroutineMock())
+    mocked_import_sub_activity = mocker.patch(
+        'app.lists.MailChimpList.import_sub_activity', new=CoroutineMock())
+    await mailchimp_list.import_recent_activity()
+    mocked_import_campaign_opens.assert_called()
+    mocked_import_sub_activity.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_import_recent_activity_fallback(
+        mocker, caplog, mailchimp_list):
+    """Tests that the import_recent_activity function falls back to member
+    activity when campaign reports can't be imported."""
+    mailchimp_list.activity_strategy = 'campaign_reports'
+    mocker.patch(
+        'app.lists.MailChimpList.import_campaign_opens',
+        new=CoroutineMock(side_effect=MailChimpImportError('foo', 'bar')))
+    mocked_import_sub_activity = mocker.patch(
+        'app.lists.MailChimpList.import_sub_activity', new=CoroutineMock())
+    await mailchimp_list.import_recent_activity()
+    mocked_import_sub_activity.assert_called()
+    assert 'Falling back to member activity' in caplog.text
+
+@pytest.mark.asyncio
+async def test_import_recent_activity_member_activity(mocker, mailchimp_list):
+    """Tests that the import_recent_activity function uses the
+    member_activity strategy by default."""
+    mocked_import_campaign_opens = mocker.patch(
+        'app.lists.MailChimpList.import_campaign_opens', new=CoroutineMock())
+    mocked_import_sub_activity = mocker.patch(
+        'app.lists.MailChimpList.import_sub_activity', new=CoroutineMock())
+    await mailchimp_list.import_recent_activity()
+    mocked_import_campaign_opens.assert_not_called()
+    mocked_import_sub_activity.assert_called()
+
+@pytest.mark.asyncio
+async def test_import_campaign_opens(mocker, mailchimp_list):
+    """Tests the import_campaign_opens function."""
+    mocked_make_paginated_requests = mocker.patch(
+        'app.lists.MailChimpList.make_paginated_requests',
+        new=CoroutineMock(side_effect=[
+            [{'id': 'c1'}, {'id': 'c2'}],
+            [{'email_id': 'foo',
+              'opens': [{'timestamp': '2000-10-01T00:00:00+00:00'},
+                        {'timestamp': '2000-12-01T00:00:00+00:00'}]},
+             {'email_id': 'bar',
+              'opens': [{'timestamp': '1999-10-01T00:00:00+00:00'}]},
+             {'email_id': 'qux',
+              'opens': [{'timestamp': '2000-12-01T00:00:00+00:00'}]}],
+            [{'email_id': 'foo',
+              'opens': [{'timestamp': '2000-11-01T00:00:00+00:00'}]}]]))
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list.df = pd.DataFrame({
+        'status': ['subscribed', 'subscribed', 'subscribed', 'cleaned']})
+    mailchimp_list.df['id'] = np.array(
+        [b'foo', b'bar', b'baz', b'qux'], dtype='S32')
+    await mailchimp_list.import_campaign_opens()
+    assert mailchimp_list.subscribers == 3
+    campaigns_call, *report_calls = (
+        mocked_make_paginated_requests.call_args_list)
+    assert campaigns_call == call(
+        ANY, 'https://bar1.api.mailchimp.com/3.0/campaigns',
+        (('fields', 'campaigns.id,total_items'),
+         ('list_id', 1),
+         ('status', 'sent'),
+         ('since_send_time', '2000-01-02T00:00:00+00:00')),
+        ANY, 'campaigns')
+    assert sorted(args[1] for args, _ in report_calls) == [
+        'https://bar1.api.mailchimp.com/3.0/reports/c1/open-details',
+        'https://bar1.api.mailchimp.com/3.0/reports/c2/open-details']
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.Timestamp('2000-12-01'), pd.NaT, pd.NaT, pd.NaT]
+
+@pytest.mark.asyncio
+async def test_make_paginated_requests(mocker, mailchimp_list):
+    """Tests the make_paginated_requests function."""
+    mocked_make_async_requests = mocker.patch(
+        'app.lists.MailChimpList.make_async_requests',
+        new=CoroutineMock(side_effect=[
+            {'members': ['foo'], 'total_items': 2500},
+            {'members': ['bar']},
+            {'members': ['baz']}]))
+    mailchimp_list.REPORT_CHUNK_SIZE = 1000
+    items = await mailchimp_list.make_paginated_requests(
+        'foo', 'www.foo.com', (('fields', 'bar'),), 'baz', 'members')
+    assert items == ['foo', 'bar', 'baz']
+    mocked_make_async_requests.assert_has_calls([
+        call('foo', 'www.foo.com',
+             (('fields', 'bar'), ('count', '1000'), ('offset', str(offset))),
+             'baz')
+        for offset in (0, 1000, 2000)])
+
+@pytest.mark.asyncio
+async def test_make_paginated_requests_page_size(mocker, mailchimp_list):
+    """Tests the make_paginated_requests function with a custom page
+    size."""
+    mocked_make_async_requests = mocker.patch(
+        'app.lists.MailChimpList.make_async_requests',
+        new=CoroutineMock(side_effect=[
+            {'members': ['foo'], 'total_items': 6000},
+            {'members': ['bar']}]))
+    items = await mailchimp_list.make_paginated_requests(
+        'foo', 'www.foo.com', (), 'baz', 'members', page_size=5000)
+    assert items == ['foo', 'bar']
+    mocked_make_async_requests.assert_called_with(
+        'foo', 'www.foo.com', (('count', '5000'), ('offset', '5000')), 'baz')
+
+@pytest.mark.asyncio
+async def test_import_campaign_opens_since(mocker, mailchimp_list):
+    """Tests that the import_campaign_opens function only requests opens
+    since the given time, as long as it's in the past year."""
+    mocked_make_paginated_requests = mocker.patch(
+        'app.lists.MailChimpList.make_paginated_requests',
+        new=CoroutineMock(side_effect=[[{'id': 'c1'}], [], [{'id': 'c1'}], []]))
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list.df = pd.DataFrame({'id': ['foo'], 'status': ['subscribed']})
+    await mailchimp_list.import_campaign_opens(datetime.datetime(
+        2000, 12, 1, tzinfo=datetime.timezone.utc))
+    args, _ = mocked_make_paginated_requests.call_args
+    assert args[2][-1] == ('since', '2000-12-01T00:00:00+00:00')
+    mailchimp_list.df = pd.DataFrame({'id': ['foo'], 'status': ['subscribed']})
+    await mailchimp_list.import_campaign_opens(datetime.datetime(
+        1999, 12, 1, tzinfo=datetime.timezone.utc))
+    args, _ = mocked_make_paginated_requests.call_args
+    assert args[2][-1] == ('since', '2000-01-02T00:00:00+00:00')
+
+@pytest.mark.asyncio
+async def test_update_recent_activity(mocker, mailchimp_list, snapshot_df):
+    """Tests that the update_recent_activity function imports opens from
+    campaign reports, and keeps the latest of the previous and new opens,
+    and only those in the past year."""
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    snapshot_df['status'] = pd.Categorical(
+        ['subscribed', 'subscribed', 'cleaned'],
+        categories=MemberBuffer.STATUSES)
+    mailchimp_list.df = snapshot_df
+    mailchimp_list.activity_strategy = 'member_activity'
+
+    async def import_recent_activity(since, activity_strategy): # pylint: disable=unused-argument
+        mailchimp_list.merge_recent_opens([{
+            'ids': np.array([b'foo', b'bar'], dtype='S32'),
+            'recent_opens': np.array(
+                ['2000-12-01', '2000-10-01'], dtype='datetime64[ns]')}])
+    mocked_import_recent_activity = mocker.patch(
+        'app.lists.MailChimpList.import_recent_activity',
+        new=CoroutineMock(side_effect=import_recent_activity))
+    await mailchimp_list.update_recent_activity('qux')
+    mocked_import_recent_activity.assert_called_once_with(
+        'qux', activity_strategy='campaign_reports')
+    assert mailchimp_list.df.columns.tolist()[-1] == 'recent_open'
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.Timestamp('2000-12-01'), pd.Timestamp('2000-11-01'), pd.NaT]
@@ -0,0 +1,68 @@
+import io
+import pytest
+from aiohttp import ClientSession
+from app.lists import MailChimpImportError
+
+def test_make_batch_operation(mailchimp_list):
+    """Tests the make_batch_operation function."""
+    assert mailchimp_list.make_batch_operation(
+        'foo', '/bar', (('baz', 'qux'),)) == {
+            'method': 'GET',
+            'path': '/bar',
+            'params': {'baz': 'qux'},
+            'operation_id': 'foo'}
+
+@pytest.mark.asyncio
+async def test_make_batch_requests(fake_batch_server, batch_mailchimp_list):
+    """Tests the make_batch_requests function against a fake batch server."""
+    fake_batch_server.responses = {
+        '/foo': {'foo': 'bar'}, '/bar': {'bar': 'baz'}, '/baz': {'baz': 1}}
+    operations = [
+        batch_mailchimp_list.make_batch_operation(
+            path[1:], path, (('fields', 'foo'),))
+        for path in ('/foo', '/bar', '/baz')]
+    async with ClientSession() as session:
+        results = [result async for result in
+                   batch_mailchimp_list.make_batch_requests(
+                       session, operations)]
+    assert fake_batch_server.submitted == [{'operations': operations}]
+    assert len(fake_batch_server.polls) == 2
+    assert sorted(results) == sorted([
+        ('foo', {'foo': 'bar'}), ('bar', {'bar': 'baz'}), ('baz', {'baz': 1})])
+
+@pytest.mark.asyncio
+async def test_make_batch_requests_operation_error(
+        fake_batch_server, batch_mailchimp_list):
+    """Tests the make_batch_requests function when an operation fails."""
+    operations = [batch_mailchimp_list.make_batch_operation('foo', '/foo', ())]
+    async with ClientSession() as session:
+        with pytest.raises(MailChimpImportError) as e:
+            async for _ in batch_mailchimp_list.make_batch_requests(
+                    session, operations):
+                pass
+    assert e.value.error_details['mailchimp_err_code'] == 404
+
+@pytest.mark.asyncio
+async def test_make_batch_requests_timeout(
+        fake_batch_server, batch_mailchimp_list):
+    """Tests the make_batch_requests function when the batch doesn't finish
+    in time."""
+    batch_mailchimp_list.MAX_BATCH_WAIT = 0
+    operations = [batch_mailchimp_list.make_batch_operation('foo', '/foo', ())]
+    async with ClientSession() as session:
+        with pytest.raises(MailChimpImportError):
+            async for _ in batch_mailchimp_list.make_batch_requests(
+                    session, operations):
+                pass
+    assert not fake_batch_server.polls
+
+@pytest.mark.asyncio
+async def test_download_batch_results_error(
+        fake_batch_server, batch_mailchimp_list):
+    """Tests the download_batch_results function when the results can't be
+    downloaded."""
+    async with ClientSession() as session:
+        with pytest.raises(MailChimpImportError):
+            await batch_mailchimp_list.download_batch_results(
+                str(fake_batch_server.make_url('/foo')), session,
+                io.BytesIO())
@@ -0,0 +1,27 @@
+from unittest.mock import MagicMock
+import pytest
+from celery_app import set_queue_concurrency
+
+@pytest.fixture
+def worker_conf():
+    """Provides a worker configuration with per-queue concurrency."""
+    conf = MagicMock(worker_concurrency=None)
+    conf.get.return_value = {'interactive': 4, 'batch': 2}
+    yield conf
+
+def test_set_queue_concurrency(worker_conf): # pylint: disable=redefined-outer-name
+    """Tests that a worker consuming specific queues is sized for them."""
+    set_queue_concurrency(conf=worker_conf,
+                          options={'queues': 'interactive,batch'})
+    worker_conf.get.assert_called_with('QUEUE_CONCURRENCY')
+    assert worker_conf.worker_concurrency == 6
+
+@pytest.mark.parametrize('options', [
+    {'queues': 'interactive', 'concurrency': 1},
+    {'queues': None},
+    {'queues': 'foo'}])
+def test_set_queue_concurrency_ignored(worker_conf, options): # pylint: disable=redefined-outer-name
+    """Tests that a worker's concurrency is left alone if it was given on
+    the command line, or the worker's queues don't have a concurrency."""
+    set_queue_concurrency(conf=worker_conf, options=options)
+    assert worker_conf.worker_concurrency is None
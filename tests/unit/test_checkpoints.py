@@ -0,0 +1,71 @@
+import os
+import numpy as np
+from app.checkpoints import ImportCheckpoint
+
+def test_import_checkpoint_dirs(checkpoint_dir, tmpdir):
+    """Tests that checkpoints are kept in a directory per list and run."""
+    checkpoint = ImportCheckpoint('foo', 'bar')
+    assert checkpoint.run_dir == os.path.join(checkpoint_dir, 'foo', 'bar')
+    assert os.path.isdir(checkpoint.run_dir)
+    other_dir = str(tmpdir.join('baz'))
+    assert ImportCheckpoint('foo', 'bar', directory=other_dir).run_dir == (
+        os.path.join(other_dir, 'foo', 'bar'))
+
+def test_import_checkpoint_save_load():
+    """Tests that saved parts are loaded back with their dtypes intact."""
+    checkpoint = ImportCheckpoint('foo', 'bar')
+    arrays = {
+        'id': np.array(['foo', 'bar'], dtype='S32'),
+        'status': np.array([0, 1], dtype='int8'),
+        'timestamp_opt': np.array(
+            ['2000-01-01T00:00:00', 'NaT'], dtype='datetime64[ns]'),
+        'avg_open_rate': np.array([0.5, np.nan], dtype='float32')}
+    checkpoint.save('members-0', **arrays)
+    loaded_arrays = ImportCheckpoint('foo', 'bar').load('members-0')
+    assert loaded_arrays.keys() == arrays.keys()
+    for key, array in arrays.items():
+        assert loaded_arrays[key].dtype == array.dtype
+        np.testing.assert_array_equal(loaded_arrays[key], array)
+    assert not [file_name for file_name in os.listdir(checkpoint.run_dir)
+                if file_name.endswith('.tmp')]
+
+def test_import_checkpoint_load_missing():
+    """Tests that loading a part which wasn't saved returns None."""
+    assert ImportCheckpoint('foo', 'bar').load('members-0') is None
+    assert ImportCheckpoint('foo', 'baz').load('members-0') is None
+
+def test_import_checkpoint_has_parts():
+    """Tests checking whether a run saved any parts."""
+    assert not ImportCheckpoint.has_parts('foo', 'bar')
+    checkpoint = ImportCheckpoint('foo', 'bar')
+    assert not ImportCheckpoint.has_parts('foo', 'bar')
+    checkpoint.save('members-0', id=np.array([1]))
+    assert ImportCheckpoint.has_parts('foo', 'bar')
+    assert not ImportCheckpoint.has_parts('foo', 'baz')
+
+def test_import_checkpoint_clear():
+    """Tests that clearing a run removes its checkpoints only."""
+    checkpoint = ImportCheckpoint('foo', 'bar')
+    other_checkpoint = ImportCheckpoint('foo', 'baz')
+    checkpoint.save('members-0', id=np.array([1]))
+    other_checkpoint.save('members-0', id=np.array([1]))
+    checkpoint.clear()
+    assert not os.path.exists(checkpoint.run_dir)
+    assert other_checkpoint.load('members-0') is not None
+
+def test_import_checkpoint_remove_abandoned_runs():
+    """Tests that every list's old runs are removed when a new run
+    starts."""
+    old_checkpoint = ImportCheckpoint('foo', 'bar')
+    recent_checkpoint = ImportCheckpoint('foo', 'baz')
+    other_list_checkpoint = ImportCheckpoint('qux', 'bar')
+    recent_other_list_checkpoint = ImportCheckpoint('qux', 'baz')
+    old_mtime = os.path.getmtime(old_checkpoint.run_dir) - (
+        ImportCheckpoint.MAX_AGE + 1)
+    for run_dir in (old_checkpoint.run_dir, other_list_checkpoint.run_dir):
+        os.utime(run_dir, (old_mtime, old_mtime))
+    ImportCheckpoint('foo', 'quux')
+    assert not os.path.exists(old_checkpoint.run_dir)
+    assert not os.path.exists(other_list_checkpoint.run_dir)
+    assert os.path.exists(recent_checkpoint.run_dir)
+    assert os.path.exists(recent_other_list_checkpoint.run_dir)
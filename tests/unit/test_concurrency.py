@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from collections import OrderedDict
+import pytest
+from app.concurrency import TaskGroup, run_workers
+from app.lists import MailChimpImportError
+
+async def succeed(result):
+    """Returns a result once the other tasks have had a chance to run."""
+    await asyncio.sleep(0)
+    return result
+
+async def fail():
+    """Raises an import error once the other tasks have started."""
+    await asyncio.sleep(0)
+    raise MailChimpImportError('foo', OrderedDict([('err_desc', 'bar')]))
+
+async def hang(cancelled):
+    """Runs until cancelled, then records the cancellation."""
+    try:
+        await asyncio.sleep(3600)
+    except asyncio.CancelledError:
+        cancelled.append(True)
+        raise
+
+@pytest.mark.asyncio
+async def test_gather():
+    """Tests running a group of tasks which all succeed."""
+    async with TaskGroup('foos') as group:
+        group.spawn(succeed(1))
+        group.spawn(succeed(2))
+        assert await group.gather() == [1, 2]
+    assert group.completed == 2
+
+@pytest.mark.asyncio
+async def test_failure_cancels_siblings(caplog):
+    """Tests that the group cancels its other tasks as soon as one fails,
+    and reports how many had completed."""
+    cancelled = []
+    with pytest.raises(MailChimpImportError) as e: # pylint: disable=invalid-name
+        async with TaskGroup('foo bars') as group:
+            group.spawn(succeed(1))
+            group.spawn(fail())
+            group.spawn(hang(cancelled))
+            group.spawn(hang(cancelled))
+            await group.gather()
+    assert cancelled == [True, True]
+    assert all(task.done() for task in group.tasks)
+    assert e.value.error_details == OrderedDict([
+        ('err_desc', 'bar'), ('foo_bars_completed', '1 of 4')])
+    assert 'Cancelled 2 of 4 foo bars after an error' in caplog.text
+
+@pytest.mark.asyncio
+async def test_failure_as_completed():
+    """Tests that the failing task's error is raised, rather than the
+    cancellation of a task which hadn't completed yet."""
+    cancelled = []
+    with pytest.raises(MailChimpImportError):
+        async with TaskGroup('foos') as group:
+            group.spawn(hang(cancelled))
+            group.spawn(fail())
+            for next_task in group.as_completed():
+                await next_task
+    assert cancelled == [True]
+
+@pytest.mark.asyncio
+async def test_block_error_cancels_tasks(caplog):
+    """Tests that the group cancels its tasks if the block raises an
+    error."""
+    caplog.set_level(logging.WARNING)
+    cancelled = []
+    with pytest.raises(ValueError):
+        async with TaskGroup('foos') as group:
+            group.spawn(hang(cancelled))
+            await asyncio.sleep(0)
+            raise ValueError
+    assert cancelled == [True]
+    assert group.completed == 0
+
+@pytest.mark.asyncio
+async def test_run_workers():
+    """Tests that a fixed number of workers handle every item."""
+    handled = []
+    running = []
+    max_running = []
+
+    async def handle(item):
+        running.append(item)
+        max_running.append(len(running))
+        await asyncio.sleep(0)
+        running.remove(item)
+        handled.append(item)
+
+    await run_workers('foos', 3, handle, range(20))
+    assert sorted(handled) == list(range(20))
+    assert max(max_running) == 3
+
+@pytest.mark.asyncio
+async def test_run_workers_bounded_queue():
+    """Tests that items wait in the iterable rather than the queue while
+    the workers are busy."""
+    taken = []
+    release = asyncio.Event()
+
+    async def handle(item): # pylint: disable=unused-argument
+        await release.wait()
+
+    def items():
+        for item in range(100):
+            taken.append(item)
+            yield item
+
+    workers = asyncio.ensure_future(run_workers('foos', 2, handle, items()))
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    # Two items being handled, two in the queue and one waiting to be put
+    assert len(taken) == 5
+    release.set()
+    await workers
+    assert len(taken) == 100
+
+@pytest.mark.asyncio
+async def test_run_workers_async_items():
+    """Tests that the workers handle the items of an async iterable."""
+    handled = []
+
+    async def handle(item):
+        handled.append(item)
+
+    async def items():
+        for item in range(20):
+            await asyncio.sleep(0)
+            yield item
+
+    await run_workers('foos', 3, handle, items())
+    assert sorted(handled) == list(range(20))
+
+@pytest.mark.asyncio
+async def test_run_workers_failure():
+    """Tests that the other workers are cancelled if one fails."""
+    handled = []
+
+    async def handle(item):
+        await asyncio.sleep(0)
+        if item == 3:
+            raise MailChimpImportError('foo', OrderedDict())
+        handled.append(item)
+
+    with pytest.raises(MailChimpImportError):
+        await run_workers('foos', 2, handle, range(100))
+    assert len(handled) < 10
@@ -0,0 +1,73 @@
+import asyncio
+import pytest
+from aiohttp import ClientSession
+from app.connections import (
+    WorkerConnections, open_worker_connections, close_worker_connections)
+
+@pytest.fixture
+def worker_connections():
+    """Opens a worker's connections, then closes them and restores the
+    previous event loop."""
+    previous_loop = asyncio.get_event_loop()
+    WorkerConnections.open()
+    yield WorkerConnections
+    WorkerConnections.close()
+    asyncio.set_event_loop(previous_loop)
+
+def test_open(worker_connections): # pylint: disable=redefined-outer-name
+    """Tests that opening a worker's connections creates a persistent
+    event loop and a keep-alive session."""
+    assert asyncio.get_event_loop() is worker_connections.loop
+    connector = worker_connections.session.connector
+    assert connector.limit == WorkerConnections.MAX_CONNECTIONS
+    assert connector.limit_per_host == (
+        WorkerConnections.MAX_CONNECTIONS_PER_HOST)
+    assert connector.use_dns_cache
+
+def test_open_replaces_connections(worker_connections): # pylint: disable=redefined-outer-name
+    """Tests that reopening a worker's connections closes the old ones."""
+    old_loop = worker_connections.loop
+    old_session = worker_connections.session
+    worker_connections.open()
+    assert old_session.closed
+    assert old_loop.is_closed()
+    assert worker_connections.loop is not old_loop
+
+def test_close(worker_connections): # pylint: disable=redefined-outer-name
+    """Tests closing a worker's connections."""
+    loop = worker_connections.loop
+    session = worker_connections.session
+    worker_connections.close()
+    assert session.closed
+    assert loop.is_closed()
+    assert worker_connections.session is None
+    assert worker_connections.loop is None
+    worker_connections.close()
+
+def test_client_session_shared(worker_connections): # pylint: disable=redefined-outer-name
+    """Tests that imports on the worker's event loop share its session."""
+    async def use_session():
+        async with WorkerConnections.client_session() as session:
+            pass
+        return session
+    session = worker_connections.loop.run_until_complete(use_session())
+    assert session is worker_connections.session
+    assert not session.closed
+
+@pytest.mark.asyncio
+async def test_client_session_new():
+    """Tests that imports outside of a worker get a new session, which is
+    closed afterwards."""
+    async with WorkerConnections.client_session() as session:
+        assert isinstance(session, ClientSession)
+        assert session is not WorkerConnections.session
+    assert session.closed
+
+def test_worker_signals(mocker):
+    """Tests that worker processes open and close their connections."""
+    mocked_open = mocker.patch('app.connections.WorkerConnections.open')
+    mocked_close = mocker.patch('app.connections.WorkerConnections.close')
+    open_worker_connections(sender=None)
+    mocked_open.assert_called_once_with()
+    close_worker_connections(sender=None)
+    mocked_close.assert_called_once_with()
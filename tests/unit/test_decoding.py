@@ -0,0 +1,34 @@
+import sys
+import json
+import importlib
+import pytest
+from app import decoding
+
+@pytest.fixture
+def reload_decoding():
+    """Reloads the decoding module after a test, so the fastest available
+    backend is used again."""
+    yield
+    importlib.reload(decoding)
+
+def test_loads_bytes():
+    """Tests decoding a response body straight from bytes."""
+    assert decoding.loads(b'{"members": [{"id": "foo"}]}') == {
+        'members': [{'id': 'foo'}]}
+
+@pytest.mark.parametrize('missing_backends, backend', [
+    (['orjson'], 'ujson'),
+    (['orjson', 'ujson'], 'json')])
+def test_fallback_backend(
+        monkeypatch, reload_decoding, missing_backends, backend): # pylint: disable=redefined-outer-name, unused-argument
+    """Tests falling back to a slower backend when the faster ones aren't
+    installed."""
+    if backend == 'ujson':
+        pytest.importorskip('ujson')
+    for missing_backend in missing_backends:
+        monkeypatch.setitem(sys.modules, missing_backend, None)
+    importlib.reload(decoding)
+    assert decoding.BACKEND == backend
+    if backend == 'json':
+        assert decoding.loads is json.loads
+    assert decoding.loads(b'{"foo": "bar"}') == {'foo': 'bar'}
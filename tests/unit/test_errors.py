@@ -0,0 +1,22 @@
+from app.errors import MailChimpImportError
+
+def test_mailchimp_import_error():
+    """Tests the custom MailChimp Import Error."""
+    error = MailChimpImportError('foo', 'bar')
+    assert isinstance(error, MailChimpImportError)
+    assert str(error) == 'foo'
+    assert error.error_details == 'bar'
+
+def test_mailchimp_import_error_from_response():
+    """Tests creating a MailChimp Import Error from a bad response."""
+    error = MailChimpImportError.from_response(
+        'https://bar1.api.mailchimp.com/3.0/lists', 'foo-bar1', 404,
+        'Not Found')
+    assert str(error) == 'Invalid response code from MailChimp'
+    assert list(error.error_details.items()) == [
+        ('err_desc', 'An error occurred when trying to import your data '
+                     'from MailChimp.'),
+        ('mailchimp_err_code', 404),
+        ('mailchimp_url', 'https://bar1.api.mailchimp.com/3.0/lists'),
+        ('api_key', 'foo-bar1'),
+        ('mailchimp_err_reason', 'Not Found')]
@@ -145,6 +145,7 @@ def test_api_key_form_validates(test_app, mocker):
         api_key_form.key.data = 'foo-bar1'
         api_key_form.store_aggregates.data = True
         api_key_form.monthly_updates.data = True
+        api_key_form.activity_strategy.data = 'campaign_reports'
         mocked_validate = mocker.patch('app.forms.FlaskForm.validate')
         mocked_validate.return_value = True
         mocked_request = mocker.patch('app.forms.requests')
@@ -156,3 +157,4 @@ def test_api_key_form_validates(test_app, mocker):
         assert flask.session['num_lists'] == 2
         assert flask.session['store_aggregates']
         assert flask.session['monthly_updates']
+        assert flask.session['activity_strategy'] == 'campaign_reports'
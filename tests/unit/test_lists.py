@@ -1,25 +1,29 @@
+import os
+import json
 import logging
 import random
 import datetime
 from collections import OrderedDict
-from unittest.mock import call, ANY
+from unittest.mock import call, ANY, MagicMock
+import asyncio
 from asyncio import TimeoutError as AsyncTimeoutError
 import pytest
-from aiohttp import ClientHttpProxyError, ServerDisconnectedError
+from aiohttp import ClientHttpProxyError, ServerDisconnectedError, ClientSession
 import asynctest
 from asynctest import CoroutineMock
 import pandas as pd
 from pandas.util.testing import assert_frame_equal
 import numpy as np
-from requests.exceptions import ConnectionError as ConnError
-from app.lists import MailChimpImportError
+from app.lists import MailChimpImportError, MailChimpList
+from app.members import MemberBuffer
+from app.spill import ColumnSpill
+from app.throttling import ApiKeyConnectionSlots
 
-def test_mailchimp_import_error():
-    """Tests the custom MailChimp Import Error."""
-    error = MailChimpImportError('foo', 'bar')
-    assert isinstance(error, MailChimpImportError)
-    assert str(error) == 'foo'
-    assert error.error_details == 'bar'
+def test_mailchimp_list_unknown_activity_strategy():
+    """Tests that creating a MailChimpList with an unknown activity strategy
+    raises a ValueError."""
+    with pytest.raises(ValueError):
+        MailChimpList(1, 2, 'foo-bar1', 'bar1', activity_strategy='foo')
 
 @pytest.mark.asyncio
 async def test_enable_proxy_no_proxy(mocker, caplog, mailchimp_list):
@@ -37,94 +41,75 @@ async def test_enable_proxy_no_proxy(mocker, caplog, mailchimp_list):
 async def test_enable_proxy_successful(mocker, caplog, mailchimp_list):
     """Tests the enable_proxy function."""
     mocked_os = mocker.patch('app.lists.os')
-    mocked_os.environ.get.side_effect = [None, 'foo']
-    mocked_current_proccess = mocker.patch('app.lists.current_process')
-    mocked_current_proccess.return_value.index = 5
-    mocked_requests = mocker.patch('app.lists.requests')
-    mocked_requests.get.return_value.text = 'foo:bar:baz'
+    mocked_os.environ.get.side_effect = [None]
+    mocked_proxy_pool = mocker.patch('app.lists.ProxyPool')
+    mocked_proxy_pool.get_pool.return_value.get = CoroutineMock(
+        return_value='http://bar:baz')
     caplog.set_level(logging.INFO)
-    mocked_sleep = mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
     await mailchimp_list.enable_proxy()
-    mocked_requests.get.assert_called_with(
-        'http://us-proxies.com/api.php',
-        params=(
-            ('api', ''),
-            ('uid', '9557'),
-            ('pwd', 'foo'),
-            ('cmd', 'rotate'),
-            ('process', '6'),
-        ),
-    )
+    assert mailchimp_list.proxy_pool == (
+        mocked_proxy_pool.get_pool.return_value)
     assert mailchimp_list.proxy == 'http://bar:baz'
     assert 'Using proxy: http://bar:baz' in caplog.text
-    mocked_sleep.assert_called()
-
-@pytest.mark.asyncio
-async def test_enable_proxy_unable_to_get_process_number(
-        mocker, mailchimp_list):
-    """Tests the enable_proxy function when current_process().index
-    raises an AttributeError."""
-    mocked_os = mocker.patch('app.lists.os')
-    mocked_os.environ.get.side_effect = [None, 'foo']
-    mocked_current_proccess = mocker.patch('app.lists.current_process')
-    del mocked_current_proccess.return_value.index
-    mocked_requests = mocker.patch('app.lists.requests')
-    mocked_requests.get.return_value.text = 'foo:bar:baz'
-    mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
-    await mailchimp_list.enable_proxy()
-    mocked_requests.get.assert_called_with(
-        'http://us-proxies.com/api.php',
-        params=(
-            ('api', ''),
-            ('uid', '9557'),
-            ('pwd', 'foo'),
-            ('cmd', 'rotate'),
-            ('process', '1'),
-        ),
-    )
 
 @pytest.mark.asyncio
-async def test_enable_proxy_proxy_response_error(
-        mocker, caplog, mailchimp_list):
-    """Tests the enable_proxy function when the request to the proxy provider
-    returns an error."""
+async def test_enable_proxy_unavailable(mocker, caplog, mailchimp_list):
+    """Tests the enable_proxy function when the pool has no proxy
+    available."""
     mocked_os = mocker.patch('app.lists.os')
-    mocked_os.environ.get.side_effect = [None, 'foo']
-    mocker.patch('app.lists.current_process')
-    mocked_requests = mocker.patch('app.lists.requests')
-    mocked_requests.get.return_value.text = 'ERROR:bar:baz'
+    mocked_os.environ.get.side_effect = [None]
+    mocked_proxy_pool = mocker.patch('app.lists.ProxyPool')
+    mocked_proxy_pool.get_pool.return_value.get = CoroutineMock(
+        return_value=None)
+    mocked_proxy_pool.get_pool.return_value.error = 'baz'
     await mailchimp_list.enable_proxy()
     assert mailchimp_list.proxy is None
     assert 'Not using a proxy. Reason: baz.' in caplog.text
 
 @pytest.mark.asyncio
-async def test_enable_proxy_connection_error(mocker, caplog, mailchimp_list):
-    """Tests the enable_proxy function when the request to the proxy provider
-    causes a ConnectionError."""
-    mocked_os = mocker.patch('app.lists.os')
-    mocked_os.environ.get.side_effect = [None, 'foo']
-    mocker.patch('app.lists.current_process')
-    mocked_requests = mocker.patch('app.lists.requests')
-    mocked_requests.get.side_effect = ConnError()
-    await mailchimp_list.enable_proxy()
+async def test_rotate_proxy(mailchimp_list):
+    """Tests switching proxies after a request through one failed."""
+    mailchimp_list.proxy_pool = MagicMock(get=CoroutineMock(
+        return_value='http://qux:quux'))
+    mailchimp_list.proxy = 'http://bar:baz'
+    await mailchimp_list.rotate_proxy('http://bar:baz')
+    mailchimp_list.proxy_pool.report_failure.assert_called_with(
+        'http://bar:baz')
+    assert mailchimp_list.proxy == 'http://qux:quux'
+
+@pytest.mark.asyncio
+async def test_rotate_proxy_already_switched(mailchimp_list):
+    """Tests that a list which already switched away from a failed proxy
+    keeps its new proxy."""
+    mailchimp_list.proxy_pool = MagicMock(get=CoroutineMock())
+    mailchimp_list.proxy = 'http://qux:quux'
+    await mailchimp_list.rotate_proxy('http://bar:baz')
+    mailchimp_list.proxy_pool.report_failure.assert_called_with(
+        'http://bar:baz')
+    mailchimp_list.proxy_pool.get.assert_not_called()
+    assert mailchimp_list.proxy == 'http://qux:quux'
+
+@pytest.mark.asyncio
+async def test_rotate_proxy_no_proxy(mailchimp_list):
+    """Tests that rotating does nothing when the list isn't proxied."""
+    await mailchimp_list.rotate_proxy(None)
     assert mailchimp_list.proxy is None
-    assert 'ConnectionError: proxy provider down.' in caplog.text
 
 @pytest.mark.asyncio
 async def test_make_async_request(mocker, mailchimp_list):
     """Tests the make_async_request function."""
     client_session_mock = CoroutineMock()
     client_session_mock.get.return_value.__aenter__.return_value.status = 200
-    client_session_mock.get.return_value.__aenter__.return_value.text = (
-        CoroutineMock(return_value='foo'))
+    client_session_mock.get.return_value.__aenter__.return_value.read = (
+        CoroutineMock(return_value=b'foo'))
     mocked_basic_auth = mocker.patch('app.lists.BasicAuth')
     async_request_response = await mailchimp_list.make_async_request(
         'www.foo.com', 'foo', client_session_mock)
     client_session_mock.get.assert_called_with(
         'www.foo.com', params='foo',
         auth=mocked_basic_auth('shorenstein', 'foo-bar1'),
-        proxy=None)
-    assert async_request_response == 'foo'
+        headers={'Accept-Encoding': 'gzip'}, proxy=None)
+    assert async_request_response == b'foo'
 
 @pytest.mark.asyncio
 async def test_make_async_request_with_status_code_retry(
@@ -138,6 +123,7 @@ async def test_make_async_request_with_status_code_retry(
     status_code = random.choice(mailchimp_list.HTTP_STATUS_CODES_TO_RETRY)
     client_session_mock.get.return_value.__aenter__.return_value.status = (
         status_code)
+    client_session_mock.get.return_value.__aenter__.return_value.headers = {}
     with pytest.raises(MailChimpImportError) as e:
         await mailchimp_list.make_async_request(
             'www.foo.com', 'foo', client_session_mock)
@@ -148,11 +134,121 @@ async def test_make_async_request_with_status_code_retry(
             ('mailchimp_url', 'www.foo.com'),
             ('api_key', 'foo-bar1'),
             ('mailchimp_err_reason', 'foo')])
-    mocked_sleep.assert_has_calls([
-        call(mailchimp_list.BACKOFF_INTERVAL ** x)
-        for x in range(1, mailchimp_list.MAX_RETRIES + 1)])
+    assert mocked_sleep.call_count == mailchimp_list.MAX_RETRIES
+    assert all(mailchimp_list.BACKOFF_INTERVAL <= delay <=
+               mailchimp_list.MAX_BACKOFF_INTERVAL
+               for (delay,), _ in mocked_sleep.call_args_list)
     assert 'Invalid response code from MailChimp' in caplog.text
 
+@pytest.mark.asyncio
+async def test_make_async_request_retry_after(mocker, mailchimp_list):
+    """Tests that the make_async_request function waits as long as a
+    response's Retry-After header asks before retrying."""
+    client_session_mock = CoroutineMock()
+    response_mock = client_session_mock.get.return_value.__aenter__
+    response_mock.side_effect = [
+        MagicMock(status=429, headers={'Retry-After': '45'}),
+        MagicMock(status=200, read=CoroutineMock(return_value=b'foo'))]
+    mocker.patch('app.lists.BasicAuth')
+    mocked_sleep = mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
+    assert await mailchimp_list.make_async_request(
+        'www.foo.com', 'foo', client_session_mock) == b'foo'
+    mocked_sleep.assert_called_once_with(45)
+    assert mailchimp_list.retry_policy.retries_left == pytest.approx(
+        mailchimp_list.RETRY_BUDGET + mailchimp_list.RETRY_RATIO - 1)
+
+@pytest.mark.asyncio
+async def test_make_async_request_retry_releases_slot(mocker, mailchimp_list):
+    """Tests that a request waiting to retry doesn't hold a connection slot,
+    so requests retrying together can't take every slot and deadlock."""
+    mailchimp_list.connection_slots = ApiKeyConnectionSlots('foo', 1)
+    client_session_mock = CoroutineMock()
+    response_mock = client_session_mock.get.return_value.__aenter__
+    response_mock.side_effect = [
+        MagicMock(status=429, headers={}),
+        MagicMock(status=200, read=CoroutineMock(return_value=b'foo'))]
+    mocker.patch('app.lists.BasicAuth')
+    free_slots = []
+
+    async def sleep(_):
+        slot = mailchimp_list.connection_slots.try_acquire()
+        free_slots.append(slot is not None)
+        if slot is not None:
+            mailchimp_list.connection_slots.release(slot)
+
+    mocker.patch('app.lists.asyncio.sleep', new=sleep)
+    assert await mailchimp_list.make_async_request(
+        'www.foo.com', 'foo', client_session_mock) == b'foo'
+    assert free_slots == [True]
+
+@pytest.mark.asyncio
+async def test_make_async_request_cancelled(mocker, mailchimp_list):
+    """Tests that a request cancelled in flight, e.g. by a TaskGroup, is
+    neither retried nor reported to the limiter."""
+    client_session_mock = CoroutineMock()
+    in_flight = asyncio.Event()
+
+    async def hang(*_):
+        in_flight.set()
+        await asyncio.sleep(3600)
+
+    client_session_mock.get.return_value.__aenter__.side_effect = hang
+    mocker.patch('app.lists.BasicAuth')
+    mocked_should_retry = mocker.spy(
+        mailchimp_list.retry_policy, 'should_retry')
+    limiter = MagicMock()
+    request = asyncio.ensure_future(mailchimp_list.make_async_request(
+        'www.foo.com', 'foo', client_session_mock, limiter=limiter))
+    await in_flight.wait()
+    request.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(request, 1)
+    assert client_session_mock.get.call_count == 1
+    mocked_should_retry.assert_not_called()
+    limiter.record.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_make_async_request_no_retry(mocker, mailchimp_list):
+    """Tests that the make_async_request function doesn't retry status codes
+    which aren't worth retrying, or once the retry budget is spent."""
+    client_session_mock = CoroutineMock()
+    client_session_mock.get.return_value.__aenter__.return_value.status = 404
+    client_session_mock.get.side_effect = [
+        client_session_mock.get.return_value, AsyncTimeoutError()]
+    mocker.patch('app.lists.BasicAuth')
+    mocked_sleep = mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
+    with pytest.raises(MailChimpImportError):
+        await mailchimp_list.make_async_request(
+            'www.foo.com', 'foo', client_session_mock)
+    mailchimp_list.retry_policy.retries_left = 0
+    with pytest.raises(MailChimpImportError):
+        await mailchimp_list.make_async_request(
+            'www.foo.com', 'foo', client_session_mock)
+    mocked_sleep.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_make_async_request_large_import_retries(
+        mocker, mailchimp_list):
+    """Tests that sporadic failures across a large import are retried, even
+    once they add up to more than RETRY_BUDGET retries."""
+    client_session_mock = CoroutineMock()
+    attempts = []
+
+    async def respond(*_):
+        attempts.append(True)
+        # Every tenth request fails once
+        return MagicMock(
+            status=504 if len(attempts) % 11 == 1 else 200, headers={},
+            read=CoroutineMock(return_value=b'foo'))
+    client_session_mock.get.return_value.__aenter__.side_effect = respond
+    mocker.patch('app.lists.BasicAuth')
+    mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
+    num_requests = 12 * mailchimp_list.RETRY_BUDGET
+    for _ in range(num_requests):
+        assert await mailchimp_list.make_async_request(
+            'www.foo.com', 'foo', client_session_mock) == b'foo'
+    assert len(attempts) - num_requests > mailchimp_list.RETRY_BUDGET
+
 @pytest.mark.parametrize('error, error_args', [
     (ClientHttpProxyError, ['foo', 'bar']),
     (ServerDisconnectedError, ['foo']),
@@ -176,151 +272,467 @@ async def test_make_async_request_request_error(
             ('application_exception', str(error)),
             ('mailchimp_url', 'www.foo.com'),
             ('api_key', 'foo-bar1')])
-    mocked_sleep.assert_has_calls([
-        call(mailchimp_list.BACKOFF_INTERVAL ** x)
-        for x in range(1, mailchimp_list.MAX_RETRIES + 1)])
+    assert mocked_sleep.call_count == mailchimp_list.MAX_RETRIES
+    assert all(mailchimp_list.BACKOFF_INTERVAL <= delay <=
+               mailchimp_list.MAX_BACKOFF_INTERVAL
+               for (delay,), _ in mocked_sleep.call_args_list)
     assert 'Error in async request to MailChimp' in caplog.text
 
+@pytest.mark.parametrize('outcome', [
+    MagicMock(status=429, headers={}),
+    ClientHttpProxyError('foo', 'bar')])
+@pytest.mark.asyncio
+async def test_make_async_request_rotates_proxy(
+        mocker, mailchimp_list, outcome):
+    """Tests that the make_async_request function switches proxies when
+    the proxy fails or is rate limited, then retries through the new one."""
+    client_session_mock = CoroutineMock()
+    response_mock = client_session_mock.get.return_value.__aenter__
+    response_mock.side_effect = [
+        outcome, MagicMock(status=200, read=CoroutineMock(return_value=b'foo'))]
+    mocker.patch('app.lists.BasicAuth')
+    mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
+    mailchimp_list.proxy_pool = MagicMock(get=CoroutineMock(
+        return_value='http://qux:quux'))
+    mailchimp_list.proxy_pool.has_other_ready_proxy.return_value = True
+    mailchimp_list.proxy_pool.is_current.return_value = True
+    mailchimp_list.proxy = 'http://bar:baz'
+    assert await mailchimp_list.make_async_request(
+        'www.foo.com', 'foo', client_session_mock) == b'foo'
+    mailchimp_list.proxy_pool.report_failure.assert_called_once_with(
+        'http://bar:baz')
+    assert client_session_mock.get.call_args[1]['proxy'] == 'http://qux:quux'
+
+@pytest.mark.asyncio
+async def test_make_async_request_rate_limited_only_proxy(
+        mocker, mailchimp_list):
+    """Tests that the make_async_request function backs off instead of
+    switching proxies when rate limited with no other proxy ready."""
+    client_session_mock = CoroutineMock()
+    response_mock = client_session_mock.get.return_value.__aenter__
+    response_mock.side_effect = [
+        MagicMock(status=429, headers={}),
+        MagicMock(status=200, read=CoroutineMock(return_value=b'foo'))]
+    mocker.patch('app.lists.BasicAuth')
+    mocked_sleep = mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
+    mailchimp_list.proxy_pool = MagicMock(get=CoroutineMock())
+    mailchimp_list.proxy_pool.has_other_ready_proxy.return_value = False
+    mailchimp_list.proxy = 'http://bar:baz'
+    assert await mailchimp_list.make_async_request(
+        'www.foo.com', 'foo', client_session_mock) == b'foo'
+    mailchimp_list.proxy_pool.has_other_ready_proxy.assert_called_once_with(
+        'http://bar:baz')
+    mailchimp_list.proxy_pool.report_failure.assert_not_called()
+    assert mailchimp_list.proxy == 'http://bar:baz'
+    mocked_sleep.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_make_async_request_collateral_proxy_error(
+        mocker, mailchimp_list):
+    """Tests that the make_async_request function doesn't count requests
+    which failed because another request switched proxies as retries."""
+    client_session_mock = CoroutineMock()
+    response_mock = client_session_mock.get.return_value.__aenter__
+    response_mock.side_effect = (
+        [ClientHttpProxyError('foo', 'bar')] *
+        (mailchimp_list.MAX_RETRIES + 1) +
+        [MagicMock(status=200, read=CoroutineMock(return_value=b'foo'))])
+    mocker.patch('app.lists.BasicAuth')
+    mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
+    mailchimp_list.proxy_pool = MagicMock(get=CoroutineMock(
+        return_value='http://qux:quux'))
+    mailchimp_list.proxy_pool.is_current.return_value = False
+    mailchimp_list.proxy = 'http://bar:baz'
+    retries_left = mailchimp_list.retry_policy.retries_left
+    assert await mailchimp_list.make_async_request(
+        'www.foo.com', 'foo', client_session_mock) == b'foo'
+    assert mailchimp_list.retry_policy.retries_left == pytest.approx(
+        retries_left + mailchimp_list.RETRY_RATIO)
+
+@pytest.mark.asyncio
+async def test_make_async_request_gzip(mailchimp_list, fake_gzip_server):
+    """Tests that the make_async_request function asks for a gzipped
+    response, and returns it decompressed."""
+    async with ClientSession() as session:
+        response = await mailchimp_list.make_async_request(
+            str(fake_gzip_server.make_url('/')), (), session)
+    assert json.loads(response.decode()) == {'accept_encoding': 'gzip'}
+
 @pytest.mark.asyncio
 async def test_make_async_requests(mocker, mailchimp_list):
     """Tests the make_async_requests function."""
     semaphore_mock = asynctest.MagicMock()
     mocked_make_async_request = mocker.patch(
         'app.lists.MailChimpList.make_async_request', new=CoroutineMock())
-    mocked_make_async_request.return_value = '["foo"]'
+    mocked_make_async_request.return_value = b'["foo"]'
     assert ['foo'] == await mailchimp_list.make_async_requests(
         semaphore_mock, 'www.foo.com', 'foo', 'bar')
     mocked_make_async_request.assert_called_with(
-        'www.foo.com', 'foo', 'bar')
+        'www.foo.com', 'foo', 'bar', limiter=semaphore_mock)
 
 @pytest.mark.asyncio
-async def test_import_list_members(mocker, mailchimp_list):
-    """Tests the import_list_members function."""
-    mocked_enable_proxy = mocker.patch(
-        'app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
-    mocked_asyncio = mocker.patch('app.lists.asyncio')
-    mocked_sem = mocked_asyncio.Semaphore.return_value
+@pytest.mark.parametrize('status_code', [200, 429])
+async def test_make_async_request_records_outcome(
+        mocker, mailchimp_list, status_code):
+    """Tests that the make_async_request function reports the outcome of
+    each attempt to the concurrency limiter."""
+    client_session_mock = CoroutineMock()
+    client_session_mock.get.return_value.__aenter__.return_value.status = (
+        status_code)
+    client_session_mock.get.return_value.__aenter__.return_value.read = (
+        CoroutineMock(return_value=b'foo'))
+    mocker.patch('app.lists.BasicAuth')
+    mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
+    mocked_time = mocker.patch('app.throttling.time')
+    mocked_time.monotonic.return_value = 1
+    limiter_mock = MagicMock()
+    try:
+        await mailchimp_list.make_async_request(
+            'www.foo.com', 'foo', client_session_mock, limiter=limiter_mock)
+    except MailChimpImportError:
+        pass
+    limiter_mock.record.assert_has_calls(
+        [call(1, status_code)] * (
+            1 if status_code == 200 else mailchimp_list.MAX_RETRIES + 1))
+
+@pytest.mark.asyncio
+async def test_make_async_request_records_failure(mocker, mailchimp_list):
+    """Tests that the make_async_request function reports requests which
+    fail without a response to the concurrency limiter."""
+    client_session_mock = CoroutineMock()
+    client_session_mock.get.return_value.__aenter__.side_effect = (
+        AsyncTimeoutError('foo'))
+    mocker.patch('app.lists.BasicAuth')
+    mocker.patch('app.lists.asyncio.sleep', new=CoroutineMock())
+    mocked_time = mocker.patch('app.throttling.time')
+    mocked_time.monotonic.return_value = 1
+    limiter_mock = MagicMock()
+    with pytest.raises(MailChimpImportError):
+        await mailchimp_list.make_async_request(
+            'www.foo.com', 'foo', client_session_mock, limiter=limiter_mock)
+    limiter_mock.record.assert_has_calls(
+        [call(1, None)] * (mailchimp_list.MAX_RETRIES + 1))
+
+@pytest.mark.asyncio
+async def test_make_async_request_times_from_slot(mocker, mailchimp_list):
+    """Tests that the make_async_request function doesn't count the time
+    spent waiting for a connection slot as request latency."""
+    mailchimp_list.connection_slots = ApiKeyConnectionSlots('foo', 1)
+    held_slot = mailchimp_list.connection_slots.try_acquire()
+    client_session_mock = CoroutineMock()
+    client_session_mock.get.return_value.__aenter__.return_value.status = 200
+    client_session_mock.get.return_value.__aenter__.return_value.read = (
+        CoroutineMock(return_value=b'foo'))
+    mocker.patch('app.lists.BasicAuth')
+    mocked_time = mocker.patch('app.throttling.time')
+    mocked_time.monotonic.return_value = 1
+    async def wait_for_slot(_):
+        mocked_time.monotonic.return_value = 5
+        mailchimp_list.connection_slots.release(held_slot)
+    mocker.patch('app.throttling.asyncio.sleep',
+                 new=CoroutineMock(side_effect=wait_for_slot))
+    limiter_mock = MagicMock()
+    await mailchimp_list.make_async_request(
+        'www.foo.com', 'foo', client_session_mock, limiter=limiter_mock)
+    limiter_mock.record.assert_called_once_with(5, 200)
+
+def test_mailchimp_list_unknown_import_backend():
+    """Tests that creating a MailChimpList with an unknown import backend
+    raises a ValueError."""
+    with pytest.raises(ValueError):
+        MailChimpList(1, 2, 'foo-bar1', 'bar1', import_backend='foo')
+
+@pytest.mark.asyncio
+async def test_make_async_request_post(mocker, mailchimp_list):
+    """Tests the make_async_request function when passed a request body."""
+    client_session_mock = CoroutineMock()
+    client_session_mock.post.return_value.__aenter__.return_value.status = 200
+    client_session_mock.post.return_value.__aenter__.return_value.read = (
+        CoroutineMock(return_value=b'foo'))
+    mocked_basic_auth = mocker.patch('app.lists.BasicAuth')
+    async_request_response = await mailchimp_list.make_async_request(
+        'www.foo.com', None, client_session_mock, json_body={'foo': 'bar'})
+    client_session_mock.post.assert_called_with(
+        'www.foo.com', json={'foo': 'bar'},
+        auth=mocked_basic_auth('shorenstein', 'foo-bar1'),
+        headers={'Accept-Encoding': 'gzip'}, proxy=None)
+    client_session_mock.get.assert_not_called()
+    assert async_request_response == b'foo'
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('activity_strategy, import_backend', [
+    ('campaign_reports', 'async_requests'),
+    ('member_activity', 'batch_operations')])
+async def test_import_members_and_activity_sequential(
+        mocker, activity_strategy, import_backend):
+    """Tests that the import_members_and_activity function imports members
+    and then their activity when the imports can't be pipelined."""
+    mocked_import_list_members = mocker.patch(
+        'app.lists.MailChimpList.import_list_members', new=CoroutineMock())
+    mocked_import_recent_activity = mocker.patch(
+        'app.lists.MailChimpList.import_recent_activity', new=CoroutineMock())
+    mailchimp_list = MailChimpList(
+        1, 2, 'foo-bar1', 'bar1', activity_strategy, import_backend)
+    await mailchimp_list.import_members_and_activity()
+    mocked_import_list_members.assert_called_once_with()
+    mocked_import_recent_activity.assert_called_once_with()
+
+@pytest.fixture
+def fake_members_and_activity():
+    """Provides a fake of make_async_requests which returns either a chunk
+    of members or a subscriber's activity, depending on the url."""
+    async def make_async_requests(sem, url, params, session): # pylint: disable=unused-argument
+        if url.endswith('/members'):
+            offset = int(params[-1][1])
+            return {'members': [
+                {'id': 'foo', 'status': 'subscribed'},
+                {'id': 'bar', 'status': 'cleaned'}] if offset == 0 else [
+                    {'id': 'baz', 'status': 'subscribed'}]}
+        subscriber_id = url.split('/')[-2]
+        activity = ([{'action': 'open',
+                      'timestamp': '2000-10-01T00:00:00+00:00'}]
+                    if subscriber_id == 'baz' else [])
+        return {'email_id': subscriber_id, 'activity': activity}
+    yield make_async_requests
+
+@pytest.mark.asyncio
+async def test_import_members_and_activity_pipelined(
+        mocker, fake_members_and_activity): # pylint: disable=redefined-outer-name
+    """Tests that the import_members_and_activity function requests the
+    activity of each chunk's subscribers, and checkpoints it by chunk."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
     mocked_make_async_requests = mocker.patch(
-        'app.lists.MailChimpList.make_async_requests')
-    mocked_asyncio.gather = CoroutineMock(return_value=(
-        [{'foo': [{'foo': 'bar'}]}, {'bar': [{'foo': 'baz'}]}]))
-    mailchimp_list.count = 10020
-    await mailchimp_list.import_list_members()
-    mocked_enable_proxy.assert_called()
-    mocked_asyncio.Semaphore.assert_called_with(mailchimp_list.MAX_CONNECTIONS)
-    async_requests_calls_args_list = [
-        arg
-        for args, _ in mocked_make_async_requests.call_args_list
-        for arg in args]
-    assert all(
-        requests_arg in async_requests_calls_args_list
-        for requests_arg in [
-            'https://bar1.api.mailchimp.com/3.0/lists/1/members',
-            (ANY, ('count', '5000'), ('offset', '0')),
-            (ANY, ('count', '5000'), ('offset', '5000')),
-            (ANY, ('count', '20'), ('offset', '10000')),
-            mocked_sem
-        ])
-    assert mocked_asyncio.ensure_future.call_count == 3
-    args, _ = mocked_asyncio.gather.call_args
-    assert len(args) == 3
-    fake_df = pd.DataFrame({'foo': ['bar', 'baz']})
-    assert_frame_equal(fake_df, mailchimp_list.df)
+        'app.lists.MailChimpList.make_async_requests',
+        new=CoroutineMock(side_effect=fake_members_and_activity))
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list = MailChimpList(
+        1, 5001, 'foo-bar1', 'bar1', 'member_activity', run_id='qux')
+    await mailchimp_list.import_members_and_activity()
+    assert mocked_make_async_requests.call_count == 4
+    mocked_make_async_requests.assert_any_call(
+        ANY, 'https://bar1.api.mailchimp.com/3.0/lists/1/members/foo/activity',
+        mailchimp_list.SUB_ACTIVITY_PARAMS, ANY)
+    assert mailchimp_list.subscribers == 2
+    assert mailchimp_list.df['id'].tolist() == [b'foo', b'bar', b'baz']
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.NaT, pd.NaT, pd.Timestamp('2000-10-01')]
+    saved_slice = mailchimp_list.load_checkpoint('chunk-activity-1')
+    assert saved_slice['ids'].tolist() == [b'baz']
+    assert saved_slice['recent_opens'].tolist() == [
+        pd.Timestamp('2000-10-01').value]
+
+def test_mailchimp_list_out_of_core(monkeypatch):
+    """Tests that only lists with at least OUT_OF_CORE_MIN_COUNT members are
+    analyzed out of core by default."""
+    assert not MailChimpList(1, 2, 'foo-bar1', 'bar1').out_of_core
+    assert MailChimpList(1, 2, 'foo-bar1', 'bar1', out_of_core=True).out_of_core
+    assert MailChimpList(
+        1, MailChimpList.OUT_OF_CORE_MIN_COUNT, 'foo-bar1', 'bar1').out_of_core
+    monkeypatch.setenv('OUT_OF_CORE_MIN_COUNT', '2')
+    assert MailChimpList(1, 2, 'foo-bar1', 'bar1').out_of_core
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize('api_results, output_df', [
-    ([
-        {
-            'activity': [{
-                'action': 'open',
-                'timestamp': '2000-10-1T00:00:00+00:00',
-                'campaign_id': 'foo',
-                'title': 'bar'
-            }],
-            'email_id': 'foo',
-            'list_id': 'qux'
-        },
-        {
-            'activity': [{
-                'action': 'open',
-                'timestamp': '1998-1-1T00:00:00+00:00',
-                'campaign_id': 'baz',
-                'title': 'bar'
-            }],
-            'email_id': 'bar',
-            'list_id': 'qux'
-        }],
-     pd.DataFrame({
-         'id': ['foo', 'bar'],
-         'recent_open': ['2000-10-1T00:00:00+00:00', np.NaN]
-     })
-    ),
-    ([
-        {
-            'activity': [{
-                'action': 'open',
-                'timestamp': '1997-10-1T00:00:00+00:00',
-                'campaign_id': 'foo',
-                'title': 'bar'
-            }],
-            'email_id': 'foo',
-            'list_id': 'qux'
-        },
-        {
-            'activity': [{
-                'action': 'open',
-                'timestamp': '1998-1-1T00:00:00+00:00',
-                'campaign_id': 'baz',
-                'title': 'bar'
-            }],
-            'email_id': 'bar',
-            'list_id': 'qux'
-        }],
-     pd.DataFrame({
-         'id': ['foo', 'bar'],
-         'recent_open': [np.NaN, np.NaN]
-     }),
-    )
-])
-async def test_import_sub_activity(
-        mocker, mailchimp_list, api_results, output_df):
-    """Tests the import_sub_activity function."""
-    mocked_asyncio = mocker.patch('app.lists.asyncio')
-    mocked_sem = mocked_asyncio.Semaphore.return_value
-    mocker.patch('app.lists.MailChimpList.get_list_ids',
-                 return_value=['foo', 'bar'])
+async def test_import_members_and_activity_out_of_core(
+        mocker, fake_members_and_activity): # pylint: disable=redefined-outer-name
+    """Tests that a list analyzed out of core is spilled to disk, and
+    matches the same list analyzed in memory."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
+    mocker.patch('app.lists.MailChimpList.make_async_requests',
+                 new=CoroutineMock(side_effect=fake_members_and_activity))
+    mocker.patch('app.lists.MailChimpList.STATS_CHUNK_SIZE', new=2)
+    mocked_datetime = mocker.patch('app.activity.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    in_memory_list, out_of_core_list = [
+        MailChimpList(1, 5001, 'foo-bar1', 'bar1', 'member_activity',
+                      out_of_core=out_of_core)
+        for out_of_core in (False, True)]
+    for mailchimp_list in (in_memory_list, out_of_core_list):
+        await mailchimp_list.import_members_and_activity()
+    assert in_memory_list.spill is None
+    assert out_of_core_list.df is None
+    assert isinstance(out_of_core_list.get_column('id'), np.memmap)
+    assert out_of_core_list.get_column('recent_open').tolist() == [
+        None, None, pd.Timestamp('2000-10-01').value]
+    assert out_of_core_list.subscribers == 2
+    assert out_of_core_list.compute_all_stats(
+        '10', '1999-1-1T00:00:00+00:00', '365') == (
+            in_memory_list.compute_all_stats(
+                '10', '1999-1-1T00:00:00+00:00', '365'))
+    assert out_of_core_list.get_list_as_csv().getvalue() == (
+        in_memory_list.get_list_as_csv().getvalue())
+
+def test_close(mailchimp_list):
+    """Tests that closing a list removes its spill from disk."""
+    mailchimp_list.spill = ColumnSpill(
+        MemberBuffer.DTYPES, {'status': MemberBuffer.STATUSES})
+    path = mailchimp_list.spill.tmp_dir.name
+    mailchimp_list.close()
+    assert mailchimp_list.spill is None
+    assert not os.path.exists(path)
+    mailchimp_list.close()
+
+def test_save_snapshot_out_of_core(mailchimp_list, snapshot_df):
+    """Tests that a spilled list's snapshot is saved straight from the
+    spill, and loads back as a dataframe."""
+    mailchimp_list.spill = ColumnSpill(
+        MemberBuffer.DTYPES, {'status': MemberBuffer.STATUSES})
+    mailchimp_list.spill.append(0, {
+        'status': np.array([0, 3, 0], dtype=np.int8),
+        'timestamp_opt': snapshot_df['timestamp_opt'].values,
+        'timestamp_signup': snapshot_df['timestamp_opt'].values,
+        'avg_open_rate': snapshot_df['avg_open_rate'].values,
+        'avg_click_rate': snapshot_df['avg_open_rate'].values,
+        'id': snapshot_df['id'].values})
+    mailchimp_list.spill.finish()
+    mailchimp_list.merge_recent_opens([
+        {'ids': np.array([b'bar'], dtype='S32'),
+         'recent_opens': np.array(['2000-10-01'], dtype='datetime64[ns]')}])
+    mailchimp_list.save_snapshot(datetime.datetime.now(datetime.timezone.utc))
+    df, _ = mailchimp_list.load_snapshot() # pylint: disable=invalid-name
+    assert df['status'].tolist() == [
+        MemberBuffer.STATUSES[0], MemberBuffer.STATUSES[3],
+        MemberBuffer.STATUSES[0]]
+    assert df['id'].tolist() == [b'foo', b'bar', b'baz']
+    assert df['recent_open'].tolist() == [
+        pd.NaT, pd.Timestamp('2000-10-01'), pd.NaT]
+
+@pytest.mark.asyncio
+async def test_import_members_and_activity_resume(
+        mocker, fake_members_and_activity): # pylint: disable=redefined-outer-name
+    """Tests that the import_members_and_activity function only requests
+    the activity of chunks not checkpointed by a previous attempt."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
     mocked_make_async_requests = mocker.patch(
-        'app.lists.MailChimpList.make_async_requests')
-    mocked_asyncio.gather = CoroutineMock(return_value=api_results)
-    mocked_datetime = mocker.patch('app.lists.datetime')
+        'app.lists.MailChimpList.make_async_requests',
+        new=CoroutineMock(side_effect=fake_members_and_activity))
+    mailchimp_list = MailChimpList(
+        1, 5001, 'foo-bar1', 'bar1', 'member_activity', run_id='qux')
+    mailchimp_list.save_checkpoint(
+        'chunk-activity-0', ids=np.array([b'foo'], dtype='S32'),
+        recent_opens=np.array(['2000-12-01'], dtype='datetime64[ns]'))
+    await mailchimp_list.import_members_and_activity()
+    assert mocked_make_async_requests.call_count == 3
+    assert mailchimp_list.df['recent_open'].tolist()[0] == (
+        pd.Timestamp('2000-12-01'))
+
+@pytest.mark.asyncio
+async def test_import_members_and_activity_error(mocker):
+    """Tests that the import_members_and_activity function cancels the
+    activity import when the members import fails."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
+    cancelled_requests = []
+
+    async def make_async_requests(sem, url, params, session): # pylint: disable=unused-argument
+        if url.endswith('/members'):
+            if params[-1] == ('offset', '0'):
+                return {'members': [{'id': 'foo', 'status': 'subscribed'}]}
+            await asyncio.sleep(0.01)
+            raise MailChimpImportError('foo', 'bar')
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled_requests.append(url)
+            raise
+    mocker.patch('app.lists.MailChimpList.make_async_requests',
+                 new=CoroutineMock(side_effect=make_async_requests))
+    mailchimp_list = MailChimpList(
+        1, 5001, 'foo-bar1', 'bar1', 'member_activity')
+    with pytest.raises(MailChimpImportError):
+        await asyncio.wait_for(
+            mailchimp_list.import_members_and_activity(), 1)
+    await asyncio.sleep(0)
+    assert cancelled_requests == [
+        'https://bar1.api.mailchimp.com/3.0/lists/1/members/foo/activity']
+
+@pytest.mark.asyncio
+async def test_update_refreshes_unchanged_members(mocker, snapshot_df):
+    """Tests that an incremental update refreshes the open rate and recent
+    open of a member who hasn't changed since the previous analysis, even
+    if the list imports member activity."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
+    mocked_datetime = mocker.patch('app.activity.datetime')
     mocked_datetime.now.return_value = datetime.datetime(
         2001, 1, 1, tzinfo=datetime.timezone.utc)
-    mailchimp_list.df = pd.DataFrame({'id': ['foo', 'bar']})
-    await mailchimp_list.import_sub_activity()
-    mocked_asyncio.Semaphore.assert_called_with(
-        mailchimp_list.MAX_ACTIVITY_CONNECTIONS)
-    async_requests_calls_args_list = [
-        arg
-        for args, _ in mocked_make_async_requests.call_args_list
-        for arg in args]
-    assert all(
-        request_arg in async_requests_calls_args_list
-        for request_arg in [
-            mocked_sem,
-            'https://bar1.api.mailchimp.com/3.0/lists/1/members/foo/activity',
-            'https://bar1.api.mailchimp.com/3.0/lists/1/members/bar/activity',
-        ])
-    args, _ = mocked_asyncio.gather.call_args
-    assert len(args) == 2
-    assert_frame_equal(output_df, mailchimp_list.df)
-
-def test_get_list_ids(mailchimp_list):
-    """Tests the get_list_ids function."""
+    mocked_make_async_requests = mocker.patch(
+        'app.lists.MailChimpList.make_async_requests',
+        new=CoroutineMock(return_value={'members': [
+            {'id': 'foo', 'status': 'subscribed',
+             'stats': {'avg_open_rate': 0.5}},
+            {'id': 'bar', 'status': 'subscribed'},
+            {'id': 'baz', 'status': 'subscribed'}]}))
+    mocker.patch(
+        'app.lists.MailChimpList.make_paginated_requests',
+        new=CoroutineMock(side_effect=[
+            [{'id': 'qux'}],
+            [{'email_id': 'foo', 'opens': [
+                {'timestamp': '2000-12-01T00:00:00+00:00'}]}]]))
+    mailchimp_list = MailChimpList(
+        1, 3, 'foo-bar1', 'bar1', 'member_activity')
+    await mailchimp_list.update_members(snapshot_df)
+    await mailchimp_list.update_recent_activity(
+        datetime.datetime(2000, 11, 15, tzinfo=datetime.timezone.utc))
+    assert mocked_make_async_requests.call_count == 1
+    assert mailchimp_list.df['avg_open_rate'].tolist()[0] == 0.5
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.Timestamp('2000-12-01'), pd.Timestamp('2000-11-01'), pd.NaT]
+
+def test_save_load_snapshot(mailchimp_list, snapshot_df):
+    """Tests saving and loading a list's snapshot."""
+    assert mailchimp_list.load_snapshot() is None
+    mailchimp_list.df = snapshot_df
+    analysis_timestamp = datetime.datetime(
+        2001, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list.save_snapshot(analysis_timestamp)
+    df, loaded_timestamp = mailchimp_list.load_snapshot() # pylint: disable=invalid-name
+    assert_frame_equal(df, snapshot_df)
+    assert loaded_timestamp == analysis_timestamp
+
+def test_snapshot_versions(mailchimp_list, snapshot_df):
+    """Tests loading a list's snapshot from a previous analysis."""
+    assert mailchimp_list.get_snapshot_versions() == []
+    mailchimp_list.df = snapshot_df
+    first_version = mailchimp_list.save_snapshot(
+        datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+    mailchimp_list.df = snapshot_df[:1]
+    second_version = mailchimp_list.save_snapshot(
+        datetime.datetime(2000, 2, 1, tzinfo=datetime.timezone.utc))
+    assert mailchimp_list.get_snapshot_versions() == [
+        first_version, second_version]
+    df, _ = mailchimp_list.load_snapshot() # pylint: disable=invalid-name
+    assert len(df) == 1
+    df, _ = mailchimp_list.load_snapshot(first_version) # pylint: disable=invalid-name
+    assert_frame_equal(df, snapshot_df)
+
+def test_use_snapshot(mailchimp_list, snapshot_df):
+    """Tests that a list's members can be loaded from its latest snapshot,
+    but only when asked to."""
+    mailchimp_list.df = snapshot_df
+    analysis_timestamp = datetime.datetime(
+        2000, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list.save_snapshot(analysis_timestamp)
+    other_list = MailChimpList(
+        mailchimp_list.id, 3, mailchimp_list.api_key,
+        mailchimp_list.data_center)
+    assert other_list.df is None
+    assert other_list.use_snapshot() == analysis_timestamp
+    assert_frame_equal(other_list.df, snapshot_df)
+
+def test_use_snapshot_missing(mailchimp_list):
+    """Tests that the df is left as it was if the list hasn't been
+    snapshotted."""
+    assert mailchimp_list.use_snapshot() is None
+    assert mailchimp_list.df is None
+
+def test_get_subscriber_rows(mailchimp_list):
+    """Tests the get_subscriber_rows function."""
     mailchimp_list.df = pd.DataFrame({
-        'id': ['foo', 'bar', 'baz'],
-        'status': ['subscribed', 'unsubscribed', 'subscribed']
-    })
-    assert mailchimp_list.get_list_ids() == ['foo', 'baz']
+        'status': ['subscribed', 'unsubscribed', 'subscribed']})
+    rows = mailchimp_list.get_subscriber_rows()
+    assert rows.dtype == np.int32
+    assert rows.tolist() == [0, 2]
 
 def test_flatten(mailchimp_list):
     """Tests the flatten function."""
@@ -330,13 +742,9 @@ def test_flatten(mailchimp_list):
         'timestamp_opt': ['foo', 'bar'],
         'timestamp_signup': ['foo', 'bar'],
         'recent_open': ['bar', 'baz'],
-        'stats': [{
-            'stats1': 'foo',
-            'stats2': 'bar'
-        }, {
-            'stats1': 'quux',
-            'stats2': 'quuz'
-        }]
+        'avg_open_rate': [0.1, 0.2],
+        'avg_click_rate': [0.3, 0.4],
+        'foo': ['bar', 'baz']
     })
     mailchimp_list.flatten()
     assert_frame_equal(
@@ -347,72 +755,12 @@ def test_flatten(mailchimp_list):
             'timestamp_opt': ['foo', 'bar'],
             'timestamp_signup': ['foo', 'bar'],
             'recent_open': ['bar', 'baz'],
-            'stats1': ['foo', 'quux'],
-            'stats2': ['bar', 'quuz']
+            'avg_open_rate': [0.1, 0.2],
+            'avg_click_rate': [0.3, 0.4]
         }),
         check_like=True
     )
 
-def test_calc_list_breakdown(mailchimp_list):
-    """Tests the calc_list_breakdown function."""
-    mailchimp_list.df = pd.DataFrame({
-        'status': ['subscribed', 'subscribed', 'unsubscribed', 'pending']
-    })
-    mailchimp_list.count = 4
-    mailchimp_list.calc_list_breakdown()
-    assert mailchimp_list.subscribed_pct == 0.5
-    assert mailchimp_list.unsubscribed_pct == 0.25
-    assert mailchimp_list.cleaned_pct == 0
-    assert mailchimp_list.pending_pct == 0.25
-
-def test_calc_open_rate(mailchimp_list):
-    """Tests the calc_open_rate function."""
-    mailchimp_list.calc_open_rate('10')
-    assert mailchimp_list.open_rate == 0.1
-
-@pytest.mark.parametrize('campaign_count, expected_frequency', [
-    ('5', 0), ('365', 1)])
-def test_calc_frequency(
-        mocker, mailchimp_list, campaign_count, expected_frequency):
-    """Tests the calc_frequency function."""
-    mocked_datetime = mocker.patch('app.lists.datetime')
-    mocked_datetime.now.return_value = datetime.datetime(
-        2000, 1, 1, tzinfo=datetime.timezone.utc)
-    mailchimp_list.calc_frequency(
-        '1999-1-1T00:00:00+00:00', campaign_count)
-    assert mailchimp_list.frequency == expected_frequency
-
-def test_calc_histogram(mailchimp_list):
-    """Tests the calc_histogram function."""
-    mailchimp_list.df = pd.DataFrame({
-        'status': ['subscribed', 'subscribed', 'subscribed',
-                   'subscribed', 'cleaned', 'subscribed'],
-        'avg_open_rate': [0, 0.09, 0.56, 0.81, 0.87, 1]
-    })
-    mailchimp_list.calc_histogram()
-    assert mailchimp_list.hist_bin_counts == (
-        [2, 0, 0, 0, 0, 1, 0, 0, 1, 1])
-
-def test_calc_high_rate_pct(mailchimp_list):
-    """Tests the calc_high_open_rate_pct function."""
-    mailchimp_list.df = pd.DataFrame({
-        'status': ['subscribed', 'subscribed', 'subscribed',
-                   'subscribed', 'cleaned', 'subscribed'],
-        'avg_open_rate': [0, 0.09, 0.56, 0.81, 0.87, 1]
-    })
-    mailchimp_list.subscribers = 5
-    mailchimp_list.calc_high_open_rate_pct()
-    assert mailchimp_list.high_open_rt_pct == 0.4
-
-def test_calc_cur_yr_stats(mailchimp_list):
-    """Tests the calc_cur_yr_stats function."""
-    mailchimp_list.df = pd.DataFrame({
-        'recent_open': ['foo', 'bar', np.NaN, np.NaN, 'baz']
-    })
-    mailchimp_list.subscribers = 4
-    mailchimp_list.calc_cur_yr_stats()
-    assert mailchimp_list.cur_yr_inactive_pct == 0.25
-
 def test_get_list_as_csv(mailchimp_list):
     """Tests the get_list_as_csv."""
     mailchimp_list.df = pd.DataFrame(
@@ -420,3 +768,26 @@ def test_get_list_as_csv(mailchimp_list):
          'col2': ['bar', 'baz']})
     csv_buffer = mailchimp_list.get_list_as_csv()
     assert csv_buffer.getvalue() == 'col1,col2\nfoo,bar\nbar,baz\n'
+
+def test_get_list_as_csv_bytes_ids(mailchimp_list):
+    """Tests that get_list_as_csv decodes member ids stored as bytes."""
+    mailchimp_list.df = pd.DataFrame({'col1': ['foo', 'bar']})
+    mailchimp_list.df['id'] = np.array([b'baz', b'qux'], dtype='S32')
+    csv_buffer = mailchimp_list.get_list_as_csv()
+    assert csv_buffer.getvalue() == 'col1,id\nfoo,baz\nbar,qux\n'
+
+def test_get_list_as_csv_from_snapshot(mocker, mailchimp_list, snapshot_df):
+    """Tests that get_list_as_csv exports a list which wasn't imported
+    from its latest snapshot, chunk by chunk."""
+    mocker.patch('app.lists.MailChimpList.CSV_CHUNK_SIZE', new=2)
+    mailchimp_list.df = snapshot_df
+    expected_csv = mailchimp_list.get_list_as_csv().getvalue()
+    mailchimp_list.save_snapshot(datetime.datetime.now(datetime.timezone.utc))
+    other_list = MailChimpList(
+        mailchimp_list.id, 3, mailchimp_list.api_key,
+        mailchimp_list.data_center)
+    spy = mocker.spy(other_list, 'load_snapshot')
+    assert other_list.get_list_as_csv().getvalue() == expected_csv
+    assert not spy.called
+    assert expected_csv.count('status') == 1
+    assert 'foo' in expected_csv
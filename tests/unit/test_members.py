@@ -0,0 +1,215 @@
+from collections import OrderedDict
+from unittest.mock import ANY
+import asyncio
+import pytest
+from asynctest import CoroutineMock
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+import numpy as np
+from app.lists import MailChimpImportError, MailChimpList
+from app.members import MemberBuffer
+
+@pytest.mark.asyncio
+async def test_import_list_members_batch_operations(
+        mocker, fake_batch_server, batch_mailchimp_list):
+    """Tests the import_list_members function when using the batch
+    operations backend."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
+    fake_batch_server.responses = {
+        '/lists/1/members': {'members': [{'id': 'foo', 'status': 'cleaned'}]}}
+    await batch_mailchimp_list.import_list_members()
+    operation, = fake_batch_server.submitted[0]['operations']
+    assert operation['operation_id'] == 'members-0'
+    assert operation['params']['offset'] == '0'
+    assert batch_mailchimp_list.df['id'].tolist() == [b'foo']
+
+@pytest.mark.asyncio
+async def test_import_list_members(mocker, mailchimp_list):
+    """Tests the import_list_members function."""
+    mocked_enable_proxy = mocker.patch(
+        'app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
+    mocked_semaphore = mocker.patch('app.members.AdaptiveConcurrencyLimiter')
+    mocked_make_async_requests = mocker.patch(
+        'app.lists.MailChimpList.make_async_requests', new=CoroutineMock(
+            side_effect=[{'members': [{'id': 'foo', 'status': 'subscribed'}]},
+                         {'members': [{'id': 'bar', 'status': 'cleaned'}]},
+                         {'members': [{'id': 'baz', 'status': 'pending'}]}]))
+    mailchimp_list.count = 10020
+    await mailchimp_list.import_list_members()
+    mocked_enable_proxy.assert_called()
+    mocked_semaphore.assert_called_with(
+        mailchimp_list.MAX_CONNECTIONS, mailchimp_list.MAX_API_CONNECTIONS)
+    async_requests_calls_args_list = [
+        arg
+        for args, _ in mocked_make_async_requests.call_args_list
+        for arg in args]
+    assert all(
+        requests_arg in async_requests_calls_args_list
+        for requests_arg in [
+            'https://bar1.api.mailchimp.com/3.0/lists/1/members',
+            (ANY, ('count', '5000'), ('offset', '0')),
+            (ANY, ('count', '5000'), ('offset', '5000')),
+            (ANY, ('count', '20'), ('offset', '10000')),
+            mocked_semaphore.return_value
+        ])
+    assert mocked_make_async_requests.call_count == 3
+    assert mailchimp_list.df['id'].tolist() == [b'foo', b'bar', b'baz']
+    assert mailchimp_list.df['status'].tolist() == [
+        'subscribed', 'cleaned', 'pending']
+    assert mailchimp_list.df['avg_open_rate'].isnull().all()
+
+@pytest.mark.asyncio
+async def test_import_list_members_cancels_on_error(mocker, mailchimp_list):
+    """Tests that the import_list_members function cancels the remaining
+    chunks as soon as one fails, and reports how many had completed."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
+    cancelled = []
+
+    async def make_async_requests(sem, url, params, session): # pylint: disable=unused-argument
+        if params[2] == ('offset', '0'):
+            return {'members': [{'id': 'foo', 'status': 'subscribed'}]}
+        if params[2] == ('offset', '5000'):
+            await asyncio.sleep(0)
+            raise MailChimpImportError('foo', OrderedDict())
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append(params[2])
+            raise
+
+    mocker.patch('app.lists.MailChimpList.make_async_requests',
+                 new=CoroutineMock(side_effect=make_async_requests))
+    mailchimp_list.count = 15020
+    with pytest.raises(MailChimpImportError) as e:
+        await mailchimp_list.import_list_members()
+    assert cancelled == [('offset', '10000'), ('offset', '15000')]
+    assert e.value.error_details == OrderedDict([
+        ('member_chunks_completed', '1 of 4')])
+
+@pytest.mark.asyncio
+async def test_import_list_members_resume(mocker):
+    """Tests that the import_list_members function checkpoints chunks, and
+    only requests chunks not checkpointed by a previous attempt."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
+    mocked_make_async_requests = mocker.patch(
+        'app.lists.MailChimpList.make_async_requests', new=CoroutineMock(
+            side_effect=[{'members': [{'id': 'foo', 'status': 'subscribed'}]},
+                         {'members': [{'id': 'bar', 'status': 'cleaned'}]}]))
+    member_buffer = MemberBuffer()
+    member_buffer.append(0, [{'id': 'qux', 'status': 'pending'}])
+    mailchimp_list = MailChimpList(1, 5020, 'foo-bar1', 'bar1', run_id='baz')
+    mailchimp_list.save_checkpoint('members-0', **member_buffer.chunks[0])
+    await mailchimp_list.import_list_members()
+    args, _ = mocked_make_async_requests.call_args
+    assert args[2][-1] == ('offset', '5000')
+    assert mocked_make_async_requests.call_count == 1
+    assert mailchimp_list.df['id'].tolist() == [b'qux', b'foo']
+    resumed_list = MailChimpList(1, 5020, 'foo-bar1', 'bar1', run_id='baz')
+    await resumed_list.import_list_members()
+    assert mocked_make_async_requests.call_count == 1
+    assert_frame_equal(resumed_list.df, mailchimp_list.df)
+
+@pytest.mark.asyncio
+async def test_import_list_members_queue(mocker, mailchimp_list):
+    """Tests that the import_list_members function queues each chunk's
+    subscribers, followed by None."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
+    mocker.patch(
+        'app.lists.MailChimpList.make_async_requests', new=CoroutineMock(
+            side_effect=[{'members': [{'id': 'foo', 'status': 'subscribed'},
+                                      {'id': 'bar', 'status': 'cleaned'}]},
+                         {'members': [{'id': 'baz', 'status': 'subscribed'}]}]))
+    mailchimp_list.count = 5020
+    subscriber_queue = asyncio.Queue()
+    await mailchimp_list.import_list_members(subscriber_queue)
+    queued_chunks = [subscriber_queue.get_nowait() for _ in range(3)]
+    assert subscriber_queue.empty()
+    assert queued_chunks[-1] is None
+    assert sorted(queued_chunks[:-1]) == [(0, ['foo']), (1, ['baz'])]
+
+@pytest.mark.asyncio
+async def test_import_list_members_queue_error(mocker, mailchimp_list):
+    """Tests that the import_list_members function still queues None when
+    the import fails."""
+    mocker.patch('app.lists.MailChimpList.enable_proxy', new=CoroutineMock())
+    mocker.patch(
+        'app.lists.MailChimpList.make_async_requests', new=CoroutineMock(
+            side_effect=MailChimpImportError('foo', 'bar')))
+    subscriber_queue = asyncio.Queue()
+    with pytest.raises(MailChimpImportError):
+        await mailchimp_list.import_list_members(subscriber_queue)
+    assert subscriber_queue.get_nowait() is None
+
+def test_member_buffer():
+    """Tests that the MemberBuffer reassembles chunks in list order."""
+    member_buffer = MemberBuffer()
+    member_buffer.append(1, [{'id': 'bar', 'status': 'cleaned',
+                              'timestamp_opt': ''}])
+    member_buffer.append(0, [{'id': 'foo', 'status': 'subscribed',
+                              'timestamp_opt': '2000-01-01T00:00:00+00:00',
+                              'stats': {'avg_open_rate': 0.5}}])
+    df = member_buffer.to_frame()
+    assert df.columns.tolist() == list(MemberBuffer.COLUMNS)
+    assert df['id'].tolist() == [b'foo', b'bar']
+    assert df['status'].tolist() == ['subscribed', 'cleaned']
+    assert df['timestamp_opt'].tolist() == [pd.Timestamp('2000-01-01'), pd.NaT]
+    assert df['avg_open_rate'].tolist()[0] == 0.5
+    assert df['avg_click_rate'].isnull().all()
+
+def test_member_buffer_dtypes():
+    """Tests that the MemberBuffer produces a compact, typed dataframe."""
+    member_buffer = MemberBuffer()
+    member_buffer.append(0, [{
+        'id': 'a' * 32, 'status': 'pending',
+        'timestamp_opt': '2000-01-01T00:00:00+00:00',
+        'timestamp_signup': '2000-01-01T05:00:00+05:00',
+        'stats': {'avg_open_rate': 0.1, 'avg_click_rate': 0.2}}])
+    df = member_buffer.to_frame()
+    assert df['status'].dtype.name == 'category'
+    assert df['avg_open_rate'].dtype == np.float32
+    assert df['avg_click_rate'].dtype == np.float32
+    assert df['timestamp_opt'].dtype == np.dtype('datetime64[ns]')
+    assert df['timestamp_signup'].tolist() == [pd.Timestamp('2000-01-01')]
+    assert df['id'].dtype == np.dtype('S32')
+
+@pytest.mark.parametrize('timestamps, expected', [
+    (['2000-01-01T00:00:00+00:00', ''],
+     [pd.Timestamp('2000-01-01'), pd.NaT]),
+    (['2000-01-01T05:00:00+05:00', '2000-01-01T00:00:00+00:00'],
+     [pd.Timestamp('2000-01-01'), pd.Timestamp('2000-01-01')]),
+    (['foo+00:00', None, np.nan],
+     [pd.NaT, pd.NaT, pd.NaT])])
+def test_member_buffer_parse_timestamps(timestamps, expected):
+    """Tests parsing UTC timestamps directly, and falling back to pandas
+    for other offsets and invalid timestamps."""
+    parsed = MemberBuffer.parse_timestamps(timestamps)
+    assert parsed.dtype == np.dtype('datetime64[ns]')
+    assert pd.Series(parsed).tolist() == expected
+
+def test_member_buffer_empty():
+    """Tests the MemberBuffer when no members have been added."""
+    df = MemberBuffer().to_frame()
+    assert df.empty
+    assert df.columns.tolist() == list(MemberBuffer.COLUMNS)
+
+@pytest.mark.asyncio
+async def test_update_members(mocker, mailchimp_list, snapshot_df):
+    """Tests that the update_members function imports every member,
+    keeping their previous recent opens."""
+    member_buffer = MemberBuffer()
+    member_buffer.append(0, [{'id': 'bar', 'status': 'unsubscribed'},
+                             {'id': 'foo', 'status': 'subscribed'},
+                             {'id': 'qux', 'status': 'subscribed'}])
+
+    async def import_list_members():
+        mailchimp_list.df = member_buffer.to_frame()
+    mocked_import_list_members = mocker.patch(
+        'app.lists.MailChimpList.import_list_members',
+        new=CoroutineMock(side_effect=import_list_members))
+    await mailchimp_list.update_members(snapshot_df)
+    mocked_import_list_members.assert_called_once_with()
+    assert mailchimp_list.df['id'].tolist() == [b'bar', b'foo', b'qux']
+    assert mailchimp_list.df['status'].tolist() == [
+        'unsubscribed', 'subscribed', 'subscribed']
+    assert mailchimp_list.df['recent_open'].tolist() == [
+        pd.Timestamp('2000-11-01'), pd.Timestamp('2000-06-01'), pd.NaT]
@@ -0,0 +1,216 @@
+import asyncio
+import pytest
+from aiohttp import ClientSession
+from app.proxies import (
+    ProxyPool, ProxyProvider, ProxyError, open_worker_proxy_pool)
+
+@pytest.mark.asyncio
+async def test_provider_rotate(fake_proxy_provider):
+    """Tests rotating a proxy process."""
+    provider = ProxyProvider(str(fake_proxy_provider.make_url('/api.php')))
+    async with ClientSession() as session:
+        proxy = await provider.rotate(session, 3)
+    assert proxy == 'http://{}:{}'.format(
+        fake_proxy_provider.host, fake_proxy_provider.port)
+    assert fake_proxy_provider.rotations == ['3']
+
+@pytest.mark.asyncio
+async def test_provider_rotate_error(fake_proxy_provider):
+    """Tests rotating a proxy process when the provider returns an error."""
+    fake_proxy_provider.error = 'foo'
+    provider = ProxyProvider(str(fake_proxy_provider.make_url('/api.php')))
+    async with ClientSession() as session:
+        with pytest.raises(ProxyError, match='foo'):
+            await provider.rotate(session, 3)
+
+@pytest.mark.asyncio
+async def test_provider_rotate_unreachable(unused_tcp_port):
+    """Tests rotating a proxy process when the provider is down."""
+    provider = ProxyProvider('http://127.0.0.1:{}/api.php'.format(
+        unused_tcp_port))
+    async with ClientSession() as session:
+        with pytest.raises(ProxyError, match='proxy provider down'):
+            await provider.rotate(session, 3)
+
+@pytest.mark.asyncio
+async def test_provider_rotate_timeout(unused_tcp_port):
+    """Tests rotating a proxy process when the provider doesn't respond."""
+    server = await asyncio.start_server(
+        lambda reader, writer: None, '127.0.0.1', unused_tcp_port)
+    provider = ProxyProvider('http://127.0.0.1:{}/api.php'.format(
+        unused_tcp_port))
+    provider.TIMEOUT = 0.1
+    async with ClientSession() as session:
+        with pytest.raises(ProxyError, match='proxy provider down'):
+            await provider.rotate(session, 3)
+    server.close()
+    await server.wait_closed()
+
+@pytest.mark.parametrize('index, size, process_numbers', [
+    (0, 1, [1]),
+    (5, 1, [6]),
+    (2, 3, [7, 8, 9])])
+def test_get_process_numbers(mocker, index, size, process_numbers):
+    """Tests that each worker controls its own proxy processes."""
+    mocked_current_process = mocker.patch('app.proxies.current_process')
+    mocked_current_process.return_value.index = index
+    assert list(ProxyPool.get_process_numbers(size)) == process_numbers
+
+def test_get_process_numbers_no_index(mocker):
+    """Tests falling back to the first proxy process when the worker's
+    index is unknown."""
+    mocked_current_process = mocker.patch('app.proxies.current_process')
+    del mocked_current_process.return_value.index
+    assert list(ProxyPool.get_process_numbers(2)) == [1, 2]
+
+@pytest.mark.asyncio
+async def test_get(proxy_pool, fake_proxy_provider): # pylint: disable=redefined-outer-name
+    """Tests that the pool hands out its proxies in turn, and only health
+    checks each one the first time."""
+    proxy = 'http://{}:{}'.format(
+        fake_proxy_provider.host, fake_proxy_provider.port)
+    assert [await proxy_pool.get() for _ in range(3)] == [proxy] * 3
+    assert fake_proxy_provider.rotations == ['1', '2']
+    assert fake_proxy_provider.health_checks == 2
+    assert proxy_pool.next_index == 3
+
+@pytest.mark.asyncio
+async def test_get_waits_for_boot(mocker, proxy_pool): # pylint: disable=redefined-outer-name
+    """Tests that proxies aren't handed out until they've booted."""
+    mocked_sleep = mocker.patch('app.proxies.asyncio.sleep')
+    mocked_sleep.return_value = asyncio.Future()
+    mocked_sleep.return_value.set_result(None)
+    proxy_pool.BOOT_TIME = 30
+    await proxy_pool.warm()
+    await proxy_pool.get()
+    assert 29 < mocked_sleep.call_args[0][0] <= 30
+
+@pytest.mark.asyncio
+async def test_get_unhealthy(proxy_pool, fake_proxy_provider): # pylint: disable=redefined-outer-name
+    """Tests that proxies which fail their health check are rotated."""
+    fake_proxy_provider.healthy = False
+    assert await proxy_pool.get() is None
+    assert fake_proxy_provider.health_checks == 4
+    assert 'failed its health check' in proxy_pool.error
+
+    # The failed proxies are still rotated, ready for the next request
+    assert sorted(proxy_pool.rotations) == [1, 2]
+    await asyncio.gather(*proxy_pool.rotations.values())
+    assert sorted(proxy_pool.proxies) == [1, 2]
+    assert not proxy_pool.healthy
+
+@pytest.mark.asyncio
+async def test_get_provider_error(proxy_pool, fake_proxy_provider): # pylint: disable=redefined-outer-name
+    """Tests that no proxy is handed out when the provider fails."""
+    fake_proxy_provider.error = 'foo'
+    assert await proxy_pool.get() is None
+    assert proxy_pool.error == 'foo'
+    assert not proxy_pool.proxies
+
+@pytest.mark.asyncio
+async def test_warm(proxy_pool, fake_proxy_provider): # pylint: disable=redefined-outer-name
+    """Tests booting every proxy in the pool up front."""
+    await proxy_pool.warm()
+    assert sorted(fake_proxy_provider.rotations) == ['1', '2']
+    assert sorted(proxy_pool.proxies) == [1, 2]
+    assert not proxy_pool.rotations
+    await proxy_pool.warm()
+    assert len(fake_proxy_provider.rotations) == 2
+
+@pytest.mark.asyncio
+async def test_report_failure(proxy_pool, fake_proxy_provider): # pylint: disable=redefined-outer-name
+    """Tests that a failed proxy is rotated, but only once."""
+    await proxy_pool.warm()
+    proxy_pool.proxies[2] = 'http://foo:1'
+    proxy_pool.healthy.add('http://foo:1')
+    proxy_pool.report_failure('http://foo:1')
+    proxy_pool.report_failure('http://foo:1')
+    assert 2 not in proxy_pool.proxies
+    assert 'http://foo:1' not in proxy_pool.healthy
+    await proxy_pool.rotations[2]
+    assert fake_proxy_provider.rotations[2:] == ['2']
+    assert proxy_pool.proxies[2] != 'http://foo:1'
+
+@pytest.mark.asyncio
+async def test_is_current(proxy_pool): # pylint: disable=redefined-outer-name
+    """Tests telling whether a proxy has been rotated."""
+    await proxy_pool.warm()
+    proxy_pool.proxies[2] = 'http://foo:1'
+    assert proxy_pool.is_current('http://foo:1')
+    proxy_pool.report_failure('http://foo:1')
+    assert not proxy_pool.is_current('http://foo:1')
+    await proxy_pool.rotations[2]
+
+def test_has_other_ready_proxy(mocker, proxy_pool): # pylint: disable=redefined-outer-name
+    """Tests that only other booted, healthy proxies count as ready."""
+    mocked_time = mocker.patch('app.proxies.time')
+    mocked_time.monotonic.return_value = 10
+    proxy_pool.proxies = {1: 'http://foo:1', 2: 'http://foo:2'}
+    proxy_pool.ready_at = {1: 0, 2: 0}
+    proxy_pool.healthy = {'http://foo:1'}
+    assert not proxy_pool.has_other_ready_proxy('http://foo:1')
+    assert proxy_pool.has_other_ready_proxy('http://foo:2')
+    proxy_pool.healthy.add('http://foo:2')
+    proxy_pool.ready_at[2] = 20
+    assert not proxy_pool.has_other_ready_proxy('http://foo:1')
+    proxy_pool.ready_at[2] = 5
+    assert proxy_pool.has_other_ready_proxy('http://foo:1')
+
+def test_open(mocker, monkeypatch):
+    """Tests that opening a worker's pool boots its proxies on the
+    worker's event loop."""
+    monkeypatch.delenv('NO_PROXY', raising=False)
+    mocked_connections = mocker.patch('app.proxies.WorkerConnections')
+    mocked_connections.loop = asyncio.new_event_loop()
+    mocked_create = mocker.patch('app.proxies.ProxyPool.create')
+    warmed = []
+
+    async def warm():
+        warmed.append(True)
+    mocked_create.return_value.warm = warm
+    open_worker_proxy_pool()
+    assert ProxyPool.worker_pool is mocked_create.return_value
+    assert warmed == [True]
+    ProxyPool.worker_pool = None
+    mocked_connections.loop.close()
+
+def test_open_slow_provider(mocker, monkeypatch):
+    """Tests that a starting worker doesn't wait for slow rotations, which
+    carry on when the worker's event loop next runs."""
+    monkeypatch.delenv('NO_PROXY', raising=False)
+    mocked_connections = mocker.patch('app.proxies.WorkerConnections')
+    loop = mocked_connections.loop = asyncio.new_event_loop()
+    mocked_create = mocker.patch('app.proxies.ProxyPool.create')
+    mocker.patch('app.proxies.ProxyPool.WARM_TIMEOUT', new=0.01)
+    rotated = asyncio.Event(loop=loop)
+
+    async def warm():
+        await asyncio.sleep(0.1)
+        rotated.set()
+    mocked_create.return_value.warm = warm
+    started = loop.time()
+    ProxyPool.open()
+    assert loop.time() - started < 0.1
+    assert not rotated.is_set()
+    loop.run_until_complete(asyncio.wait_for(rotated.wait(), 1, loop=loop))
+    ProxyPool.worker_pool = None
+    loop.close()
+
+def test_open_no_proxy(mocker, monkeypatch):
+    """Tests that a worker doesn't open a pool when proxying is disabled."""
+    monkeypatch.setenv('NO_PROXY', 'true')
+    mocked_create = mocker.patch('app.proxies.ProxyPool.create')
+    ProxyPool.open()
+    assert ProxyPool.worker_pool is None
+    mocked_create.assert_not_called()
+
+def test_get_pool(mocker):
+    """Tests that only callers on the worker's event loop get the worker's
+    pool."""
+    mocker.patch('app.proxies.ProxyPool.worker_pool')
+    mocked_create = mocker.patch('app.proxies.ProxyPool.create')
+    mocked_connections = mocker.patch('app.proxies.WorkerConnections')
+    mocked_connections.loop = asyncio.get_event_loop()
+    assert ProxyPool.get_pool() is ProxyPool.worker_pool
+    mocked_connections.loop = None
+    assert ProxyPool.get_pool() is mocked_create.return_value
@@ -406,6 +406,7 @@ def test_analyze_list(client, mocker, fake_list_data):
         sess['data_center'] = 'bar1'
         sess['monthly_updates'] = True
         sess['store_aggregates'] = False
+        sess['activity_strategy'] = 'campaign_reports'
         sess['org_id'] = 'bar'
     user_data = {'user_id': sess['user_id'], 'email': sess['email']}
     list_data = {
@@ -415,6 +416,7 @@ def test_analyze_list(client, mocker, fake_list_data):
         'data_center': 'bar1',
         'monthly_updates': True,
         'store_aggregates': False,
+        'activity_strategy': 'campaign_reports',
         'total_count': fake_list_data['total_count'],
         'open_rate': fake_list_data['open_rate'],
         'creation_timestamp': fake_list_data['date_created'],
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+import pytest
+from app.scheduling import ListUpdateScheduler
+
+NOW = datetime(2000, 3, 1, tzinfo=timezone.utc)
+
+def make_analysis(list_id, days_old, subscribers):
+    """Makes a fake ListStats object for a list analyzed days_old ago."""
+    return MagicMock(
+        list_id=list_id, subscribers=subscribers, subscribed_pct=0.5,
+        cur_yr_inactive_pct=0.5,
+        analysis_timestamp=(NOW - timedelta(days=days_old)).replace(
+            tzinfo=None))
+
+def test_estimate_cost(mocker):
+    """Tests estimating the number of requests needed to update a list
+    incrementally."""
+    mocker.patch('app.scheduling.SnapshotStore.get_versions',
+                 return_value=['1'])
+    analysis = make_analysis('foo', 0, 10000)
+    assert ListUpdateScheduler.estimate_cost(analysis) == (
+        20000 / 5000 + 5000 / 1000)
+
+def test_estimate_cost_no_snapshot():
+    """Tests that a list without a snapshot costs a request per
+    subscriber."""
+    analysis = make_analysis('foo', 0, 10000)
+    assert ListUpdateScheduler.estimate_cost(analysis) == (
+        20000 / 5000 + 10000)
+
+def test_estimate_cost_campaign_reports():
+    """Tests that a list imported in full using campaign reports costs a
+    request per chunk of opens."""
+    analysis = make_analysis('foo', 0, 10000)
+    analysis.list.activity_strategy = 'campaign_reports'
+    assert ListUpdateScheduler.estimate_cost(analysis) == (
+        20000 / 5000 + 5000 / 1000)
+
+def test_estimate_cost_out_of_core(mocker, monkeypatch):
+    """Tests that a list analyzed out of core costs a request per
+    subscriber, even with a snapshot."""
+    mocker.patch('app.scheduling.SnapshotStore.get_versions',
+                 return_value=['1'])
+    monkeypatch.setenv('OUT_OF_CORE_MIN_COUNT', '20000')
+    analysis = make_analysis('foo', 0, 10000)
+    assert ListUpdateScheduler.estimate_cost(analysis) == (
+        20000 / 5000 + 10000)
+
+@pytest.mark.parametrize('subscribed_pct', [0, None])
+def test_estimate_cost_no_subscribers(subscribed_pct):
+    """Tests estimating the cost of a list without subscribers."""
+    analysis = make_analysis('foo', 0, 0)
+    analysis.subscribed_pct = subscribed_pct
+    analysis.cur_yr_inactive_pct = None
+    assert ListUpdateScheduler.estimate_cost(analysis) == 0
+
+def test_daily_budget():
+    """Tests that the daily budget spreads the total cost over the update
+    interval."""
+    scheduler = ListUpdateScheduler(
+        [make_analysis('foo', 0, 30000), make_analysis('bar', 0, 30000)],
+        NOW)
+    assert scheduler.costs == {'foo': 30012, 'bar': 30012}
+    assert scheduler.daily_budget == 60024 / 30
+
+def test_schedule_due():
+    """Tests that lists which are due are always updated, costliest first,
+    even if they're over budget."""
+    analyses = [make_analysis('foo', 30, 10000),
+                make_analysis('bar', 31, 20000),
+                make_analysis('baz', 29, 1000),
+                make_analysis('qux', 0, 0)]
+    assert [analysis.list_id for analysis in ListUpdateScheduler(
+        analyses, NOW).schedule()] == ['bar', 'foo']
+
+def test_schedule_early(mocker):
+    """Tests that lists which are nearly due are updated early, oldest
+    first, as long as they fit in the budget."""
+    mocker.patch('app.scheduling.ListUpdateScheduler.estimate_cost',
+                 side_effect=lambda analysis: analysis.subscribers)
+    analyses = [make_analysis('foo', 30, 20),
+                make_analysis('bar', 25, 50),
+                make_analysis('baz', 27, 30),
+                make_analysis('qux', 24, 10),
+                make_analysis('quux', 22, 1),
+                make_analysis('corge', 0, 2889)]
+    scheduler = ListUpdateScheduler(analyses, NOW)
+    assert scheduler.daily_budget == 100
+    assert [analysis.list_id for analysis in scheduler.schedule()] == [
+        'bar', 'baz', 'foo']
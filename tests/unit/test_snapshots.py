@@ -0,0 +1,147 @@
+import os
+import shutil
+from collections import OrderedDict
+from datetime import datetime, timezone
+import pytest
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+from app.snapshots import SnapshotStore
+
+@pytest.fixture
+def snapshot_df():
+    """Provides a members dataframe with every supported column type."""
+    df = pd.DataFrame({ # pylint: disable=invalid-name
+        'status': pd.Categorical(['subscribed', None],
+                                 categories=['subscribed', 'cleaned']),
+        'timestamp_opt': np.array(['2000-01-01T00:00:00', 'NaT'],
+                                  dtype='datetime64[ns]'),
+        'avg_open_rate': np.array([0.5, np.nan], dtype='float32')})
+    df['id'] = np.array(['foo', 'bar'], dtype='S32')
+    yield df
+
+def test_snapshot_store_directory(snapshot_dir):
+    """Tests where the store keeps snapshots."""
+    assert SnapshotStore().get_path('foo') == os.path.join(
+        snapshot_dir, 'foo')
+    assert SnapshotStore().get_path('foo', 'bar') == os.path.join(
+        snapshot_dir, 'foo', 'bar')
+    assert SnapshotStore('bar').get_path('foo') == os.path.join('bar', 'foo')
+
+def test_snapshot_store_default_directory(monkeypatch):
+    """Tests that snapshots are kept outside the deployed application by
+    default."""
+    monkeypatch.delenv('SNAPSHOT_DIR')
+    monkeypatch.setenv('HOME', '/foo')
+    assert SnapshotStore().directory == os.path.join(
+        '/foo', 'benchmarks-snapshots')
+
+def test_snapshot_store_save_load(snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests that a saved snapshot is loaded back unchanged."""
+    analysis_timestamp = datetime(2000, 1, 1, 12, tzinfo=timezone.utc)
+    version = SnapshotStore().save('foo', snapshot_df, analysis_timestamp)
+    assert version == '20000101T120000000000Z'
+    df, loaded_timestamp = SnapshotStore().load('foo') # pylint: disable=invalid-name
+    assert_frame_equal(df, snapshot_df)
+    assert df['id'].dtype == np.dtype('S32')
+    assert loaded_timestamp == analysis_timestamp
+
+def test_snapshot_store_save_columns(snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests saving a snapshot from column arrays, e.g. a spill's."""
+    columns = OrderedDict(
+        (column, snapshot_df[column].values) for column in snapshot_df)
+    columns['status'] = snapshot_df['status'].cat.codes.values
+    store = SnapshotStore()
+    store.save_columns('foo', columns, {'status': ['subscribed', 'cleaned']},
+                       datetime.now(timezone.utc))
+    df, _ = store.load('foo') # pylint: disable=invalid-name
+    assert_frame_equal(df, snapshot_df)
+
+def test_snapshot_store_load_writable(snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests that loaded snapshots are copied out of their memory maps."""
+    SnapshotStore().save('foo', snapshot_df, datetime.now(timezone.utc))
+    df, _ = SnapshotStore().load('foo') # pylint: disable=invalid-name
+    df.loc[0, 'avg_open_rate'] = 1
+    assert df['avg_open_rate'].tolist()[0] == 1
+
+def test_snapshot_store_load_missing():
+    """Tests loading the snapshot of a list which doesn't have one."""
+    assert SnapshotStore().load('foo') is None
+    assert SnapshotStore().load('foo', 'bar') is None
+    assert SnapshotStore().get_versions('foo') == []
+
+def test_snapshot_store_versions(snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests that each analysis is saved as a new version, and that the
+    latest version is loaded by default."""
+    store = SnapshotStore()
+    first_version = store.save(
+        'foo', snapshot_df, datetime(2000, 2, 1, tzinfo=timezone.utc))
+    second_version = store.save(
+        'foo', snapshot_df[['id']], datetime(2000, 3, 1, tzinfo=timezone.utc))
+    assert store.get_versions('foo') == [first_version, second_version]
+    df, analysis_timestamp = store.load('foo') # pylint: disable=invalid-name
+    assert df.columns.tolist() == ['id']
+    assert analysis_timestamp == datetime(2000, 3, 1, tzinfo=timezone.utc)
+    df, analysis_timestamp = store.load('foo', first_version) # pylint: disable=invalid-name
+    assert_frame_equal(df, snapshot_df)
+    assert analysis_timestamp == datetime(2000, 2, 1, tzinfo=timezone.utc)
+
+def test_snapshot_store_resave_version(snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests that saving the same analysis twice replaces its version."""
+    store = SnapshotStore()
+    analysis_timestamp = datetime(2000, 1, 1, tzinfo=timezone.utc)
+    store.save('foo', snapshot_df, analysis_timestamp)
+    store.save('foo', snapshot_df[['id']], analysis_timestamp)
+    assert len(store.get_versions('foo')) == 1
+    assert os.listdir(store.get_path('foo')) == store.get_versions('foo')
+    df, _ = store.load('foo') # pylint: disable=invalid-name
+    assert df.columns.tolist() == ['id']
+
+def test_snapshot_store_max_versions(mocker, snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests that only the latest MAX_VERSIONS versions are kept."""
+    mocker.patch('app.snapshots.SnapshotStore.MAX_VERSIONS', new=2)
+    store = SnapshotStore()
+    versions = [store.save('foo', snapshot_df,
+                           datetime(2000, month, 1, tzinfo=timezone.utc))
+                for month in range(1, 4)]
+    assert store.get_versions('foo') == versions[1:]
+
+def test_snapshot_store_versions_ignore_staging(snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests that a staging directory left behind by a killed save isn't
+    taken for the latest version, even if it has a metadata file."""
+    store = SnapshotStore()
+    version = store.save('foo', snapshot_df, datetime.now(timezone.utc))
+    shutil.copytree(store.get_path('foo', version),
+                    store.get_path('foo', 'zzzzzzzz' + store.STAGING_SUFFIX))
+    assert store.get_versions('foo') == [version]
+
+def test_snapshot_store_iter_chunks(snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests loading a snapshot chunk by chunk."""
+    store = SnapshotStore()
+    store.save('foo', snapshot_df, datetime.now(timezone.utc))
+    chunks = list(store.iter_chunks('foo', 1))
+    assert len(chunks) == 2
+    assert_frame_equal(pd.concat(chunks, ignore_index=True).drop(
+        columns='id'), snapshot_df.drop(columns='id'))
+    assert [chunk['id'].dtype for chunk in chunks] == [np.dtype('S32')] * 2
+    assert chunks[1]['id'].tolist() == [b'bar']
+
+def test_snapshot_store_iter_chunks_empty(snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests that an empty snapshot is loaded as a single empty chunk,
+    and a missing one as no chunks at all."""
+    store = SnapshotStore()
+    assert not list(store.iter_chunks('foo', 1))
+    store.save('foo', snapshot_df[:0], datetime.now(timezone.utc))
+    chunks = list(store.iter_chunks('foo', 1))
+    assert len(chunks) == 1
+    assert chunks[0].empty
+    assert chunks[0].columns.tolist() == snapshot_df.columns.tolist()
+
+def test_snapshot_store_unsupported_dtype(snapshot_df): # pylint: disable=redefined-outer-name
+    """Tests that columns which can't be stored raise a ValueError, and
+    don't leave anything behind."""
+    store = SnapshotStore()
+    snapshot_df['recent_open'] = ['2000-01-01T00:00:00+00:00', None]
+    with pytest.raises(ValueError):
+        store.save('foo', snapshot_df, datetime.now(timezone.utc))
+    assert not os.listdir(store.get_path('foo'))
@@ -0,0 +1,95 @@
+import os
+from collections import OrderedDict
+import pytest
+import numpy as np
+import pandas as pd
+from app.spill import ColumnSpill
+
+@pytest.fixture
+def spill():
+    """Provides an empty spill of member ids and status codes."""
+    spill = ColumnSpill( # pylint: disable=redefined-outer-name
+        OrderedDict([('status', np.int8), ('id', 'S32')]),
+        {'status': ['subscribed', 'cleaned']})
+    yield spill
+    spill.close()
+
+def test_spill_directory(spill, spill_dir): # pylint: disable=redefined-outer-name
+    """Tests that the spill is kept in the spill directory, and removed
+    once closed."""
+    path = spill.tmp_dir.name
+    assert os.path.dirname(path) == spill_dir
+    spill.close()
+    assert not os.path.exists(path)
+
+def test_spill_remove_abandoned_spills(spill_dir):
+    """Tests that spills older than MAX_AGE are removed by new spills."""
+    abandoned_dir = os.path.join(spill_dir, ColumnSpill.PREFIX + 'foo')
+    recent_dir = os.path.join(spill_dir, ColumnSpill.PREFIX + 'bar')
+    other_dir = os.path.join(spill_dir, 'baz')
+    for path in (abandoned_dir, recent_dir, other_dir):
+        os.mkdir(path)
+    os.utime(abandoned_dir, (0, 0))
+    os.utime(other_dir, (0, 0))
+    spill = ColumnSpill( # pylint: disable=redefined-outer-name
+        OrderedDict([('status', np.int8)]))
+    assert not os.path.exists(abandoned_dir)
+    assert os.path.exists(recent_dir)
+    assert os.path.exists(other_dir)
+    spill.close()
+
+def test_spill_finish(spill): # pylint: disable=redefined-outer-name
+    """Tests that chunks appended out of order are memory-mapped in chunk
+    order."""
+    spill.append(1, {'status': np.array([1], dtype=np.int8),
+                     'id': np.array([b'baz'], dtype='S32')})
+    spill.append(0, {'status': np.array([0, 1], dtype=np.int8),
+                     'id': np.array([b'foo', b'bar'], dtype='S32')})
+    spill.finish()
+    assert isinstance(spill.columns['id'], np.memmap)
+    assert spill.columns['status'].tolist() == [0, 1, 1]
+    assert spill.columns['id'].tolist() == [b'foo', b'bar', b'baz']
+    assert not any(name.endswith('.raw')
+                   for name in os.listdir(spill.tmp_dir.name))
+
+def test_spill_empty(spill): # pylint: disable=redefined-outer-name
+    """Tests finishing a spill without any chunks."""
+    spill.finish()
+    assert spill.columns['id'].tolist() == []
+    assert spill.find_rows('id', np.array([b'foo'], dtype='S32')).tolist() == [
+        -1]
+    frames = list(spill.iter_frames(10))
+    assert len(frames) == 1
+    assert frames[0].empty
+
+def test_spill_add_column(spill): # pylint: disable=redefined-outer-name
+    """Tests adding a writable column to a finished spill."""
+    spill.append(0, {'status': np.array([0, 1], dtype=np.int8),
+                     'id': np.array([b'foo', b'bar'], dtype='S32')})
+    spill.finish()
+    recent_opens = spill.add_column(
+        'recent_open', 'datetime64[ns]', np.datetime64('NaT'))
+    recent_opens[1] = np.datetime64('2000-01-01')
+    recent_opens = spill.add_column(
+        'recent_open', 'datetime64[ns]', np.datetime64('NaT'))
+    assert list(spill.columns) == ['status', 'id', 'recent_open']
+    assert pd.Series(spill.columns['recent_open']).isnull().all()
+
+def test_spill_find_rows(spill): # pylint: disable=redefined-outer-name
+    """Tests looking up rows by value."""
+    spill.READ_CHUNK_SIZE = 2
+    spill.append(0, {'status': np.zeros(3, dtype=np.int8),
+                     'id': np.array([b'foo', b'bar', b'baz'], dtype='S32')})
+    spill.finish()
+    assert spill.find_rows('id', np.array(
+        [b'baz', b'qux', b'foo'], dtype='S32')).tolist() == [2, -1, 0]
+
+def test_spill_iter_frames(spill): # pylint: disable=redefined-outer-name
+    """Tests reading a spill into dataframes, decoding categories."""
+    spill.append(0, {'status': np.array([0, 1, 0], dtype=np.int8),
+                     'id': np.array([b'foo', b'bar', b'baz'], dtype='S32')})
+    spill.finish()
+    frames = list(spill.iter_frames(2))
+    assert [len(frame) for frame in frames] == [2, 1]
+    assert frames[0]['status'].tolist() == ['subscribed', 'cleaned']
+    assert frames[1]['id'].tolist() == [b'baz']
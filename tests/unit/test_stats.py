@@ -0,0 +1,84 @@
+import datetime
+from collections import OrderedDict
+import pytest
+import pandas as pd
+import numpy as np
+from app.members import MemberBuffer
+
+def test_calc_open_rate(mailchimp_list):
+    """Tests the calc_open_rate function."""
+    mailchimp_list.calc_open_rate('10')
+    assert mailchimp_list.open_rate == 0.1
+
+@pytest.mark.parametrize('campaign_count, expected_frequency', [
+    ('5', 0), ('365', 1)])
+def test_calc_frequency(
+        mocker, mailchimp_list, campaign_count, expected_frequency):
+    """Tests the calc_frequency function."""
+    mocked_datetime = mocker.patch('app.stats.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2000, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list.calc_frequency(
+        '1999-1-1T00:00:00+00:00', campaign_count)
+    assert mailchimp_list.frequency == expected_frequency
+
+def test_bin_open_rates_float32(mailchimp_list):
+    """Tests that bin_open_rates bins single-precision open rates at their
+    own precision."""
+    assert mailchimp_list.bin_open_rates(
+        np.array([0, 0.1, 0.8, np.NaN, 1], dtype=np.float32)) == (
+            [2, 0, 0, 0, 0, 0, 0, 1, 0, 1])
+
+def test_count_high_open_rates_float32(mailchimp_list):
+    """Tests that count_high_open_rates does not count a single-precision
+    open rate of exactly 0.8."""
+    assert mailchimp_list.count_high_open_rates(
+        np.array([0.8, 0.81, np.NaN], dtype=np.float32)) == 1
+
+def test_compute_all_stats(mocker, mailchimp_list):
+    """Tests the compute_all_stats function."""
+    mocked_datetime = mocker.patch('app.stats.datetime')
+    mocked_datetime.now.return_value = datetime.datetime(
+        2000, 1, 1, tzinfo=datetime.timezone.utc)
+    mailchimp_list.df = pd.DataFrame({
+        'status': pd.Categorical(
+            ['subscribed', 'subscribed', 'subscribed', 'unsubscribed',
+             'subscribed', 'cleaned', 'pending', 'subscribed'],
+            categories=MemberBuffer.STATUSES),
+        'avg_open_rate': np.array(
+            [0, 0.09, 0.56, 0.9, 0.81, 0.87, 0.2, 1], dtype=np.float32),
+        'recent_open': pd.to_datetime(
+            ['2000-10-01', None, '2000-11-01', None, None, None, None,
+             '2000-12-01'])
+    })
+    mailchimp_list.count = 8
+    stats = mailchimp_list.compute_all_stats(
+        '10', '1999-1-1T00:00:00+00:00', '365')
+    assert stats == OrderedDict([
+        ('frequency', 1),
+        ('subscribers', 5),
+        ('open_rate', 0.1),
+        ('hist_bin_counts', [2, 0, 0, 0, 0, 1, 0, 0, 1, 1]),
+        ('subscribed_pct', 0.625),
+        ('unsubscribed_pct', 0.125),
+        ('cleaned_pct', 0.125),
+        ('pending_pct', 0.125),
+        ('high_open_rt_pct', 0.4),
+        ('cur_yr_inactive_pct', 0.4)])
+    assert all(getattr(mailchimp_list, k) == v for k, v in stats.items())
+
+def test_compute_all_stats_no_subscribers(mailchimp_list):
+    """Tests the compute_all_stats function when a list has no
+    subscribers."""
+    mailchimp_list.df = pd.DataFrame({
+        'status': ['cleaned', 'foo'],
+        'avg_open_rate': [0.5, 0.5],
+        'recent_open': [np.NaN, np.NaN]
+    })
+    mailchimp_list.count = 2
+    stats = mailchimp_list.compute_all_stats('10', None, '5')
+    assert stats['subscribers'] == 0
+    assert stats['cleaned_pct'] == 0.5
+    assert stats['hist_bin_counts'] == [0] * 10
+    assert stats['high_open_rt_pct'] == 0
+    assert stats['cur_yr_inactive_pct'] == 0
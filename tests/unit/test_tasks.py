@@ -1,12 +1,13 @@
 import logging
-from datetime import datetime, timezone
 from unittest.mock import MagicMock, ANY, call
 import json
 import pytest
 import pandas as pd
+import requests
 from app.tasks import (
     send_activated_email, import_analyze_store_list, generate_summary_stats,
     send_report, extract_stats, init_list_analysis, update_stored_data,
+    update_stored_list, finish_stored_data_update,
     send_monthly_reports, generate_diffs)
 from app.lists import MailChimpImportError
 from app.models import ListStats
@@ -56,24 +57,32 @@ def test_import_analyze_store_list(
         fake_list_data, fake_list_data['org_id'])
     mocked_mailchimp_list.assert_called_with(
         fake_list_data['list_id'], fake_list_data['total_count'],
-        fake_list_data['key'], fake_list_data['data_center'])
-    mocked_do_async_import.assert_has_calls(
-        mocked_mailchimp_list_instance.import_list_members.return_value,
-        mocked_mailchimp_list_instance.import_sub_activity.return_value)
+        fake_list_data['key'], fake_list_data['data_center'],
+        fake_list_data['activity_strategy'], None, None)
+    mocked_do_async_import.assert_called_once_with(
+        mocked_mailchimp_list_instance.import_members_and_activity
+        .return_value)
+    mocked_mailchimp_list_instance.checkpoint.clear.assert_called()
     mocked_mailchimp_list_instance.flatten.assert_called()
-    mocked_mailchimp_list_instance.calc_list_breakdown.assert_called()
-    mocked_mailchimp_list_instance.calc_open_rate.assert_called_with(
-        fake_list_data['open_rate'])
-    mocked_mailchimp_list_instance.calc_frequency.assert_called_with(
-        fake_list_data['creation_timestamp'], fake_list_data['campaign_count'])
-    mocked_mailchimp_list_instance.calc_histogram.assert_called()
-    mocked_mailchimp_list_instance.calc_high_open_rate_pct.assert_called()
-    mocked_mailchimp_list_instance.calc_cur_yr_stats.assert_called()
+    mocked_mailchimp_list_instance.compute_all_stats.assert_called_with(
+        fake_list_data['open_rate'], fake_list_data['creation_timestamp'],
+        fake_list_data['campaign_count'])
     assert isinstance(list_stats, ListStats)
     mocked_list_stats.assert_called_with(
         **{k: (v if k != 'hist_bin_counts' else json.dumps(v))
            for k, v in fake_calculation_results.items()},
         list_id=fake_list_data['list_id'])
+    mocked_mailchimp_list_instance.close.assert_called_once()
+
+def test_import_analyze_store_list_closes_list_on_error(
+        mocker, fake_list_data, mocked_mailchimp_list):
+    """Tests that the import_analyze_store_list function removes the list's
+    spilled members even when the import fails."""
+    mocked_do_async_import = mocker.patch('app.tasks.do_async_import')
+    mocked_do_async_import.side_effect = MemoryError
+    with pytest.raises(MemoryError):
+        import_analyze_store_list(fake_list_data, fake_list_data['org_id'])
+    mocked_mailchimp_list.return_value.close.assert_called_once()
 
 def test_import_analyze_store_list_store_results_in_db( # pylint: disable=unused-argument
         mocker, fake_list_data, mocked_mailchimp_list):
@@ -93,10 +102,65 @@ def test_import_analyze_store_list_store_results_in_db( # pylint: disable=unused
         data_center=fake_list_data['data_center'],
         store_aggregates=fake_list_data['store_aggregates'],
         monthly_updates=fake_list_data['monthly_updates'],
+        activity_strategy=fake_list_data['activity_strategy'],
         org_id='foo')
     mocked_db.session.merge.assert_called_with(mocked_email_list.return_value)
     mocked_db.session.add.assert_called_with(mocked_list_stats.return_value)
     mocked_db.session.commit.assert_called()
+    mocked_mailchimp_list.return_value.save_snapshot.assert_called_with(ANY)
+
+def test_import_analyze_store_list_incremental(
+        mocker, fake_list_data, mocked_mailchimp_list):
+    """Tests the import_analyze_store_list function when updating a list
+    with a snapshot incrementally."""
+    mocked_mailchimp_list_instance = mocked_mailchimp_list.return_value
+    mocked_mailchimp_list_instance.load_snapshot.return_value = (
+        'foo', 'bar')
+    mocked_do_async_import = mocker.patch('app.tasks.do_async_import')
+    mocker.patch('app.tasks.ListStats')
+    fake_list_data['incremental'] = True
+    import_analyze_store_list(fake_list_data, 'foo')
+    mocked_mailchimp_list_instance.update_members.assert_called_with('foo')
+    mocked_mailchimp_list_instance.update_recent_activity.assert_called_with(
+        'bar')
+    mocked_do_async_import.assert_has_calls([
+        call(mocked_mailchimp_list_instance.update_members.return_value),
+        call(mocked_mailchimp_list_instance.update_recent_activity
+             .return_value)])
+    mocked_mailchimp_list_instance.import_members_and_activity.assert_not_called()
+    mocked_mailchimp_list_instance.save_snapshot.assert_not_called()
+
+def test_import_analyze_store_list_incremental_no_snapshot(
+        mocker, caplog, fake_list_data, mocked_mailchimp_list):
+    """Tests the import_analyze_store_list function when updating a list
+    without a snapshot incrementally."""
+    mocked_mailchimp_list_instance = mocked_mailchimp_list.return_value
+    mocked_mailchimp_list_instance.id = 'foo'
+    mocked_mailchimp_list_instance.load_snapshot.return_value = None
+    mocker.patch('app.tasks.do_async_import')
+    mocker.patch('app.tasks.ListStats')
+    fake_list_data['incremental'] = True
+    import_analyze_store_list(fake_list_data, 'foo')
+    mocked_mailchimp_list_instance.import_members_and_activity.assert_called()
+    mocked_mailchimp_list_instance.update_members.assert_not_called()
+    assert 'No snapshot of list foo found' in caplog.text
+
+def test_import_analyze_store_list_incremental_out_of_core(
+        mocker, caplog, fake_list_data, mocked_mailchimp_list):
+    """Tests that the import_analyze_store_list function imports a list
+    analyzed out of core in full, even if it's updated incrementally."""
+    mocked_mailchimp_list_instance = mocked_mailchimp_list.return_value
+    mocked_mailchimp_list_instance.id = 'foo'
+    mocked_mailchimp_list_instance.out_of_core = True
+    mocker.patch('app.tasks.do_async_import')
+    mocker.patch('app.tasks.ListStats')
+    fake_list_data['incremental'] = True
+    caplog.set_level(logging.INFO)
+    import_analyze_store_list(fake_list_data, 'foo')
+    assert 'List foo is analyzed out of core' in caplog.text
+    mocked_mailchimp_list_instance.load_snapshot.assert_not_called()
+    mocked_mailchimp_list_instance.import_members_and_activity.assert_called()
+    mocked_mailchimp_list_instance.update_members.assert_not_called()
 
 def test_import_analyze_store_list_store_results_in_db_exception( # pylint: disable=unused-argument
         mocker, fake_list_data, mocked_mailchimp_list):
@@ -253,8 +317,9 @@ def test_extract_stats(fake_calculation_results):
 def test_init_list_analysis_existing_list_update_privacy_options(
         mocker, fake_list_data):
     """Tests the init_list_analysis function when the list exists in
-    the database. Also tests that monthly_updates and store_aggregates
-    are updated if they differ from that stored in the database."""
+    the database. Also tests that monthly_updates, store_aggregates and
+    activity_strategy are updated if they differ from that stored in the
+    database."""
     mocked_list_stats = mocker.patch('app.tasks.ListStats')
     mocked_recent_analyses = (
         mocked_list_stats.query.filter_by.return_value.order_by
@@ -265,12 +330,14 @@ def test_init_list_analysis_existing_list_update_privacy_options(
         mocked_email_list.query.filter_by.return_value.first.return_value)
     mocked_list_object.monthly_updates = True
     mocked_list_object.store_aggregates = False
+    mocked_list_object.activity_strategy = 'member_activity'
     mocked_db = mocker.patch('app.tasks.db')
     mocked_generate_summary_stats = mocker.patch(
         'app.tasks.generate_summary_stats')
     mocked_generate_summary_stats.return_value = 'foo', 'bar'
     mocked_send_report = mocker.patch('app.tasks.send_report')
     init_list_analysis({'email': 'foo@bar.com'}, fake_list_data, 1)
+    assert mocked_list_object.activity_strategy == 'campaign_reports'
     mocked_list_stats.query.filter_by.assert_called_with(
         list_id=fake_list_data['list_id'])
     mocked_list_stats.query.filter_by.return_value.order_by.assert_called_with(
@@ -314,7 +381,67 @@ def test_init_list_analysis_new_list_no_store(mocker, fake_list_data):
     mocker.patch('app.tasks.send_report')
     init_list_analysis({'email': 'foo@bar.com'}, fake_list_data, 1)
     mocked_import_analyze_store_list.assert_called_with(
-        fake_list_data, 1, 'foo@bar.com')
+        fake_list_data, 1, None, run_id=None)
+
+def test_init_list_analysis_import_error_retry(mocker, fake_list_data):
+    """Tests that the init_list_analysis function retries a failed import
+    under the same task id, without emailing the user."""
+    mocked_list_stats = mocker.patch('app.tasks.ListStats')
+    (mocked_list_stats.query.filter_by.return_value.order_by
+     .return_value.limit.return_value.all.return_value) = []
+    error = MailChimpImportError('foo', 'bar')
+    mocked_import_analyze_store_list = mocker.patch(
+        'app.tasks.import_analyze_store_list', side_effect=error)
+    mocked_retry = mocker.patch.object(
+        init_list_analysis, 'retry', return_value=RuntimeError())
+    with pytest.raises(RuntimeError):
+        init_list_analysis.apply(
+            ({'email': 'foo@bar.com'}, fake_list_data, 1),
+            task_id='baz', retries=0, throw=True)
+    mocked_import_analyze_store_list.assert_called_with(
+        fake_list_data, 1, None, run_id='baz')
+    mocked_retry.assert_called_with(exc=error)
+
+@pytest.mark.parametrize('has_checkpoints', [True, False])
+def test_init_list_analysis_retry_checkpoints(
+        mocker, caplog, fake_list_data, has_checkpoints):
+    """Tests that the init_list_analysis function warns when a retry finds
+    no checkpoints to resume from, e.g. on another machine."""
+    mocked_list_stats = mocker.patch('app.tasks.ListStats')
+    (mocked_list_stats.query.filter_by.return_value.order_by
+     .return_value.limit.return_value.all.return_value) = []
+    mocker.patch('app.tasks.import_analyze_store_list',
+                 side_effect=MailChimpImportError('foo', 'bar'))
+    mocker.patch.object(
+        init_list_analysis, 'retry', return_value=RuntimeError())
+    mocked_has_parts = mocker.patch(
+        'app.tasks.ImportCheckpoint.has_parts', return_value=has_checkpoints)
+    with pytest.raises(RuntimeError):
+        init_list_analysis.apply(
+            ({'email': 'foo@bar.com'}, fake_list_data, 1),
+            task_id='baz', retries=1, throw=True)
+    mocked_has_parts.assert_called_with(fake_list_data['list_id'], 'baz')
+    assert ('No checkpoints from earlier attempts' in caplog.text) != (
+        has_checkpoints)
+
+def test_init_list_analysis_import_error_final_attempt(
+        mocker, fake_list_data):
+    """Tests that the init_list_analysis function gives up (and emails the
+    user) once it runs out of retries."""
+    mocked_list_stats = mocker.patch('app.tasks.ListStats')
+    (mocked_list_stats.query.filter_by.return_value.order_by
+     .return_value.limit.return_value.all.return_value) = []
+    mocked_import_analyze_store_list = mocker.patch(
+        'app.tasks.import_analyze_store_list',
+        side_effect=MailChimpImportError('foo', 'bar'))
+    mocked_retry = mocker.patch.object(init_list_analysis, 'retry')
+    with pytest.raises(MailChimpImportError):
+        init_list_analysis.apply(
+            ({'email': 'foo@bar.com'}, fake_list_data, 1), task_id='baz',
+            retries=init_list_analysis.max_retries, throw=True)
+    mocked_import_analyze_store_list.assert_called_with(
+        fake_list_data, 1, 'foo@bar.com', run_id='baz')
+    mocked_retry.assert_not_called()
 
 def test_init_list_analysis_new_list_monthly_updates(mocker, fake_list_data):
     """Tests the init_list_analysis function when the list does not
@@ -329,6 +456,7 @@ def test_init_list_analysis_new_list_monthly_updates(mocker, fake_list_data):
         mocked_email_list.query.filter_by.return_value.first.return_value)
     mocked_list_object.monthly_updates = True
     mocked_list_object.store_aggregates = False
+    mocked_list_object.activity_strategy = 'campaign_reports'
     mocked_associate_user_with_list = mocker.patch(
         'app.tasks.associate_user_with_list')
     mocker.patch('app.tasks.generate_summary_stats', return_value=(
@@ -349,34 +477,52 @@ def test_update_stored_data_empty_db(mocker, caplog):
     assert 'No lists in the database!' in caplog.text
 
 def test_update_stored_data_no_old_analyses(mocker, caplog):
-    """Tests the update_stored_data function when there are no analyses older
-    than 30 days."""
+    """Tests the update_stored_data function when there are no lists to
+    update."""
     mocked_list_stats = mocker.patch('app.tasks.ListStats')
-    mocked_analysis = MagicMock(
-        analysis_timestamp=datetime.now(timezone.utc))
     (mocked_list_stats.query.order_by.return_value.distinct
-     .return_value.all.return_value) = [mocked_analysis]
+     .return_value.all.return_value) = [MagicMock()]
+    mocked_scheduler = mocker.patch('app.tasks.ListUpdateScheduler')
+    mocked_scheduler.return_value.schedule.return_value = []
     caplog.set_level(logging.INFO)
     update_stored_data()
     assert 'No old lists to update' in caplog.text
 
-
-def test_update_stored_data(mocker, fake_list_data):
-    """Tests the update_stored_data function."""
+def test_update_stored_data(mocker):
+    """Tests that the update_stored_data function dispatches a task for each
+    scheduled list, with a callback to collect the results."""
     mocked_list_stats = mocker.patch('app.tasks.ListStats')
-    mocked_list_to_update = MagicMock(
+    mocked_scheduler = mocker.patch('app.tasks.ListUpdateScheduler')
+    mocked_scheduler.return_value.schedule.return_value = [
+        MagicMock(list_id='foo'), MagicMock(list_id='baz')]
+    mocked_scheduler.return_value.costs = {'foo': 2, 'baz': 1}
+    mocked_scheduler.return_value.daily_budget = 3
+    mocked_chord = mocker.patch('app.tasks.chord')
+    update_stored_data()
+    mocked_scheduler.assert_called_with(
+        (mocked_list_stats.query.order_by.return_value.distinct
+         .return_value.all.return_value), ANY)
+    header, = mocked_chord.call_args[0]
+    assert list(header) == [update_stored_list.s('foo'),
+                            update_stored_list.s('baz')]
+    mocked_chord.return_value.assert_called_with(
+        finish_stored_data_update.s())
+
+@pytest.fixture
+def mocked_stored_list(mocker, fake_list_data):
+    """Mocks the EmailList query for the list being updated."""
+    mocked_email_list = mocker.patch('app.tasks.EmailList')
+    mocked_stored_list = MagicMock(
         **{('api_key' if k == 'key' else k): v
-           for k, v in fake_list_data.items()}
-    )
-    mocked_analysis = MagicMock(
-        analysis_timestamp=datetime(2000, 1, 1, tzinfo=timezone.utc),
-        list=mocked_list_to_update,
-        list_id=fake_list_data['list_id'])
-    (mocked_list_stats.query.order_by.return_value.distinct
-     .return_value.all.return_value) = [mocked_analysis]
+           for k, v in fake_list_data.items()})
+    (mocked_email_list.query.filter_by.return_value
+     .first.return_value) = mocked_stored_list
+    yield mocked_stored_list
+
+@pytest.fixture
+def mocked_list_stats_response(mocker):
+    """Mocks the request for an updated list's stats."""
     mocked_requests = mocker.patch('app.tasks.requests')
-    mocked_import_analyze_store_list = mocker.patch(
-        'app.tasks.import_analyze_store_list')
     mocked_requests.get.return_value.json.return_value = {
         'stats': {
             'member_count': 5,
@@ -386,8 +532,15 @@ def test_update_stored_data(mocker, fake_list_data):
             'campaign_count': 10
         }
     }
-    update_stored_data()
-    mocked_requests.get.assert_called_with(
+    yield mocked_requests
+
+def test_update_stored_list(mocker, mocked_stored_list, # pylint: disable=redefined-outer-name, unused-argument
+                            mocked_list_stats_response): # pylint: disable=redefined-outer-name
+    """Tests the update_stored_list function."""
+    mocked_import_analyze_store_list = mocker.patch(
+        'app.tasks.import_analyze_store_list')
+    assert update_stored_list('foo') is None
+    mocked_list_stats_response.get.assert_called_with(
         'https://bar1.api.mailchimp.com/3.0/lists/foo',
         params=(
             ('fields', 'stats.member_count,'
@@ -404,63 +557,73 @@ def test_update_stored_data(mocker, fake_list_data):
          'data_center': 'bar1',
          'monthly_updates': False,
          'store_aggregates': False,
+         'activity_strategy': 'campaign_reports',
          'total_count': 18,
          'open_rate': 1,
          'creation_timestamp': 'quux',
-         'campaign_count': 10},
+         'campaign_count': 10,
+         'incremental': True},
         1)
 
-def test_update_stored_data_keyerror(mocker, fake_list_data, caplog):
-    """Tests the update_stored_data function when the list raises a KeyError."""
-    mocked_list_stats = mocker.patch('app.tasks.ListStats')
-    mocked_list_to_update = MagicMock(
-        **{('api_key' if k == 'key' else k): v
-           for k, v in fake_list_data.items()}
-    )
-    mocked_analysis = MagicMock(
-        analysis_timestamp=datetime(2000, 1, 1, tzinfo=timezone.utc),
-        list=mocked_list_to_update,
-        list_id=fake_list_data['list_id'])
-    (mocked_list_stats.query.order_by.return_value.distinct
-     .return_value.all.return_value) = [mocked_analysis]
+@pytest.mark.parametrize('task, ignores_result', [
+    (send_activated_email, True), (init_list_analysis, True),
+    (update_stored_data, True), (update_stored_list, False),
+    (finish_stored_data_update, True), (send_monthly_reports, True)])
+def test_tasks_ignore_results(task, ignores_result):
+    """Tests that only the chord's tasks store their results in the result
+    backend."""
+    assert task.ignore_result == ignores_result
+
+def test_update_stored_list_missing(mocker, caplog):
+    """Tests the update_stored_list function when the list was removed from
+    the database."""
+    mocked_email_list = mocker.patch('app.tasks.EmailList')
+    mocked_email_list.query.filter_by.return_value.first.return_value = None
+    assert update_stored_list('foo') == 'foo'
+    assert 'List no longer exists in the database.' in caplog.text
+
+def test_update_stored_list_keyerror(mocker, mocked_stored_list, caplog): # pylint: disable=redefined-outer-name, unused-argument
+    """Tests the update_stored_list function when the list raises a KeyError."""
     mocked_requests = mocker.patch('app.tasks.requests')
     mocked_requests.get.return_value.json.return_value = {}
-    with pytest.raises(MailChimpImportError):
-        update_stored_data()
+    assert update_stored_list('foo') == 'foo'
     assert ('Error updating list foo. API key is no longer valid or list '
             'no longer exists.') in caplog.text
 
-def test_update_stored_data_import_error(mocker, fake_list_data, caplog):
-    """Tests the update_stored_data function when the list import raises an error."""
-    mocked_list_stats = mocker.patch('app.tasks.ListStats')
-    mocked_list_to_update = MagicMock(
-        **{('api_key' if k == 'key' else k): v
-           for k, v in fake_list_data.items()}
-    )
-    mocked_analysis = MagicMock(
-        analysis_timestamp=datetime(2000, 1, 1, tzinfo=timezone.utc),
-        list=mocked_list_to_update,
-        list_id=fake_list_data['list_id'])
-    (mocked_list_stats.query.order_by.return_value.distinct
-     .return_value.all.return_value) = [mocked_analysis]
-    mocked_requests = mocker.patch('app.tasks.requests')
+def test_update_stored_list_import_error(mocker, mocked_stored_list, # pylint: disable=redefined-outer-name, unused-argument
+                                         mocked_list_stats_response, caplog): # pylint: disable=redefined-outer-name, unused-argument
+    """Tests the update_stored_list function when the list import raises an error."""
     mocked_import_analyze_store_list = mocker.patch(
         'app.tasks.import_analyze_store_list')
     mocked_import_analyze_store_list.side_effect = MailChimpImportError(
         'foo', 'bar')
-    mocked_requests.get.return_value.json.return_value = {
-        'stats': {
-            'member_count': 5,
-            'unsubscribe_count': 6,
-            'cleaned_count': 7,
-            'open_rate': 1,
-            'campaign_count': 10
-        }
-    }
-    with pytest.raises(MailChimpImportError):
-        update_stored_data()
+    assert update_stored_list('foo') == 'foo'
     assert 'Error importing new data for list foo.' in caplog.text
 
+@pytest.mark.parametrize('error', [
+    requests.exceptions.ConnectionError, ValueError, RuntimeError])
+def test_update_stored_list_unexpected_error(
+        mocker, mocked_stored_list, caplog, error): # pylint: disable=redefined-outer-name, unused-argument
+    """Tests that the update_stored_list function reports any other error
+    as a failed update, rather than failing the chord."""
+    mocked_requests = mocker.patch('app.tasks.requests')
+    mocked_requests.get.side_effect = error
+    assert update_stored_list('foo') == 'foo'
+    assert 'Error updating list foo.' in caplog.text
+
+def test_finish_stored_data_update():
+    """Tests the finish_stored_data_update function when every list was
+    updated."""
+    finish_stored_data_update([None, None])
+
+def test_finish_stored_data_update_failures():
+    """Tests that the finish_stored_data_update function raises an error
+    listing the lists which failed to update."""
+    with pytest.raises(MailChimpImportError) as e: # pylint: disable=invalid-name
+        finish_stored_data_update([None, 'foo', 'bar'])
+    assert str(e.value) == "Some lists failed to update: ['foo', 'bar']"
+    assert e.value.error_details == ['foo', 'bar']
+
 def test_send_monthly_reports(mocker, fake_list_data, caplog):
     """Tests the send_monthly_reports function."""
     mocked_email_list = mocker.patch('app.tasks.EmailList')
@@ -0,0 +1,188 @@
+import asyncio
+from datetime import datetime, timezone
+import pytest
+from app.throttling import (
+    AdaptiveConcurrencyLimiter, ApiKeyConnectionSlots, RetryPolicy)
+
+@pytest.fixture
+def limiter():
+    """Creates an AdaptiveConcurrencyLimiter."""
+    yield AdaptiveConcurrencyLimiter(2, 4)
+
+@pytest.fixture
+def mocked_time(mocker):
+    """Freezes the limiter's clock at 10 seconds."""
+    mocked_time = mocker.patch('app.throttling.time')
+    mocked_time.monotonic.return_value = 10
+    yield mocked_time
+
+def test_adaptive_concurrency_limiter_init():
+    """Tests that the initial limit is kept within bounds."""
+    assert AdaptiveConcurrencyLimiter(2, 4).limit == 2
+    assert AdaptiveConcurrencyLimiter(5, 4).limit == 4
+    assert AdaptiveConcurrencyLimiter(0, 4).limit == 1
+
+@pytest.mark.asyncio
+async def test_acquire_release():
+    """Tests that only limit slots can be acquired at once."""
+    limiter = AdaptiveConcurrencyLimiter(2, 4)
+    await limiter.acquire()
+    await limiter.acquire()
+    waiting = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    await limiter.release()
+    await asyncio.wait_for(waiting, 1)
+    assert limiter.in_flight == 2
+
+@pytest.mark.asyncio
+async def test_context_manager():
+    """Tests using the limiter as an async context manager."""
+    limiter = AdaptiveConcurrencyLimiter(2, 4)
+    async with limiter:
+        assert limiter.in_flight == 1
+    assert limiter.in_flight == 0
+
+def test_record_success(mocked_time, limiter): # pylint: disable=unused-argument
+    """Tests that fast successful responses grow the limit additively,
+    up to the max."""
+    limiter.record(9, 200)
+    assert limiter.limit == 2.5
+    assert limiter.typical_latency == 1
+    for _ in range(20):
+        limiter.record(9, 200)
+    assert limiter.limit == 4
+
+@pytest.mark.parametrize('status', [429, 504, None])
+def test_record_congestion(
+        mocked_time, limiter, status): # pylint: disable=unused-argument
+    """Tests that congestion shrinks the limit multiplicatively."""
+    limiter.limit = 4
+    limiter.record(9, status)
+    assert limiter.limit == 2
+    assert limiter.last_backoff == 10
+
+def test_record_other_error(mocked_time, limiter): # pylint: disable=unused-argument
+    """Tests that other error responses leave the limit alone."""
+    limiter.record(9, 404)
+    assert limiter.limit == 2
+    assert limiter.typical_latency is None
+
+def test_record_latency_spike(mocked_time, limiter): # pylint: disable=unused-argument
+    """Tests that an unusually slow response shrinks the limit."""
+    limiter.typical_latency = 1
+    limiter.record(7, 200)
+    assert limiter.limit == 1
+    assert limiter.typical_latency == 1.4
+
+def test_back_off_once_per_round(mocked_time, limiter):
+    """Tests that requests sent before the last backoff can't shrink the
+    limit again, and that the limit doesn't go below the min."""
+    limiter.limit = 4
+    limiter.record(9, 429)
+    limiter.record(9.5, 429)
+    assert limiter.limit == 2
+    mocked_time.monotonic.return_value = 11
+    limiter.record(10, 429)
+    limiter.last_backoff = 0
+    limiter.record(10, 429)
+    assert limiter.limit == 1
+
+@pytest.fixture
+def retry_policy():
+    """Creates a RetryPolicy."""
+    yield RetryPolicy((429, 504), 2, 1, 10, 3)
+
+def test_retry_policy_should_retry(retry_policy):
+    """Tests that only retryable failures are retried, up to the max number
+    of retries per request, and until the budget runs out."""
+    assert not retry_policy.should_retry(0, 404)
+    assert not retry_policy.should_retry(2, 429)
+    assert retry_policy.retries_left == 3
+    assert retry_policy.should_retry(0, 429)
+    assert retry_policy.should_retry(1, None)
+    assert retry_policy.should_retry(0, 504)
+    assert not retry_policy.should_retry(0, 429)
+    assert retry_policy.retries_left == 0
+
+def test_retry_policy_retry_ratio():
+    """Tests that each request adds its share of retries to the budget,
+    and only whole retries are used."""
+    retry_policy = RetryPolicy((429, 504), 2, 1, 10, 0, 0.5)
+    retry_policy.record_request()
+    assert not retry_policy.should_retry(0, 429)
+    retry_policy.record_request()
+    assert retry_policy.should_retry(0, 429)
+    assert not retry_policy.should_retry(0, 429)
+
+def test_retry_policy_get_delay(mocker, retry_policy):
+    """Tests that delays are drawn between the base delay and three times
+    the previous delay, and capped."""
+    mocked_random = mocker.patch('app.throttling.random')
+    mocked_random.uniform.return_value = 2
+    assert retry_policy.get_delay(None) == 2
+    mocked_random.uniform.assert_called_with(1, 3)
+    assert retry_policy.get_delay(2) == 2
+    mocked_random.uniform.assert_called_with(1, 6)
+    mocked_random.uniform.return_value = 12
+    assert retry_policy.get_delay(6) == 10
+
+def test_retry_policy_get_delay_retry_after(mocker, retry_policy):
+    """Tests that delays are at least as long as Retry-After asks."""
+    mocker.patch('app.throttling.random').uniform.return_value = 2
+    assert retry_policy.get_delay(None, '1') == 2
+    assert retry_policy.get_delay(None, '30') == 30
+
+@pytest.mark.parametrize('retry_after, expected_delay', [
+    (None, None),
+    ('foo', None),
+    ('-5', 0),
+    ('1.5', 1.5),
+    ('Mon, 01 Jan 2001 00:01:00 GMT', 60),
+    ('Sun, 31 Dec 2000 00:00:00 GMT', 0)])
+def test_retry_policy_parse_retry_after(mocker, retry_after, expected_delay):
+    """Tests parsing the Retry-After header, in seconds or as a date."""
+    mocked_datetime = mocker.patch('app.throttling.datetime')
+    mocked_datetime.now.return_value = datetime(2001, 1, 1, tzinfo=timezone.utc)
+    assert RetryPolicy.parse_retry_after(retry_after) == expected_delay
+
+def test_connection_slots_shared_by_key(connection_slots_dir):
+    """Tests that slots for the same API key are shared between instances
+    (as between processes), but not with other API keys."""
+    slots = ApiKeyConnectionSlots('foo', 2)
+    other_slots = ApiKeyConnectionSlots('foo', 2)
+    first_slot = slots.try_acquire()
+    second_slot = other_slots.try_acquire()
+    assert first_slot is not None and second_slot is not None
+    assert slots.try_acquire() is None
+    assert ApiKeyConnectionSlots('bar', 2).try_acquire() is not None
+    slots.release(first_slot)
+    assert other_slots.try_acquire() is not None
+    assert all(path.startswith(connection_slots_dir) and 'foo' not in path
+               for path in slots.slot_paths)
+
+@pytest.mark.asyncio
+async def test_connection_slots_acquire_waits(mocker):
+    """Tests that acquiring a slot waits for one to be released."""
+    mocked_sleep = mocker.patch('app.throttling.asyncio.sleep')
+    slots = ApiKeyConnectionSlots('foo', 1)
+    held_slot = slots.try_acquire()
+    async def release_slot(_):
+        slots.release(held_slot)
+    mocked_sleep.side_effect = release_slot
+    async with slots.slot() as slot:
+        assert slot.slot_fd is not None
+        assert slots.try_acquire() is None
+    mocked_sleep.assert_called_once_with(slots.POLL_INTERVAL)
+    assert slots.try_acquire() is not None
+
+@pytest.mark.asyncio
+async def test_connection_slots_without_file_locking(mocker):
+    """Tests that slots are always free where file locking isn't
+    available."""
+    mocker.patch('app.throttling.fcntl', new=None)
+    slots = ApiKeyConnectionSlots('foo', 1)
+    assert slots.try_acquire() == -1
+    async with slots.slot():
+        async with slots.slot() as slot:
+            assert slot.slot_fd == -1